@@ -14,6 +14,7 @@ from pathlib import Path
 import os
 from decouple import config, Csv
 import dj_database_url
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -43,8 +44,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'tuttiapp.metrics.RequestMetricsMiddleware', # first, so it times everything below it (see /metrics)
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware', # For serving static files on Render.com. i have added it later in deployment stages of the project . INITIALLY IT WAS NOT THERE
+    'tuttiapp.middleware.StaticFilesMiddleware', # WhiteNoise, for serving static files on Render.com (async-capable for ASGI, see tuttiapp/middleware.py)
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -81,11 +83,87 @@ DATABASES = {
         # Look for the DATABASE_URL environment variable,
         # otherwise fall back to local SQLite
         default='sqlite:///' + os.path.join(BASE_DIR, 'db.sqlite3'),
-        conn_max_age=600
+        conn_max_age=config('DB_CONN_MAX_AGE', default=600, cast=int),
+        # A persistent connection the server has dropped is replaced instead of failing the next request
+        conn_health_checks=True,
+        # Transaction-mode PgBouncer can't keep a server-side cursor (the exports' .iterator()) open
+        disable_server_side_cursors=config('DB_PGBOUNCER', default=False, cast=bool),
     )
 } # i have changed this database configuration to use dj_database_url for easier deployment on Render.com
 #this has been done in the late stages of deployment of the project. Normally there is a predefined way that the databases behave
 
+# Engine-specific tuning (the pragmas themselves are applied on connect by tuttiapp/db.py)
+# SQLite: WAL lets readers carry on while one worker writes, and BEGIN IMMEDIATE takes the write
+# lock when the transaction starts, so a busy writer waits up to busy_timeout instead of failing
+# halfway through with "database is locked". synchronous=NORMAL is safe with WAL (a power cut can
+# lose the last commits, not corrupt the file).
+# Postgres: DB_POOL=True uses Django's connection pool (needs psycopg[pool]) instead of one
+# persistent connection per worker thread; DB_PGBOUNCER=True when an external PgBouncer pools them.
+_DB_ENGINE = DATABASES['default']['ENGINE']
+SQLITE_PRAGMAS = {}
+if _DB_ENGINE == 'django.db.backends.sqlite3' and config('SQLITE_TUNING', default=True, cast=bool):
+    DATABASES['default'].setdefault('OPTIONS', {})['transaction_mode'] = 'IMMEDIATE'
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': config('SQLITE_BUSY_TIMEOUT_MS', default=5000, cast=int),
+        'mmap_size': config('SQLITE_MMAP_SIZE', default=128 * 1024 * 1024, cast=int),
+        'cache_size': -config('SQLITE_CACHE_KB', default=20000, cast=int),  # negative = KiB, not pages
+    }
+elif _DB_ENGINE == 'django.db.backends.postgresql' and config('DB_POOL', default=False, cast=bool):
+    DATABASES['default']['CONN_MAX_AGE'] = 0  # the pool keeps the connections instead
+    DATABASES['default'].setdefault('OPTIONS', {})['pool'] = {
+        'min_size': config('DB_POOL_MIN_SIZE', default=2, cast=int),
+        'max_size': config('DB_POOL_MAX_SIZE', default=10, cast=int),
+        'timeout': config('DB_POOL_TIMEOUT', default=10, cast=int),  # seconds to wait for a free connection
+    }
+
+
+# Cache
+# CACHE_BACKEND picks where cached data lives:
+#   locmem - per process (default; fine for development and the tests)
+#   file   - a directory shared by every worker on one machine (CACHE_LOCATION = the directory)
+#   redis  - a Redis-compatible server shared by every worker (CACHE_LOCATION = redis://host:port/db)
+# Use file or redis when running several gunicorn workers, so they see each other's invalidations.
+CACHE_BACKEND = config('CACHE_BACKEND', default='locmem')
+CACHE_LOCATION = config('CACHE_LOCATION', default='')
+
+_CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'tutti'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', os.path.join(BASE_DIR, '.cache')),
+    'redis': ('django.core.cache.backends.redis.RedisCache', 'redis://127.0.0.1:6379/1'),
+}
+if CACHE_BACKEND not in _CACHE_BACKENDS:
+    raise ImproperlyConfigured(f"CACHE_BACKEND must be one of {', '.join(_CACHE_BACKENDS)}, not {CACHE_BACKEND!r}")
+
+CACHES = {
+    'default': {
+        'BACKEND': _CACHE_BACKENDS[CACHE_BACKEND][0],
+        'LOCATION': CACHE_LOCATION or _CACHE_BACKENDS[CACHE_BACKEND][1],
+        'KEY_PREFIX': 'tutti',
+        'TIMEOUT': config('CACHE_TIMEOUT', default=300, cast=int),
+    }
+}
+
+
+# Sessions and the logged-in user
+# SESSION_BACKEND: cached_db (default: read from the cache, written through to the database),
+# cache (cache only: sessions are lost if the cache is cleared, so only with redis),
+# signed_cookies (no server-side storage at all) or db (Django's default, one query per request).
+SESSION_BACKEND = config('SESSION_BACKEND', default='cached_db')
+_SESSION_ENGINES = {
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+    'db': 'django.contrib.sessions.backends.db',
+}
+if SESSION_BACKEND not in _SESSION_ENGINES:
+    raise ImproperlyConfigured(f"SESSION_BACKEND must be one of {', '.join(_SESSION_ENGINES)}, not {SESSION_BACKEND!r}")
+SESSION_ENGINE = _SESSION_ENGINES[SESSION_BACKEND]
+
+# request.user comes from the cache instead of a SELECT on every request (tuttiapp/auth.py)
+AUTHENTICATION_BACKENDS = ['tuttiapp.auth.CachedModelBackend']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -170,3 +248,47 @@ MPESA_SHORTCODE = config('MPESA_SHORTCODE', default='')
 MPESA_PASSKEY = config('MPESA_PASSKEY', default='')
 MPESA_EXPRESS_SHORTCODE = config('MPESA_EXPRESS_SHORTCODE', default='')
 MPESA_SHORTCODE_TYPE = config('MPESA_SHORTCODE_TYPE', default='')
+
+# M-Pesa gateway (tuttiapp/mpesa.py)
+# Leave MPESA_API_BASE_URL empty to use the Safaricom URL for MPESA_ENVIRONMENT,
+# or point it at a local stub (tuttiapp/daraja_stub.py) for load tests.
+MPESA_API_BASE_URL = config('MPESA_API_BASE_URL', default='')
+MPESA_CALLBACK_URL = config('MPESA_CALLBACK_URL', default='https://tutti-pnpn.onrender.com/mpesa/callback/')
+MPESA_POOL_SIZE = config('MPESA_POOL_SIZE', default=10, cast=int)
+MPESA_TOKEN_REFRESH_MARGIN = config('MPESA_TOKEN_REFRESH_MARGIN', default=300, cast=int) # refresh the OAuth token this many seconds early
+MPESA_PUSH_WORKERS = config('MPESA_PUSH_WORKERS', default=4, cast=int) # background threads for STK pushes, 0 = send inline
+MPESA_PUSH_ASYNC = config('MPESA_PUSH_ASYNC', default=False, cast=bool) # send them from one event loop instead (httpx if installed)
+
+# Lesson reminders (manage.py send_lesson_reminders)
+# Backends: tuttiapp.reminders.ConsoleReminderBackend, .EmailReminderBackend, .SmsStubReminderBackend
+LESSON_REMINDER_BACKEND = config('LESSON_REMINDER_BACKEND', default='tuttiapp.reminders.ConsoleReminderBackend')
+LESSON_REMINDER_WINDOW_HOURS = config('LESSON_REMINDER_WINDOW_HOURS', default=24, cast=int)
+
+# Recurring lessons (manage.py materialize_lesson_series): how far ahead a series' lessons exist
+LESSON_SERIES_WINDOW_WEEKS = config('LESSON_SERIES_WINDOW_WEEKS', default=4, cast=int)
+
+# Deleting a user from manage_users: users with more related rows (lessons, payments, series) than this
+# are disabled at once and purged in the background by `manage.py purge_deleted_users`
+USER_DELETE_INLINE_LIMIT = config('USER_DELETE_INLINE_LIMIT', default=200, cast=int)
+
+
+# Request metrics (tuttiapp/metrics.py): requests slower than this are logged to tuttiapp.slow_requests
+SLOW_REQUEST_MS = config('SLOW_REQUEST_MS', default=500, cast=int)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'plain': {'format': '{asctime} {levelname} {name}: {message}', 'style': '{'},
+        'json': {'()': 'tuttiapp.metrics.JsonFormatter'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'plain'},
+        'json_console': {'class': 'logging.StreamHandler', 'formatter': 'json'},
+    },
+    'loggers': {
+        'tuttiapp': {'handlers': ['console'], 'level': config('LOG_LEVEL', default='INFO')},
+        # Structured, so the log platform can filter and chart on view / duration_ms / db_queries
+        'tuttiapp.slow_requests': {'handlers': ['json_console'], 'level': 'WARNING', 'propagate': False},
+    },
+}
@@ -34,11 +34,15 @@ urlpatterns = [
     
     path('teachers/', views.teacher_list, name='teacher_list'), # New URL pattern for listing teachers
     path('request/<int:teacher_id>/', views.request_lesson, name='request_lesson'), # New URL pattern for requesting a lesson
+    path('teachers/<int:teacher_id>/availability/', views.teacher_availability, name='teacher_availability'), # JSON: is a slot free + next free slots
     path('approve/<int:lesson_id>/', views.approve_lesson, name='approve_lesson'), # New URL pattern for approving a lesson
     path('decline/<int:lesson_id>/', views.decline_lesson, name='decline_lesson'), # New URL pattern for declining a lesson
+    path('lessons/bulk/<str:action>/', views.bulk_lessons, name='bulk_lessons'), # JSON: approve/decline/complete/mark_paid/delete many lessons at once
     path('reschedule/<int:lesson_id>/', views.reschedule_lesson, name='reschedule_lesson'), # New URL pattern for rescheduling a lesson
     path('accept-reschedule/<int:lesson_id>/', views.accept_reschedule, name='accept_reschedule'), # New URL pattern for accepting a reschedule
     path('pay/<int:lesson_id>/', views.initiate_payment, name='initiate_payment'), # New URL pattern for initiating payment
+    path('payments/<int:payment_id>/', views.payment_pending, name='payment_pending'), # "check your phone" page shown while the STK push is in flight
+    path('payments/<int:payment_id>/status/', views.payment_status, name='payment_status'), # JSON polled by the page above
     
     path('mpesa/callback/', views.mpesa_callback, name='mpesa_callback'), # New URL pattern for M-Pesa callback
     
@@ -51,6 +55,10 @@ urlpatterns = [
     
     path('admin-panel/users/', views.manage_users, name='manage_users'),
     path('admin-panel/delete-user/<int:user_id>/', views.delete_user, name='delete_user'),
+    path('admin-panel/cache/', views.cache_stats, name='cache_stats'), # JSON cache hit/miss counters
+    path('admin-panel/analytics/', views.analytics, name='analytics'), # revenue & utilisation from the rollup tables
+    path('admin-panel/export/<str:kind>/', views.export_data, name='export_data'), # streaming CSV/JSONL of lessons or transactions
+    path('metrics', views.metrics, name='metrics'), # staff-only per-view timings, Prometheus text format
 
 ]
 
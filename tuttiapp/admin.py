@@ -1,5 +1,5 @@
 from django.contrib import admin # Import the admin module used to register models in the admin interface
-from .models import User, Lesson, MpesaTransaction # Import the models we defined in models.py
+from .models import User, Lesson, LessonSeries, MpesaTransaction, MpesaCallback # Import the models we defined in models.py
 from django.contrib.auth.admin import UserAdmin # Import this! it provides a lot of functionality for managing users as admin
 
 # This makes the User model visible
@@ -17,4 +17,19 @@ class LessonAdmin(admin.ModelAdmin):
 # This makes the M-Pesa transactions visible
 @admin.register(MpesaTransaction) # Register the MpesaTransaction model with custom admin options
 class MpesaTransactionAdmin(admin.ModelAdmin):
-    list_display = ('lesson', 'amount', 'is_successful', 'mpesa_receipt_number') # Fields to display in the admin list view
\ No newline at end of file
+    list_display = ('lesson', 'amount', 'is_successful', 'mpesa_receipt_number') # Fields to display in the admin list view
+
+# The raw M-Pesa callback inbox (read-only: rows are written by Safaricom and applied by the worker)
+@admin.register(MpesaCallback)
+class MpesaCallbackAdmin(admin.ModelAdmin):
+    list_display = ('checkout_request_id', 'status', 'received_at', 'processed_at')
+    list_filter = ('status',)
+    search_fields = ('checkout_request_id',)
+    readonly_fields = ('checkout_request_id', 'raw_body', 'status', 'error', 'received_at', 'processed_at')
+
+# Recurring bookings (their lessons are created a few weeks ahead by materialize_lesson_series)
+@admin.register(LessonSeries)
+class LessonSeriesAdmin(admin.ModelAdmin):
+    list_display = ('topic', 'teacher', 'student', 'first_start', 'interval_weeks', 'occurrences', 'materialized_count', 'status')
+    list_filter = ('status', 'interval_weeks')
+    readonly_fields = ('materialized_count', 'next_start')
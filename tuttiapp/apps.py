@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class TuttiappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tuttiapp'
+
+    def ready(self):
+        from . import db, metrics, signals  # noqa: F401  (connects the receivers)
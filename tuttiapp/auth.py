@@ -0,0 +1,24 @@
+from django.contrib.auth.backends import ModelBackend
+
+from .cache import USER, aget_or_set, get_or_set
+from .models import User
+
+# AuthenticationMiddleware asks the backend for request.user on every request.
+# ModelBackend runs a SELECT for it each time; this one keeps the user in the cache under
+# the user's version stamp, which User.save() and deleting the user bump (tuttiapp/cache.py).
+# Password changes go through save() too, so the session hash check still sees the new password.
+# aget_user() is the same for `await request.auser()` in the async views.
+
+USER_CACHE_SECONDS = 60 * 15
+
+
+class CachedModelBackend(ModelBackend):
+    def get_user(self, user_id):
+        user = get_or_set(USER, user_id, 'auth', lambda: User._default_manager.filter(pk=user_id).first(),
+                          USER_CACHE_SECONDS)
+        return user if user is not None and self.user_can_authenticate(user) else None
+
+    async def aget_user(self, user_id):
+        user = await aget_or_set(USER, user_id, 'auth', lambda: User._default_manager.filter(pk=user_id).afirst(),
+                                 USER_CACHE_SECONDS)
+        return user if user is not None and self.user_can_authenticate(user) else None
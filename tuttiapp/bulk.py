@@ -0,0 +1,86 @@
+from django.db import transaction
+
+from .models import Lesson, LessonSeries, lesson_transitioned
+
+# Bulk teacher actions: one status change (or delete) over many lessons at once.
+# The same edges as Lesson.transition() (Lesson.TRANSITIONS), applied to a batch.
+#
+# Whatever the number of ids, an action costs the same handful of queries:
+#   1. lock the teacher's matching rows and read their current status,
+#   2. one UPDATE ... WHERE id IN (...) AND teacher = me AND status IN (<expected>)
+#      (or one DELETE), so a lesson that changed status in the meantime is left alone.
+# Ids that aren't the teacher's come back as "not_found", the same as ids that don't exist.
+# Approving a lesson of a requested LessonSeries accepts the series too (one more UPDATE), like
+# series.approve_series() does, so the lessons it materialises later are scheduled as well.
+#
+# queryset.update() skips post_save, so lesson_transitioned is sent for each changed lesson,
+# like Lesson.transition() does.
+
+MAX_BULK_IDS = 500
+
+UPDATED = 'updated'
+DELETED = 'deleted'
+NOT_FOUND = 'not_found'
+INVALID_STATUS = 'invalid_status'
+
+# action: (statuses it applies to, new status; None = delete the lessons)
+BULK_ACTIONS = {
+    'approve': (('REQUESTED',), 'SCHEDULED'),
+    'decline': (('REQUESTED',), None),
+    'complete': (Lesson.sources('PENDING_PAYMENT'), 'PENDING_PAYMENT'),
+    'mark_paid': (Lesson.sources('PAID'), 'PAID'),
+    'delete': (tuple(status for status, _ in Lesson.STATUS_CHOICES), None),
+}
+
+
+class BulkActionError(ValueError):
+    pass
+
+
+def apply_bulk_action(teacher, action, lesson_ids):
+    """
+    Applies `action` to the teacher's lessons among `lesson_ids`.
+    Returns {lesson_id: {'outcome': ..., 'status': <status now, None if deleted or not found>}}.
+    """
+    if action not in BULK_ACTIONS:
+        raise BulkActionError(f"Unknown action {action!r}")
+    try:
+        lesson_ids = sorted({int(lesson_id) for lesson_id in lesson_ids})
+    except (TypeError, ValueError):
+        raise BulkActionError("Lesson ids must be integers")
+    if not lesson_ids:
+        raise BulkActionError("No lesson ids given")
+    if len(lesson_ids) > MAX_BULK_IDS:
+        raise BulkActionError(f"At most {MAX_BULK_IDS} lessons at a time")
+
+    expected, new_status = BULK_ACTIONS[action]
+    results = {lesson_id: {'outcome': NOT_FOUND, 'status': None} for lesson_id in lesson_ids}
+
+    with transaction.atomic():
+        mine = Lesson.objects.filter(pk__in=lesson_ids, teacher=teacher)
+        rows = list(mine.select_for_update().values_list('pk', 'status', 'series_id'))
+        current = {pk: status for pk, status, _ in rows}
+        eligible = [pk for pk, status in current.items() if status in expected]
+        for pk, status in current.items():
+            results[pk] = {'outcome': INVALID_STATUS, 'status': status}
+
+        if eligible:
+            targets = mine.filter(pk__in=eligible, status__in=expected)
+            if new_status is None:
+                targets.delete()  # deletes still send the signals, which do the bookkeeping
+            elif targets.update(status=new_status, **Lesson.status_columns(new_status)) != len(eligible):
+                # Without row locks (SQLite) another request can get in between the read and the
+                # UPDATE: the guard left those lessons alone, so report what they are now.
+                changed = dict(mine.filter(pk__in=eligible).exclude(status=new_status).values_list('pk', 'status'))
+                eligible = [pk for pk in eligible if pk not in changed]
+                results.update({pk: {'outcome': INVALID_STATUS, 'status': status} for pk, status in changed.items()})
+            series_ids = {series_id for pk, _, series_id in rows if series_id and pk in eligible}
+            if action == 'approve' and series_ids:
+                LessonSeries.objects.filter(pk__in=series_ids, status=LessonSeries.REQUESTED).update(status=LessonSeries.ACTIVE)
+            if new_status is not None:
+                for pk in eligible:
+                    lesson_transitioned.send(sender=Lesson, lesson=Lesson(pk=pk, teacher_id=teacher.pk, status=new_status),
+                                             from_status=current[pk], to_status=new_status)
+            for pk in eligible:
+                results[pk] = {'outcome': DELETED if new_status is None else UPDATED, 'status': new_status}
+    return results
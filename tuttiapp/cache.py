@@ -0,0 +1,165 @@
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+# One place for everything the app keeps in the cache (the backend itself is chosen in settings.CACHES).
+#
+# Keys are namespaced per kind of object: "user:<id>:v<stamp>:<name>". Every object has a version
+# stamp in the cache, and saving or deleting the object bumps it (tuttiapp/signals.py), which
+# retires all of its entries at once without having to know their names; the old ones just expire.
+# Because the stamps live in the shared cache, a bump in one gunicorn worker is seen by all of them.
+# An entry should only depend on its own object's row: a user's entries (like the logged-in user
+# in tuttiapp/auth.py) are not retired when one of their lessons changes.
+#
+# Hits and misses are counted per namespace for the cache_stats page.
+# The async views (tuttiapp/views.py) use aget_or_set(), which is the same with an async loader.
+
+USER = 'user'
+LESSON = 'lesson'
+STATS = 'stats'
+PAYMENT = 'payment'
+NAMESPACES = (USER, LESSON, STATS, PAYMENT)
+
+DEFAULT_TIMEOUT = 60 * 5
+STAMP_TIMEOUT = 60 * 60 * 24
+STATS_FLUSH_EVERY = 100  # local hit/miss counts are added to the shared totals this often
+
+_MISSING = object()
+
+
+def make_key(namespace, *parts):
+    if namespace not in NAMESPACES:
+        raise ValueError(f"Unknown cache namespace {namespace!r}")
+    return ':'.join([namespace, *(str(part) for part in parts)])
+
+
+def _stamp_key(namespace, obj_id):
+    return make_key(namespace, obj_id, 'stamp')
+
+
+def get_stamp(namespace, obj_id):
+    key = _stamp_key(namespace, obj_id)
+    stamp = cache.get(key)
+    if stamp is None:
+        # Start from the clock rather than 1: if a stamp is evicted, restarting at 1 could
+        # bring back entries written under an old "1".
+        cache.add(key, time.time_ns(), STAMP_TIMEOUT)
+        stamp = cache.get(key)
+    return stamp
+
+
+def versioned_key(namespace, obj_id, name):
+    return make_key(namespace, obj_id, f'v{get_stamp(namespace, obj_id)}', name)
+
+
+def bump(namespace, obj_id):
+    key = _stamp_key(namespace, obj_id)
+    try:
+        cache.incr(key)
+    except ValueError:  # no stamp yet, so nothing cached under it either
+        cache.add(key, time.time_ns(), STAMP_TIMEOUT)
+
+
+def invalidate(namespace, obj_id):
+    """
+    Retires everything cached for this object: now, and again once the current transaction
+    commits, in case another request re-cached the old rows in between.
+    """
+    bump(namespace, obj_id)
+    transaction.on_commit(lambda: bump(namespace, obj_id))
+
+
+def get_or_set(namespace, obj_id, name, loader, timeout=DEFAULT_TIMEOUT):
+    """Returns the cached value, or calls loader() and caches what it returns (None is not cached)."""
+    key = versioned_key(namespace, obj_id, name)
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        _record(namespace, 'hits')
+        return value
+    _record(namespace, 'misses')
+    value = loader()
+    if value is not None:
+        cache.set(key, value, timeout)
+    return value
+
+
+async def aget_stamp(namespace, obj_id):
+    key = _stamp_key(namespace, obj_id)
+    stamp = await cache.aget(key)
+    if stamp is None:
+        await cache.aadd(key, time.time_ns(), STAMP_TIMEOUT)
+        stamp = await cache.aget(key)
+    return stamp
+
+
+async def aget_or_set(namespace, obj_id, name, aloader, timeout=DEFAULT_TIMEOUT):
+    """get_or_set() for async code: `aloader` is a coroutine function."""
+    key = make_key(namespace, obj_id, f'v{await aget_stamp(namespace, obj_id)}', name)
+    value = await cache.aget(key, _MISSING)
+    if value is not _MISSING:
+        _record(namespace, 'hits')
+        return value
+    _record(namespace, 'misses')
+    value = await aloader()
+    if value is not None:
+        await cache.aset(key, value, timeout)
+    return value
+
+
+# --- Hit/miss counters ---
+_counts = Counter()
+_counts_lock = threading.Lock()
+
+
+def _record(namespace, outcome):
+    with _counts_lock:
+        _counts[(namespace, outcome)] += 1
+        pending = sum(_counts.values())
+    if pending >= STATS_FLUSH_EVERY:
+        flush_stats()
+
+
+def flush_stats():
+    """Adds this process's counts to the totals in the shared cache."""
+    with _counts_lock:
+        counts = dict(_counts)
+        _counts.clear()
+    for (namespace, outcome), count in counts.items():
+        add_to(make_key(STATS, 'cache', namespace, outcome), count)
+
+
+def add_to(key, count, timeout=None):
+    """Adds `count` to a shared counter, creating it if needed (atomic on backends with an atomic incr)."""
+    if not cache.add(key, count, timeout):
+        try:
+            cache.incr(key, count)
+        except ValueError:  # expired between add() and incr()
+            cache.set(key, count, timeout)
+
+
+def cache_stats():
+    """{'backend': ..., 'namespaces': {namespace: {'hits', 'misses', 'hit_rate'}}} across all workers."""
+    flush_stats()
+    keys = {make_key(STATS, 'cache', ns, outcome): (ns, outcome)
+            for ns in NAMESPACES for outcome in ('hits', 'misses')}
+    totals = cache.get_many(list(keys))
+    namespaces = {}
+    for ns in NAMESPACES:
+        hits = totals.get(make_key(STATS, 'cache', ns, 'hits'), 0)
+        misses = totals.get(make_key(STATS, 'cache', ns, 'misses'), 0)
+        namespaces[ns] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+        }
+    return {'backend': settings.CACHES['default']['BACKEND'], 'namespaces': namespaces}
+
+
+def reset_stats():
+    with _counts_lock:
+        _counts.clear()
+    cache.delete_many([make_key(STATS, 'cache', ns, outcome) for ns in NAMESPACES for outcome in ('hits', 'misses')])
@@ -0,0 +1,118 @@
+import json
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import InvalidTransition, Lesson, MpesaCallback, MpesaTransaction
+from .stats import record_payment
+
+logger = logging.getLogger(__name__)
+
+# M-Pesa callback ingestion.
+# 1. ingest_callback() runs inside the request: one INSERT of the raw body, nothing else,
+#    so Safaricom gets its "Accepted" straight away even during a payment burst
+#    (aingest_callback() in the async view).
+# 2. process_pending() runs in the worker (manage.py process_mpesa_callbacks): it locks a batch
+#    of pending rows, applies each to its MpesaTransaction under select_for_update, and marks it done.
+#    A transaction with a result_code already set has been applied, so Safaricom's retries
+#    (and manual replays) are recorded as DUPLICATE and change nothing.
+
+DEFAULT_BATCH_SIZE = 100
+
+
+class CallbackError(Exception):
+    pass
+
+
+def _checkout_id(raw_body):
+    try:
+        return str(json.loads(raw_body)['Body']['stkCallback']['CheckoutRequestID'] or '')[:100]
+    except (ValueError, KeyError, TypeError):
+        return ''  # stored anyway; the worker marks it FAILED with the reason
+
+
+def ingest_callback(raw_body):
+    return MpesaCallback.objects.create(checkout_request_id=_checkout_id(raw_body), raw_body=raw_body)
+
+
+async def aingest_callback(raw_body):
+    """ingest_callback() for the async callback view."""
+    return await MpesaCallback.objects.acreate(checkout_request_id=_checkout_id(raw_body), raw_body=raw_body)
+
+
+def process_pending(batch_size=DEFAULT_BATCH_SIZE):
+    """Applies up to `batch_size` pending callbacks. Returns {status: count} for the batch."""
+    summary = {}
+    with transaction.atomic():
+        # skip_locked lets several workers share the inbox without waiting on each other (Postgres);
+        # SQLite has no row locks and simply serialises the writers.
+        batch = list(
+            MpesaCallback.objects.select_for_update(skip_locked=True)
+            .filter(status=MpesaCallback.PENDING)
+            .order_by('id')[:batch_size]
+        )
+        for callback in batch:
+            try:
+                with transaction.atomic():  # a bad callback only rolls back its own changes
+                    callback.status = apply_callback(callback)
+                    callback.error = ''
+            except CallbackError as e:
+                logger.warning("M-Pesa callback %s rejected: %s", callback.pk, e)
+                callback.status = MpesaCallback.FAILED
+                callback.error = str(e)
+            except Exception as e:
+                logger.exception("M-Pesa callback %s failed", callback.pk)
+                callback.status = MpesaCallback.FAILED
+                callback.error = str(e)
+            callback.processed_at = timezone.now()
+            summary[callback.status] = summary.get(callback.status, 0) + 1
+        MpesaCallback.objects.bulk_update(batch, ['status', 'error', 'processed_at'])
+    return summary
+
+
+def apply_callback(callback):
+    try:
+        stk_callback = json.loads(callback.raw_body)['Body']['stkCallback']
+    except (ValueError, KeyError, TypeError):
+        raise CallbackError("Malformed callback payload")
+
+    checkout_id = stk_callback.get('CheckoutRequestID')
+    try:
+        mpesa_transaction = MpesaTransaction.objects.select_for_update().get(checkout_request_id=checkout_id)
+    except MpesaTransaction.DoesNotExist:
+        raise CallbackError(f"Unknown CheckoutRequestID {checkout_id!r}")
+
+    # Idempotency: only the first callback for a checkout request is applied
+    if mpesa_transaction.result_code is not None or mpesa_transaction.is_successful:
+        return MpesaCallback.DUPLICATE
+
+    result_code = int(stk_callback.get('ResultCode', -1))
+    mpesa_transaction.result_code = result_code
+    mpesa_transaction.result_desc = (stk_callback.get('ResultDesc') or '')[:255]
+
+    if result_code == 0:
+        mpesa_transaction.is_successful = True
+        for item in stk_callback.get('CallbackMetadata', {}).get('Item', []):
+            if item.get('Name') == 'MpesaReceiptNumber':
+                mpesa_transaction.mpesa_receipt_number = item.get('Value')
+        mpesa_transaction.save(update_fields=['result_code', 'result_desc', 'is_successful', 'mpesa_receipt_number'])
+        record_payment(mpesa_transaction)  # add to the admin revenue totals
+        mark_lesson_paid(mpesa_transaction.lesson_id)
+    else:
+        # User cancelled or failed
+        mpesa_transaction.save(update_fields=['result_code', 'result_desc'])
+    # The saves above retire the cached payment status (tuttiapp/signals.py)
+    return MpesaCallback.PROCESSED
+
+
+def mark_lesson_paid(lesson_id):
+    # The money has arrived whatever the lesson's status was, so retry through concurrent changes
+    lesson = Lesson.objects.only('id', 'status', 'teacher_id').get(pk=lesson_id)
+    if lesson.status == 'PAID':
+        return
+    try:
+        lesson.transition('PAID', retry=True)
+    except InvalidTransition as e:
+        # e.g. still SCHEDULED: keep the payment, but leave the lesson for a person to sort out
+        logger.warning("Payment received but %s", e)
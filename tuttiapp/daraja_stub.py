@@ -0,0 +1,125 @@
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A tiny local stand-in for the Daraja API (OAuth, STK push and STK query), for tests and benchmarks.
+#
+#   with DarajaStub(latency=0.05) as stub:
+#       gateway = MpesaGateway(base_url=stub.url)
+#
+# `stub.calls` counts requests per endpoint, so tests can check how often a token was fetched.
+# STK queries answer from `stub.query_results` ({checkout_request_id: (result_code, result_desc)});
+# any other push is reported as still being processed.
+
+
+class DarajaStub:
+    def __init__(self, latency=0.0, token_ttl=3599, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.token_ttl = token_ttl
+        self.calls = {'token': 0, 'stk_push': 0}
+        self.pushes = []  # the STK push bodies received
+        self.query_results = {}
+        self._lock = threading.Lock()
+        self._tokens = set()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def revoke_tokens(self):
+        with self._lock:
+            self._tokens.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _count(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, so connection pooling is measurable
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if not self.path.startswith('/oauth/v1/generate'):
+                    return self._send(404, {'errorMessage': 'Not found'})
+                stub._count('token')
+                time.sleep(stub.latency)
+                token = uuid.uuid4().hex[:28]
+                with stub._lock:
+                    stub._tokens.add(token)
+                self._send(200, {'access_token': token, 'expires_in': str(stub.token_ttl)})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if self.path not in ('/mpesa/stkpush/v1/processrequest', '/mpesa/stkpushquery/v1/query'):
+                    return self._send(404, {'errorMessage': 'Not found'})
+                token = self.headers.get('Authorization', '').replace('Bearer ', '')
+                with stub._lock:
+                    valid = token in stub._tokens
+                if not valid:
+                    return self._send(401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'})
+                if self.path == '/mpesa/stkpushquery/v1/query':
+                    return self._query(body)
+                stub._count('stk_push')
+                with stub._lock:
+                    stub.pushes.append(body)
+                time.sleep(stub.latency)
+                self._send(200, {
+                    'MerchantRequestID': uuid.uuid4().hex[:20],
+                    'CheckoutRequestID': f"ws_CO_{uuid.uuid4().hex[:20]}",
+                    'ResponseCode': '0',
+                    'ResponseDescription': 'Success. Request accepted for processing',
+                    'CustomerMessage': 'Success. Request accepted for processing',
+                })
+
+            def _query(self, body):
+                stub._count('stk_query')
+                time.sleep(stub.latency)
+                checkout_id = body.get('CheckoutRequestID')
+                if checkout_id not in stub.query_results:
+                    return self._send(500, {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'})
+                result_code, result_desc = stub.query_results[checkout_id]
+                self._send(200, {
+                    'ResponseCode': '0',
+                    'ResponseDescription': 'The service request has been accepted successsfully',
+                    'MerchantRequestID': uuid.uuid4().hex[:20],
+                    'CheckoutRequestID': checkout_id,
+                    'ResultCode': result_code,
+                    'ResultDesc': result_desc,
+                })
+
+        return Handler
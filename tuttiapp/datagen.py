@@ -0,0 +1,139 @@
+import datetime
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.utils import timezone
+
+from .marketplace import refresh_teacher_card
+from .models import Lesson, MpesaTransaction, User
+from .rollups import refresh_rollups
+from .stats import rebuild_admin_stats
+
+# Synthetic data for benchmarks. Never point this at the production database:
+# run it against a scratch DATABASE_URL (e.g. sqlite:///bench.sqlite3).
+
+BENCH_PASSWORD = 'password123'
+TOPICS = ['Major Scales', 'Jazz Piano Basics', 'Sight Reading', 'Violin Bowing', 'Music Theory', 'Guitar Chords']
+
+
+def seed_users(count, role, prefix='bench', batch_size=5000):
+    """Creates `count` teachers or students in bulk (one password hash shared by all of them)."""
+    password = make_password(BENCH_PASSWORD)
+    start = User.objects.filter(username__startswith=f"{prefix}_{role}_").count()
+    users = (
+        User(
+            username=f"{prefix}_{role}_{i}",
+            email=f"{prefix}_{role}_{i}@example.com",
+            phone_number=f"2547{i % 100000000:08d}",
+            password=password,
+            is_teacher=(role == 'teacher'),
+            is_student=(role == 'student'),
+        )
+        for i in range(start, start + count)
+    )
+    _bulk_insert(User, users, batch_size)
+    return list(User.objects.filter(username__startswith=f"{prefix}_{role}_").values_list('id', flat=True))
+
+
+# A realistic status mix: past lessons were mostly taught and paid (some cancelled, a few still
+# waiting for the money); upcoming ones are mostly booked. Weights, not percentages.
+PAST_STATUS_MIX = {'PAID': 70, 'PENDING_PAYMENT': 8, 'COMPLETED': 4, 'CANCELLED': 15, 'SCHEDULED': 3}
+FUTURE_STATUS_MIX = {'SCHEDULED': 60, 'REQUESTED': 25, 'RESCHEDULE_PENDING': 5, 'CANCELLED': 10}
+DURATIONS = [30, 45, 60, 60, 60, 90]
+PRICES = [1000, 1500, 1500, 2000, 2500]
+
+
+def seed_lessons(count, teacher_ids, student_ids, batch_size=5000, spread_days=730, seed=42):
+    """
+    Spreads `count` lessons over `spread_days` either side of today with the status mix above,
+    inserted in batches so memory stays flat for millions of rows.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    spread = spread_days * 24 * 60  # minutes
+    past = (list(PAST_STATUS_MIX), list(PAST_STATUS_MIX.values()))
+    future = (list(FUTURE_STATUS_MIX), list(FUTURE_STATUS_MIX.values()))
+
+    def lesson():
+        start = now + datetime.timedelta(minutes=rng.randint(-spread, spread))
+        statuses, weights = past if start < now else future
+        status = rng.choices(statuses, weights)[0]
+        duration = rng.choice(DURATIONS)
+        completed_at = paid_at = None
+        if status in Lesson.TAUGHT_STATUSES:
+            completed_at = start + datetime.timedelta(minutes=duration)
+        if status == 'PAID':
+            paid_at = completed_at + datetime.timedelta(minutes=rng.randint(5, 3 * 24 * 60))
+        return Lesson(
+            teacher_id=rng.choice(teacher_ids),
+            student_id=rng.choice(student_ids),
+            start_time=start,
+            duration_minutes=duration,
+            price=rng.choice(PRICES),
+            topic=rng.choice(TOPICS),
+            status=status,
+            completed_at=completed_at,
+            paid_at=paid_at,
+            is_student_reminder_sent=start < now or rng.random() < 0.5,
+        )
+
+    _bulk_insert(Lesson, (lesson() for _ in range(count)), batch_size)
+
+
+def seed_transactions(batch_size=5000, seed=42):
+    """
+    Gives every PAID lesson its successful M-Pesa transaction, and some PENDING_PAYMENT lessons one
+    that is still waiting for the PIN, failed or was rejected. Lessons that already have one are skipped.
+    Returns how many were created.
+    """
+    lessons = (
+        Lesson.objects.filter(status__in=('PAID', 'PENDING_PAYMENT'), transaction__isnull=True)
+        .order_by('pk').values_list('pk', 'status', 'price')
+    )
+    created = last_pk = 0
+    while True:
+        rows = list(lessons.filter(pk__gt=last_pk)[:batch_size])
+        if not rows:
+            return created
+        last_pk = rows[-1][0]
+        batch = []
+        for pk, status, price in rows:
+            rng = random.Random(seed * 1_000_003 + pk)  # per lesson, so a second run adds nothing new
+            fields = {'lesson_id': pk, 'amount': price, 'phone_number': f"2547{rng.randrange(10 ** 8):08d}",
+                      'checkout_request_id': f"ws_CO_bench_{pk}"}
+            if status == 'PAID':
+                fields.update(is_successful=True, result_code=0, result_desc='The service request is processed successfully.',
+                              mpesa_receipt_number=f"BN{pk:08d}")
+            else:
+                outcome = rng.random()
+                if outcome < 0.6:
+                    continue  # the student hasn't tried to pay yet
+                if outcome < 0.8:
+                    pass  # waiting for the PIN / the callback
+                elif outcome < 0.9:
+                    fields.update(result_code=1032, result_desc='Request cancelled by user')
+                else:
+                    fields.update(push_status=MpesaTransaction.PUSH_REJECTED, checkout_request_id=None,
+                                  push_error='M-Pesa Error: Invalid PhoneNumber')
+            batch.append(MpesaTransaction(**fields))
+        MpesaTransaction.objects.bulk_create(batch)
+        created += len(batch)
+
+
+def rebuild_derived():
+    """Brings the tables kept up to date by signals (which bulk_create skips) in line with the data."""
+    rebuild_admin_stats()
+    for teacher_id in User.objects.filter(is_teacher=True).values_list('pk', flat=True).iterator():
+        refresh_teacher_card(teacher_id)
+    refresh_rollups(full=True)
+
+
+def _bulk_insert(model, rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            model.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        model.objects.bulk_create(batch)
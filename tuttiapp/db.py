@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Per-connection database setup (see "Engine-specific tuning" in tutti/settings.py).
+# SQLite keeps most pragmas per connection, so they are set every time Django opens one.
+# journal_mode is the exception: WAL is stored in the database file once set, and an in-memory
+# database (the test runner's) can't use it, so it is skipped there.
+# Postgres needs nothing here: its pooling and health checks are plain DATABASES settings.
+
+# What SQLite does when nothing is set, for comparing against (manage.py bench_writes)
+SQLITE_DEFAULT_PRAGMAS = {'journal_mode': 'DELETE', 'synchronous': 'FULL'}
+
+
+def sqlite_pragmas(connection):
+    """The pragmas as the connection sees them: {name: value} (None where SQLite has none, e.g. mmap_size in memory)."""
+    values = {}
+    with connection.cursor() as cursor:
+        for name in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size'):
+            row = cursor.execute(f'PRAGMA {name}').fetchone()
+            values[name] = row[0] if row else None
+    return values
+
+
+def apply_sqlite_pragmas(connection, pragmas):
+    in_memory = connection.is_in_memory_db()
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            if name == 'journal_mode' and in_memory:
+                continue
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite' and settings.SQLITE_PRAGMAS:
+        apply_sqlite_pragmas(connection, settings.SQLITE_PRAGMAS)
@@ -0,0 +1,117 @@
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Lesson, LessonSeries, MpesaTransaction, User
+
+logger = logging.getLogger(__name__)
+
+# Deleting users (manage_users).
+# user.delete() makes Django's collector load every lesson the user taught or took, and their
+# payments, and delete them row by row with signals: for a teacher with years of lessons that
+# outlasts the request. So delete_user() first counts what would go with them, stopping at the
+# limit so the count itself stays cheap:
+#   - up to USER_DELETE_INLINE_LIMIT related rows: deleted right away, as before;
+#   - more: one save disables the account and drops its roles (so they can't log in and leave the
+#     marketplace and the admin counters at once) and sets deletion_requested_at.
+#     `manage.py purge_deleted_users` then deletes their unpaid lessons PURGE_BATCH at a time.
+# Paid lessons and their M-Pesa transactions are financial records and are kept: a user who has
+# any is anonymised ("deleted-<id>") by the purge instead of deleted. That holds for small users
+# too: theirs is purged right away instead of with user.delete().
+
+INLINE = 'inline'
+SCHEDULED = 'scheduled'
+PURGE_BATCH = 500
+
+
+def related_lessons(user_id):
+    return Lesson.objects.filter(Q(teacher_id=user_id) | Q(student_id=user_id))
+
+
+def cascade_size(user, limit):
+    """How many rows deleting `user` would take with it, counting no further than limit + 1."""
+    related = (
+        related_lessons(user.pk),
+        MpesaTransaction.objects.filter(Q(lesson__teacher_id=user.pk) | Q(lesson__student_id=user.pk)),
+        LessonSeries.objects.filter(Q(teacher_id=user.pk) | Q(student_id=user.pk)),
+    )
+    size = 0
+    for queryset in related:
+        size += queryset.values('pk')[:limit + 1 - size].count()
+        if size > limit:
+            break
+    return size
+
+
+def has_paid_lessons(user_id):
+    return related_lessons(user_id).filter(Q(status='PAID') | Q(transaction__is_successful=True)).exists()
+
+
+def delete_user(user):
+    """Deletes `user` now if that's cheap, otherwise disables them for the purge. Returns INLINE or SCHEDULED."""
+    limit = settings.USER_DELETE_INLINE_LIMIT
+    if user.deletion_requested_at is None and cascade_size(user, limit) <= limit:
+        if has_paid_lessons(user.pk):
+            with transaction.atomic():
+                _disable(user)
+                purge_user(user)
+        else:
+            user.delete()
+        return INLINE
+    if user.deletion_requested_at is None:
+        _disable(user)
+    return SCHEDULED
+
+
+def _disable(user):
+    user.is_active = False
+    user.is_student = user.is_teacher = False  # the signals take them off the counters and the marketplace
+    user.deletion_requested_at = timezone.now()
+    user.save(update_fields=['is_active', 'is_student', 'is_teacher', 'deletion_requested_at'])
+
+
+# --- The background purge ---
+def purge_user(user, batch_size=PURGE_BATCH):
+    """Clears out one user whose deletion was requested. Returns how many lessons were deleted."""
+    unpaid = related_lessons(user.pk).exclude(status='PAID').exclude(transaction__is_successful=True)
+    deleted = 0
+    while True:
+        # One short transaction per batch; an interrupted purge carries on where it stopped
+        lesson_ids = list(unpaid.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not lesson_ids:
+            break
+        with transaction.atomic():
+            Lesson.objects.filter(pk__in=lesson_ids).delete()
+        deleted += len(lesson_ids)
+
+    user_id = user.pk
+    with transaction.atomic():
+        LessonSeries.objects.filter(Q(teacher_id=user_id) | Q(student_id=user_id)).delete()
+        if related_lessons(user_id).exists():
+            _anonymise(user)
+        else:
+            user.delete()
+    logger.info("Purged user %s: %s lessons deleted", user_id, deleted)
+    return deleted
+
+
+def _anonymise(user):
+    user.username = f'deleted-{user.pk}'
+    user.first_name = user.last_name = user.email = ''
+    user.phone_number = None
+    user.set_unusable_password()
+    user.deletion_requested_at = None  # done: the row stays only for the paid lessons
+    user.save(update_fields=['username', 'first_name', 'last_name', 'email', 'phone_number', 'password',
+                             'deletion_requested_at'])
+
+
+def purge_deleted_users(batch_size=PURGE_BATCH):
+    """Purges every user waiting for deletion. Returns (users purged, lessons deleted)."""
+    queue = list(User.objects.filter(deletion_requested_at__isnull=False).order_by('deletion_requested_at'))
+    lessons = 0
+    for user in queue:
+        lessons += purge_user(user, batch_size)
+    return len(queue), lessons
@@ -0,0 +1,175 @@
+import csv
+import datetime
+import json
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import Lesson, MpesaTransaction
+
+# Full exports of lessons and payments for finance (admin-panel/export/<kind>/ and `manage.py export_data`).
+# Rows are read with .values_list(...).iterator(chunk_size=CHUNK_SIZE) and turned into text one at a
+# time, so memory stays flat however many rows there are and the first bytes go out straight away.
+# Rows come out in id order, which is the cheapest order to stream and stable between runs.
+# Under ASGI the view streams astream() instead: Django would read a sync iterator like stream()'s
+# all the way into a list (in a thread) before sending the first byte.
+
+CHUNK_SIZE = 2000
+FORMATS = ('csv', 'jsonl')
+# A CSV cell starting with one of these is run as a formula by spreadsheet apps, and topics and
+# usernames are typed in by users: such cells get a leading ' so they open as plain text.
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+LESSON_COLUMNS = (
+    'id', 'start_time', 'end_time', 'duration_minutes', 'status', 'topic', 'price',
+    'teacher_id', 'teacher__username', 'student_id', 'student__username', 'series_id',
+)
+TRANSACTION_COLUMNS = (
+    'id', 'transaction_date', 'lesson_id', 'lesson__teacher_id', 'lesson__teacher__username',
+    'lesson__student__username', 'phone_number', 'amount', 'is_successful', 'mpesa_receipt_number',
+    'push_status', 'result_code', 'result_desc',
+)
+
+# Same four states as MpesaTransaction.payment_state, as filters
+PAYMENT_STATES = {
+    'paid': Q(is_successful=True),
+    'failed': Q(is_successful=False) & (Q(push_status=MpesaTransaction.PUSH_REJECTED) | Q(result_code__isnull=False)),
+    'queued': Q(is_successful=False, push_status=MpesaTransaction.PUSH_QUEUED, result_code__isnull=True),
+    'waiting_for_pin': Q(is_successful=False, push_status=MpesaTransaction.PUSH_SENT, result_code__isnull=True),
+}
+
+# kind: (model, columns, date column, teacher column, status choices)
+EXPORTS = {
+    'lessons': (Lesson, LESSON_COLUMNS, 'start_time', 'teacher_id', tuple(s for s, _ in Lesson.STATUS_CHOICES)),
+    'transactions': (MpesaTransaction, TRANSACTION_COLUMNS, 'transaction_date', 'lesson__teacher_id', tuple(PAYMENT_STATES)),
+}
+
+
+class ExportError(ValueError):
+    pass
+
+
+def parse_filters(date_from=None, date_to=None, teacher=None, status=None):
+    """Checks the raw filter values (e.g. from GET). Dates are YYYY-MM-DD and both ends are included."""
+    filters = {}
+    for name, value in (('date_from', date_from), ('date_to', date_to)):
+        if value:
+            day = parse_date(value) if isinstance(value, str) else value
+            if day is None:
+                raise ExportError(f"{name} must be a date like 2026-01-31")
+            filters[name] = day
+    if teacher:
+        try:
+            filters['teacher'] = int(teacher)
+        except (TypeError, ValueError):
+            raise ExportError("teacher must be a user id")
+    if status:
+        filters['status'] = status
+    return filters
+
+
+def export_queryset(kind, date_from=None, date_to=None, teacher=None, status=None):
+    if kind not in EXPORTS:
+        raise ExportError(f"Unknown export {kind!r}, use one of: {', '.join(EXPORTS)}")
+    model, columns, date_column, teacher_column, statuses = EXPORTS[kind]
+    queryset = model.objects.all()
+
+    tz = timezone.get_current_timezone()
+    if date_from:
+        start = datetime.datetime.combine(date_from, datetime.time.min, tzinfo=tz)
+        queryset = queryset.filter(**{f'{date_column}__gte': start})
+    if date_to:
+        end = datetime.datetime.combine(date_to + datetime.timedelta(days=1), datetime.time.min, tzinfo=tz)
+        queryset = queryset.filter(**{f'{date_column}__lt': end})
+    if teacher:
+        queryset = queryset.filter(**{teacher_column: teacher})
+    if status:
+        if status not in statuses:
+            raise ExportError(f"status must be one of: {', '.join(statuses)}")
+        queryset = queryset.filter(PAYMENT_STATES[status]) if kind == 'transactions' else queryset.filter(status=status)
+    return queryset.order_by('pk').values_list(*columns)
+
+
+def headers(kind):
+    return [column.replace('__', '_') for column in EXPORTS[kind][1]]
+
+
+class _Echo:
+    """csv.writer target that hands back each line instead of buffering it."""
+    def write(self, value):
+        return value
+
+
+def _text(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _check_format(fmt):
+    if fmt not in FORMATS:
+        raise ExportError(f"format must be one of: {', '.join(FORMATS)}")
+
+
+def stream(kind, fmt='csv', **filters):
+    """Yields the export as lines of text. Errors in the filters are raised before the first line."""
+    _check_format(fmt)
+    rows = export_queryset(kind, **filters).iterator(chunk_size=CHUNK_SIZE)
+    return _csv_lines(kind, rows) if fmt == 'csv' else _jsonl_lines(kind, rows)
+
+
+def astream(kind, fmt='csv', **filters):
+    """stream() as an async iterator, for ASGI. Errors in the filters are still raised straight away."""
+    _check_format(fmt)
+    return _alines(kind, fmt, _arows(export_queryset(kind, **filters)))
+
+
+async def _arows(queryset):
+    # Not queryset.aiterator(): on a values_list() it runs the query in the async context and fails.
+    # This is what aiterator() does otherwise, a chunk at a time from the sync iterator in a thread.
+    rows = queryset.iterator(chunk_size=CHUNK_SIZE)
+    while chunk := await sync_to_async(lambda: list(islice(rows, CHUNK_SIZE)))():
+        for row in chunk:
+            yield row
+
+
+def _csv_lines(kind, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(headers(kind))
+    for row in rows:
+        yield writer.writerow(_csv_row(row))
+
+
+def _jsonl_lines(kind, rows):
+    names = headers(kind)
+    for row in rows:
+        yield _jsonl_line(names, row)
+
+
+async def _alines(kind, fmt, rows):
+    if fmt == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(headers(kind))
+        async for row in rows:
+            yield writer.writerow(_csv_row(row))
+    else:
+        names = headers(kind)
+        async for row in rows:
+            yield _jsonl_line(names, row)
+
+
+def _csv_row(row):
+    return [_csv_cell(_text(value)) for value in row]
+
+
+def _csv_cell(value):
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _jsonl_line(names, row):
+    return json.dumps(dict(zip(names, (_text(value) for value in row))), default=str) + '\n'
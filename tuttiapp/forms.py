@@ -1,14 +1,50 @@
 from django import forms
-from .models import Lesson
+from .models import Lesson, LessonSeries
 from django.core.validators import RegexValidator
 from django.contrib.auth.forms import UserCreationForm
 from .models import User
+from .scheduling import is_slot_free, next_free_slots # double-booking checks
+from django.utils import timezone
 
 
 #i created this form to handle lesson requests by students
 #it uses django's ModelForm to automatically generate form fields based on the Lesson model
 
-class LessonRequestForm(forms.ModelForm):
+class TeacherAvailabilityMixin:
+    """Rejects a start_time that clashes with another of the teacher's lessons (see scheduling.py)."""
+    def check_availability(self, teacher, exclude=None):
+        start_time = self.cleaned_data.get('start_time')
+        if teacher is None or start_time is None:
+            return
+        duration = getattr(self.instance, 'duration_minutes', None) or 60
+        if not is_slot_free(teacher, start_time, duration, exclude=exclude):
+            slots = next_free_slots(teacher, start_time, duration, exclude=exclude)
+            suggestions = ", ".join(timezone.localtime(slot).strftime("%b %d, %H:%M") for slot in slots)
+            self.add_error('start_time', f"{teacher.username} is already booked at that time. Next free slots: {suggestions}")
+
+
+class LessonRequestForm(TeacherAvailabilityMixin, forms.ModelForm):
+    # Optional: book the same slot every week / two weeks (creates a LessonSeries, see tuttiapp/series.py)
+    repeat = forms.TypedChoiceField(
+        choices=[(0, 'Just once')] + LessonSeries.INTERVAL_CHOICES, coerce=int, initial=0, required=False,
+        widget=forms.Select(attrs={'class': 'form-select'}),
+    )
+    repeat_count = forms.IntegerField(
+        min_value=2, max_value=LessonSeries.MAX_OCCURRENCES, initial=10, required=False,
+        widget=forms.NumberInput(attrs={'class': 'form-control'}),
+    )
+
+    def __init__(self, *args, teacher=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.teacher = teacher
+
+    def clean(self):
+        cleaned_data = super().clean()
+        self.check_availability(self.teacher)
+        if cleaned_data.get('repeat') and not cleaned_data.get('repeat_count'):
+            self.add_error('repeat_count', "How many lessons should the series have?")
+        return cleaned_data
+
     class Meta:
         model = Lesson
         fields = ['topic', 'start_time']
@@ -24,7 +60,13 @@ class LessonRequestForm(forms.ModelForm):
         '''
         
         
-class LessonRescheduleForm(forms.ModelForm): # Form for rescheduling lessons. Used by teachers. 
+class LessonRescheduleForm(TeacherAvailabilityMixin, forms.ModelForm): # Form for rescheduling lessons. Used by teachers. 
+    def clean(self):
+        cleaned_data = super().clean()
+        # the lesson being moved doesn't clash with itself
+        self.check_availability(self.instance.teacher, exclude=self.instance)
+        return cleaned_data
+
     class Meta:
         model = Lesson
         fields = ['start_time', 'topic']
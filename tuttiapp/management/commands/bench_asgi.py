@@ -0,0 +1,164 @@
+import asyncio
+import datetime
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from django.utils import timezone
+
+from tuttiapp.models import Lesson, MpesaCallback, MpesaTransaction, User
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+PREFIX = 'asgibench'
+CHECKOUT_ID = f'ws_CO_{PREFIX}'
+SERVERS = ('wsgi', 'asgi')
+ENDPOINTS = ('payment_status', 'mpesa_callback', 'dashboard')
+
+
+class Command(BaseCommand):
+    help = (
+        "Concurrent-connection capacity of the async endpoints (payment status polling, the M-Pesa "
+        "callback, the dashboard) under WSGI (gunicorn sync workers) and ASGI (uvicorn), one after the "
+        "other, on the same database. Each run keeps N connections busy for a few seconds and reports "
+        "throughput, latency and failures. Needs httpx, gunicorn and uvicorn; use a scratch database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, action='append', default=[], help="Open connections (repeatable; default 10, 100, 500)")
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument('--workers', type=int, default=2, help="Server processes, for both servers")
+        parser.add_argument('--threads', type=int, default=1, help="Threads per gunicorn worker")
+        parser.add_argument('--server', choices=SERVERS, action='append', default=[])
+        parser.add_argument('--endpoint', choices=ENDPOINTS, action='append', default=[])
+        parser.add_argument('--timeout', type=float, default=10, help="Seconds before a request counts as failed")
+        parser.add_argument('--port', type=int, default=8765)
+
+    def handle(self, *args, **options):
+        if httpx is None:
+            raise CommandError("The load generator needs httpx (pip install httpx)")
+        concurrency = options['concurrency'] or [10, 100, 500]
+        endpoints = options['endpoint'] or list(ENDPOINTS)
+        requests = self.prepare()
+        try:
+            for server in options['server'] or SERVERS:
+                process = self.start(server, options)
+                try:
+                    for endpoint in endpoints:
+                        for connections in concurrency:
+                            result = asyncio.run(self.load(options['port'], requests[endpoint], connections, options))
+                            self.report(server, endpoint, connections, result)
+                finally:
+                    process.terminate()
+                    process.wait(timeout=30)
+        finally:
+            self.cleanup()
+
+    # --- The requests ---
+    def prepare(self):
+        teacher, _ = User.objects.get_or_create(username=f'{PREFIX}_teacher', defaults={'is_teacher': True})
+        student, _ = User.objects.get_or_create(username=f'{PREFIX}_student', defaults={'is_student': True})
+        lesson = Lesson.objects.create(teacher=teacher, student=student, topic="ASGI benchmark", status='PENDING_PAYMENT',
+                                       start_time=timezone.now() - datetime.timedelta(days=1))
+        payment = MpesaTransaction.objects.create(lesson=lesson, amount=1500, phone_number='254700000000',
+                                                  checkout_request_id=CHECKOUT_ID)
+
+        # A logged-in session for the student, stored in the database so every worker finds it
+        session = SessionStore()
+        session[SESSION_KEY] = str(student.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = student.get_session_auth_hash()
+        session.create()
+        self.session_key = session.session_key
+        cookies = {settings.SESSION_COOKIE_NAME: session.session_key}
+
+        callback = json.dumps({'Body': {'stkCallback': {
+            'MerchantRequestID': PREFIX, 'CheckoutRequestID': CHECKOUT_ID, 'ResultCode': 1032,
+            'ResultDesc': 'Request cancelled by user',
+        }}})
+        return {
+            'payment_status': ('GET', reverse('payment_status', args=[payment.pk]), {'cookies': cookies}),
+            'mpesa_callback': ('POST', reverse('mpesa_callback'),
+                               {'content': callback, 'headers': {'Content-Type': 'application/json'}}),
+            'dashboard': ('GET', reverse('dashboard'), {'cookies': cookies}),
+        }
+
+    def cleanup(self):
+        MpesaCallback.objects.filter(checkout_request_id=CHECKOUT_ID).delete()
+        User.objects.filter(username__startswith=f'{PREFIX}_').delete()  # with the lesson and the payment
+        SessionStore().delete(self.session_key)
+
+    # --- Servers ---
+    def start(self, server, options):
+        bind = f"127.0.0.1:{options['port']}"
+        if server == 'wsgi':
+            command = [sys.executable, '-m', 'gunicorn', 'tutti.wsgi:application', '--bind', bind,
+                       '--workers', str(options['workers']), '--threads', str(options['threads']), '--log-level', 'warning']
+        else:
+            command = [sys.executable, '-m', 'uvicorn', 'tutti.asgi:application', '--host', '127.0.0.1',
+                       '--port', str(options['port']), '--workers', str(options['workers']),
+                       '--log-level', 'warning', '--no-access-log']
+        process = subprocess.Popen(command, cwd=settings.BASE_DIR, env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'tutti.settings'})
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f"{server} server exited ({' '.join(command)}); is it installed?")
+            try:
+                socket.create_connection(('127.0.0.1', options['port']), timeout=1).close()
+                time.sleep(1)  # let every worker finish booting
+                self.stdout.write(f"{server}: {' '.join(command[2:])}")
+                return process
+            except OSError:
+                time.sleep(0.2)
+        process.terminate()
+        raise CommandError(f"{server} server didn't start listening on {bind}")
+
+    # --- Load ---
+    async def load(self, port, request, connections, options):
+        method, path, kwargs = request
+        limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+        latencies, errors = [], {}
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=options['timeout']) as client:
+            deadline = time.monotonic() + options['seconds']
+
+            async def connection():
+                while time.monotonic() < deadline:
+                    started = time.perf_counter()
+                    try:
+                        response = await client.request(method, path, **kwargs)
+                        if response.status_code != 200:
+                            raise ValueError(f"HTTP {response.status_code}")
+                        latencies.append(time.perf_counter() - started)
+                    except (httpx.HTTPError, ValueError) as e:
+                        kind = str(e) if isinstance(e, ValueError) else type(e).__name__
+                        errors[kind] = errors.get(kind, 0) + 1
+
+            started = time.monotonic()
+            await asyncio.gather(*(connection() for _ in range(connections)))
+            elapsed = time.monotonic() - started
+        return {'latencies': sorted(latencies), 'errors': errors, 'elapsed': elapsed}
+
+    def report(self, server, endpoint, connections, result):
+        latencies, errors = result['latencies'], result['errors']
+
+        def pct(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else float('nan')
+
+        failed = sum(errors.values())
+        style = self.style.SUCCESS if not failed else self.style.WARNING
+        self.stdout.write(style(
+            f"{server:<5} {endpoint:<15} {connections:>5} conns  {len(latencies) / result['elapsed']:8.1f} req/s  "
+            f"p50 {pct(0.5):8.1f} ms  p99 {pct(0.99):8.1f} ms  failed {failed}"
+            + (f" {errors}" if errors else "")
+        ))
@@ -0,0 +1,89 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from tuttiapp.datagen import seed_lessons, seed_users
+from tuttiapp.models import Lesson
+
+
+class RollbackIndexes(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds a large Lesson table and prints the query plan and timing of every hot "
+        "access path with the Lesson indexes in place, then with them dropped. "
+        "Run against a scratch database: DATABASE_URL=sqlite:///bench.sqlite3"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lessons', type=int, default=1_000_000, help="Target size of the Lesson table")
+        parser.add_argument('--teachers', type=int, default=500)
+        parser.add_argument('--students', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=20, help="Timed runs per query")
+
+    def handle(self, *args, **options):
+        self.seed(options)
+
+        teacher_id, student_id = Lesson.objects.values_list('teacher_id', 'student_id').first()
+        now = timezone.now()
+        access_paths = {
+            'dashboard (teacher)': Lesson.objects.feed().for_teacher(teacher_id).upcoming(now).order_by('start_time', 'id')[:26],
+            'dashboard (student)': Lesson.objects.feed().for_student(student_id).history(now).order_by('-start_time', '-id')[:26],
+            'teacher by status': Lesson.objects.filter(teacher_id=teacher_id, status='REQUESTED').order_by('start_time')[:50],
+            'admin status filter': Lesson.objects.filter(status='PENDING_PAYMENT').order_by('-start_time')[:100],
+            'reminder sweep': Lesson.objects.filter(
+                status='SCHEDULED', is_student_reminder_sent=False,
+                start_time__gte=now, start_time__lt=now + datetime.timedelta(hours=24),
+            ).order_by('start_time')[:1000],
+        }
+
+        self.stdout.write(self.style.MIGRATE_HEADING("With indexes"))
+        self.report(access_paths, options['repeat'], 'indexed')
+
+        # Drop the indexes inside a transaction and roll it back afterwards, so the
+        # comparison runs against the exact same data. (SQLite and Postgres both have transactional DDL.)
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                for index in Lesson._meta.indexes:
+                    cursor.execute(f"DROP INDEX {connection.ops.quote_name(index.name)}")
+                self.stdout.write(self.style.MIGRATE_HEADING("Without indexes"))
+                self.report(access_paths, options['repeat'], 'unindexed')
+                raise RollbackIndexes
+        except RollbackIndexes:
+            pass
+
+    def seed(self, options):
+        missing = options['lessons'] - Lesson.objects.count()
+        if missing <= 0:
+            return
+        self.stdout.write(f"Seeding {missing} lessons...")
+        teacher_ids = seed_users(options['teachers'], 'teacher')
+        student_ids = seed_users(options['students'], 'student')
+        seed_lessons(missing, teacher_ids, student_ids)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def report(self, access_paths, repeat, phase):
+        for name, queryset in access_paths.items():
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                list(queryset.all())
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            self.stdout.write(self.style.SUCCESS(f"{name}: median {timings[len(timings) // 2]:.2f} ms"))
+            self.stdout.write(self.explain(queryset, phase))
+
+    def explain(self, queryset, phase):
+        # QuerySet.explain() would reuse sqlite3's cached EXPLAIN statement (and its stale plan)
+        # after the DROP INDEX, so the SQL is tagged with the phase to force a fresh plan.
+        sql, params = queryset.query.sql_with_params()
+        prefix = connection.ops.explain_query_prefix()
+        with connection.cursor() as cursor:
+            cursor.execute(f"{prefix} {sql} -- {phase}", params)
+            return "\n".join(" ".join(str(col) for col in row) for row in cursor.fetchall())
@@ -0,0 +1,60 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from tuttiapp.models import User
+
+BENCH_USERNAME = 'bench_session_user'
+
+
+class Command(BaseCommand):
+    help = (
+        "Counts the queries per logged-in request with database sessions + ModelBackend (Django's defaults) "
+        "versus the configured SESSION_BACKEND and the cached user backend. "
+        "Run against a scratch database: DATABASE_URL=sqlite:///bench.sqlite3"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Requests per mode")
+        parser.add_argument('--path', default='/teachers/', help="Page to request (any login_required page)")
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=BENCH_USERNAME).first()
+        if user is None:
+            user = User.objects.create_user(username=BENCH_USERNAME, password='password', is_student=True)
+
+        modes = (
+            ("db sessions + ModelBackend", {
+                'SESSION_ENGINE': 'django.contrib.sessions.backends.db',
+                'AUTHENTICATION_BACKENDS': ['django.contrib.auth.backends.ModelBackend'],
+            }),
+            (f"{settings.SESSION_BACKEND} sessions + cached user", {}),
+        )
+        for label, overrides in modes:
+            with override_settings(**overrides):
+                client = Client()
+                client.force_login(user)
+                client.get(options['path'])  # warm the caches
+
+                timings = []
+                with CaptureQueriesContext(connection) as queries:
+                    for _ in range(options['requests']):
+                        started = time.perf_counter()
+                        response = client.get(options['path'])
+                        timings.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 200:
+                    self.stderr.write(self.style.ERROR(f"{options['path']} answered {response.status_code}"))
+                    return
+
+            timings.sort()
+            per_request = len(queries) / options['requests']
+            auth_queries = sum(1 for q in queries if 'django_session' in q['sql'] or 'FROM "tuttiapp_user"' in q['sql'])
+            self.stdout.write(
+                f"{label:<36} {per_request:5.2f} queries/request "
+                f"({auth_queries / options['requests']:.2f} session/user)  "
+                f"p50 {timings[len(timings) // 2]:6.2f} ms"
+            )
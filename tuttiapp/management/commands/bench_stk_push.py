@@ -0,0 +1,55 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from tuttiapp.daraja_stub import DarajaStub
+from tuttiapp.mpesa import MpesaGateway
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures STK pushes per second through the M-Pesa gateway against a local Daraja stub, "
+        "comparing a shared gateway (pooled session + cached token) with a fresh client per push."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pushes', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--latency', type=float, default=0.02, help="Simulated Daraja latency per request, in seconds")
+        parser.add_argument('--base-url', default='', help="Use this Daraja-compatible server instead of starting the stub")
+
+    def handle(self, *args, **options):
+        stub = None
+        base_url = options['base_url']
+        if not base_url:
+            stub = DarajaStub(latency=options['latency']).start()
+            base_url = stub.url
+        try:
+            shared = MpesaGateway(base_url=base_url, pool_size=options['concurrency'])
+            self.run('shared gateway', lambda: shared, options)
+            self.stdout.write(f"  metrics: {shared.metrics()}")
+            self.run('fresh client per push', lambda: MpesaGateway(base_url=base_url), options)
+            if stub:
+                self.stdout.write(f"stub calls: {stub.calls}")
+        finally:
+            if stub:
+                stub.stop()
+
+    def run(self, label, gateway_factory, options):
+        def push(i):
+            gateway = gateway_factory()
+            started = time.perf_counter()
+            response = gateway.stk_push('0712345678', 1, f"Bench-{i}", "Benchmark", 'https://example.com/callback/')
+            assert response.response_code == '0', response.response_description
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            latencies = sorted(pool.map(push, range(options['pushes'])))
+        elapsed = time.perf_counter() - started
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[int(len(latencies) * 0.95)] * 1000
+        self.stdout.write(self.style.SUCCESS(
+            f"{label:<22} {options['pushes'] / elapsed:8.1f} pushes/s  p50 {p50:6.1f} ms  p95 {p95:6.1f} ms"
+        ))
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tuttiapp.datagen import seed_users
+from tuttiapp.models import User
+from tuttiapp.search import search_users
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds a large User table and times the manage_users search (target: under 50 ms). "
+        "Run against a scratch database: DATABASE_URL=sqlite:///bench.sqlite3"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500_000, help="Target size of the User table")
+        parser.add_argument('--repeat', type=int, default=20, help="Timed runs per query")
+        parser.add_argument('--budget-ms', type=float, default=50.0)
+
+    def handle(self, *args, **options):
+        missing = options['users'] - User.objects.count()
+        if missing > 0:
+            self.stdout.write(f"Seeding {missing} users...")
+            seed_users(missing // 2, 'teacher')
+            seed_users(missing - missing // 2, 'student')
+
+        queries = {
+            'username fragment': 'student_4242',
+            'email fragment': 'teacher_77@exa',
+            'local phone': '0700012',
+            'no match': 'zzqxv',
+            'second page': 'teacher_1',
+        }
+        failed = False
+        for name, query in queries.items():
+            page = 2 if name == 'second page' else 1
+            timings = []
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                results = search_users(query, page=page)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            p50 = timings[len(timings) // 2]
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            style = self.style.SUCCESS if p95 <= options['budget_ms'] else self.style.ERROR
+            failed |= p95 > options['budget_ms']
+            self.stdout.write(style(f"{name:<18} {query!r:<18} {len(results):>3} hits  p50 {p50:7.2f} ms  p95 {p95:7.2f} ms"))
+
+        if failed:
+            self.stderr.write(self.style.ERROR(f"Some searches exceeded {options['budget_ms']} ms"))
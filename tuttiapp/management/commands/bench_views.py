@@ -0,0 +1,168 @@
+import datetime
+import itertools
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from tuttiapp.models import Lesson, MpesaCallback, MpesaTransaction, User
+
+BENCH_ADMIN = 'bench_admin'
+TOPIC = "Benchmark"
+# Read-only scenarios get one unmeasured request first, so the numbers are for warm caches
+WARM_UP = {'dashboard_teacher', 'dashboard_teacher_history', 'dashboard_student', 'dashboard_admin',
+           'teacher_list', 'teacher_list_search', 'manage_users_search'}
+
+
+class Command(BaseCommand):
+    help = (
+        "Drives the main pages and lesson actions through the test client and reports latency percentiles "
+        "and queries per request. Seed a scratch database first (manage.py seed_data). Each request commits, "
+        "so its on-commit work (cache invalidation, card refreshes...) is measured too; the lessons and "
+        "callbacks the actions create are deleted at the end. --save / --baseline turn it into a regression check."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help="Requests per scenario")
+        parser.add_argument('--only', action='append', default=[], help="Run just this scenario (repeatable)")
+        parser.add_argument('--save', help="Write the results as JSON, to use as a later --baseline")
+        parser.add_argument('--baseline', help="Fail if a scenario got slower or runs more queries than in this file")
+        parser.add_argument('--tolerance', type=float, default=1.5, help="Allowed p95 growth over the baseline (x)")
+
+    def handle(self, *args, **options):
+        teacher_id = (Lesson.objects.values('teacher').annotate(n=Count('pk')).order_by('-n')
+                      .values_list('teacher', flat=True).first())
+        if teacher_id is None:
+            raise CommandError("No lessons: run manage.py seed_data first")
+        student_id = Lesson.objects.filter(teacher_id=teacher_id).values_list('student', flat=True).first()
+        self.teacher, self.student = User.objects.get(pk=teacher_id), User.objects.get(pk=student_id)
+        self.admin = User.objects.filter(username=BENCH_ADMIN).first() or \
+            User.objects.create_superuser(username=BENCH_ADMIN, password='password')
+
+        results = {}
+        self.created_lessons = []
+        self.last_callback = MpesaCallback.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        try:
+            for name, scenario in self.scenarios(options['requests']).items():
+                if options['only'] and name not in options['only']:
+                    continue
+                results[name] = self.run(name, scenario, options['requests'])
+        finally:
+            self.cleanup()
+
+        if options['save']:
+            with open(options['save'], 'w') as out:
+                json.dump(results, out, indent=2)
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    # --- Scenarios: name -> function making the i-th request ---
+    def scenarios(self, n):
+        teacher, student, admin = self.client_for(self.teacher), self.client_for(self.student), self.client_for(self.admin)
+        to_approve = self.lessons_for_actions(n, 'REQUESTED')
+        to_complete = self.lessons_for_actions(n, 'SCHEDULED')
+        to_bulk = self.lessons_for_actions(n * 20, 'REQUESTED')
+        waiting = itertools.cycle(list(
+            MpesaTransaction.objects.filter(is_successful=False, result_code__isnull=True, checkout_request_id__isnull=False)
+            .values_list('checkout_request_id', flat=True)[:n]
+        ) or ['ws_CO_unknown'])
+        anonymous = Client()
+        return {
+            'dashboard_teacher': lambda i: teacher.get(reverse('dashboard')),
+            'dashboard_teacher_history': lambda i: teacher.get(reverse('dashboard'), {'segment': 'history'}),
+            'dashboard_student': lambda i: student.get(reverse('dashboard')),
+            'dashboard_admin': lambda i: admin.get(reverse('dashboard')),
+            'teacher_list': lambda i: student.get(reverse('teacher_list'), {'page': i % 5 + 1}),
+            'teacher_list_search': lambda i: student.get(reverse('teacher_list'), {'q': 'Piano', 'available': 7}),
+            'manage_users_search': lambda i: admin.get(reverse('manage_users'), {'q': f'bench_student_{i}'}),
+            'mpesa_callback': lambda i: anonymous.post(
+                reverse('mpesa_callback'), self.callback_body(next(waiting)), content_type='application/json'),
+            'approve_lesson': lambda i: teacher.post(reverse('approve_lesson', args=[to_approve[i]])),
+            'complete_lesson': lambda i: teacher.post(reverse('complete_lesson', args=[to_complete[i]])),
+            'bulk_approve_20': lambda i: teacher.post(
+                reverse('bulk_lessons', args=['approve']), {'ids': to_bulk[i * 20:(i + 1) * 20]},
+                content_type='application/json'),
+        }
+
+    def client_for(self, user):
+        client = Client()
+        client.force_login(user)
+        return client
+
+    def lessons_for_actions(self, count, status):
+        # Far in the future and an hour apart, so they never clash with the seeded lessons
+        start = timezone.now().replace(minute=0, second=0, microsecond=0) + datetime.timedelta(days=3650)
+        offset = Lesson.objects.filter(teacher=self.teacher, start_time__gte=start).count()
+        lessons = Lesson.objects.bulk_create([
+            Lesson(teacher=self.teacher, student=self.student, topic=TOPIC, status=status,
+                   start_time=start + datetime.timedelta(hours=offset + i))
+            for i in range(count)
+        ])
+        self.created_lessons += [lesson.pk for lesson in lessons]
+        return [lesson.pk for lesson in lessons]
+
+    def cleanup(self):
+        # Through the ORM, so the signals take the lessons back off the counters, cards and rollups
+        for i in range(0, len(self.created_lessons), 1000):
+            Lesson.objects.filter(pk__in=self.created_lessons[i:i + 1000]).delete()
+        MpesaCallback.objects.filter(pk__gt=self.last_callback, raw_body__contains='"MerchantRequestID": "bench"').delete()
+
+    def callback_body(self, checkout_id):
+        return json.dumps({'Body': {'stkCallback': {
+            'MerchantRequestID': 'bench', 'CheckoutRequestID': checkout_id, 'ResultCode': 0,
+            'ResultDesc': 'The service request is processed successfully.',
+            'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'BENCH0001'}]},
+        }}})
+
+    # --- Running and reporting ---
+    def run(self, name, make_request, n):
+        if name in WARM_UP:
+            make_request(0)
+        timings, queries = [], []
+        for i in range(n):
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = make_request(i)
+                timings.append((time.perf_counter() - started) * 1000)
+            queries.append(len(captured))
+            if response.status_code >= 400:
+                raise CommandError(f"{name}: {response.status_code} on request {i}")
+
+        timings.sort()
+
+        def pct(p):
+            return round(timings[min(n - 1, int(n * p))], 2)
+
+        result = {
+            'requests': n, 'p50_ms': pct(0.50), 'p95_ms': pct(0.95), 'p99_ms': pct(0.99), 'max_ms': round(timings[-1], 2),
+            'queries_mean': round(sum(queries) / n, 2), 'queries_max': max(queries),
+        }
+        self.stdout.write(
+            f"{name:<26} p50 {result['p50_ms']:8.2f} ms  p95 {result['p95_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms  "
+            f"queries {result['queries_mean']:5.1f} (max {result['queries_max']})"
+        )
+        return result
+
+    def compare(self, results, path, tolerance):
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = []
+        for name, result in results.items():
+            before = baseline.get(name)
+            if before is None:
+                continue
+            if result['queries_max'] > before['queries_max']:
+                regressions.append(f"{name}: {before['queries_max']} -> {result['queries_max']} queries")
+            if result['p95_ms'] > before['p95_ms'] * tolerance:
+                regressions.append(f"{name}: p95 {before['p95_ms']} -> {result['p95_ms']} ms")
+        for regression in regressions:
+            self.stdout.write(self.style.ERROR(f"REGRESSION {regression}"))
+        if regressions:
+            raise CommandError(f"{len(regressions)} regressions against {path}")
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {path}"))
@@ -0,0 +1,138 @@
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connection, connections, transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from tuttiapp.db import SQLITE_DEFAULT_PRAGMAS, sqlite_pragmas
+from tuttiapp.models import Lesson, MpesaCallback, MpesaTransaction, User
+
+TOPIC = "Write benchmark"
+PREFIX = 'writebench'
+
+
+class Command(BaseCommand):
+    help = (
+        "Concurrent write throughput: worker threads, each with its own database connection, record a "
+        "burst of payments (callback inbox insert, then read the lesson and write its transaction and "
+        "status in one transaction). On SQLite it compares SQLite's defaults with the tuned pragmas "
+        "from settings (WAL, BEGIN IMMEDIATE...). Use a scratch database: the rows it writes are deleted "
+        "afterwards, and the file is left in WAL mode."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writes', type=int, default=1000, help="Payments per profile")
+        parser.add_argument('--workers', type=int, default=8, help="Concurrent writers (think gunicorn workers)")
+        parser.add_argument('--profile', choices=('default', 'tuned'), action='append', default=[],
+                            help="Run just this profile (repeatable). SQLite only; other engines run as configured")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            self.stdout.write(f"{connection.vendor}: benchmarking the configured settings")
+            self.run('configured', options)
+            return
+        if connection.is_in_memory_db():
+            raise CommandError("Needs a database file: the writers can't share an in-memory database")
+        if not settings.SQLITE_PRAGMAS:
+            raise CommandError("SQLITE_TUNING is off: there's no tuned profile to compare with")
+
+        profiles = {
+            'default': (SQLITE_DEFAULT_PRAGMAS, None),
+            'tuned': (settings.SQLITE_PRAGMAS, 'IMMEDIATE'),
+        }
+        for name in options['profile'] or profiles:
+            pragmas, transaction_mode = profiles[name]
+            with self.sqlite_profile(pragmas, transaction_mode):
+                self.stdout.write(f"{name}: {sqlite_pragmas(connection)}, transaction mode {transaction_mode or 'DEFERRED'}")
+                self.run(name, options)
+
+    def sqlite_profile(self, pragmas, transaction_mode):
+        class Profile:
+            # Each new connection (one per worker thread) picks these up from the shared settings dict
+            def __enter__(self):
+                connections.close_all()
+                self.options = connections.settings[DEFAULT_DB_ALIAS].setdefault('OPTIONS', {})
+                self.saved = dict(self.options)
+                self.options.pop('transaction_mode', None)
+                if transaction_mode:
+                    self.options['transaction_mode'] = transaction_mode
+                self.override = override_settings(SQLITE_PRAGMAS=pragmas)
+                self.override.enable()
+                connection.ensure_connection()  # switches journal_mode while it's the only connection
+
+            def __exit__(self, *exc):
+                connections.close_all()
+                self.override.disable()
+                self.options.clear()
+                self.options.update(self.saved)
+
+        return Profile()
+
+    def run(self, label, options):
+        lesson_ids = self.create_lessons(options['writes'])
+        workers = options['workers']
+        shares = [lesson_ids[i::workers] for i in range(workers)]
+
+        started = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = [result for share in pool.map(self.writer, shares) for result in share]
+            elapsed = time.perf_counter() - started
+        finally:
+            self.cleanup()
+
+        latencies = sorted(seconds for seconds, error in results if error is None)
+        errors = [error for _, error in results if error is not None]
+        if not latencies:
+            raise CommandError(f"{label}: every write failed, e.g. {errors[0]}")
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[int(len(latencies) * 0.95)] * 1000
+        style = self.style.SUCCESS if not errors else self.style.WARNING
+        self.stdout.write(style(
+            f"{label:<10} {len(latencies) / elapsed:8.1f} writes/s  p50 {p50:7.1f} ms  p95 {p95:7.1f} ms  "
+            f"failed {len(errors)}/{len(results)}" + (f" ({errors[0]})" if errors else "")
+        ))
+
+    def writer(self, lesson_ids):
+        try:
+            return [self.pay(lesson_id) for lesson_id in lesson_ids]
+        finally:
+            connection.close()  # this thread's own connection
+
+    def pay(self, lesson_id):
+        checkout_id = f"ws_CO_{PREFIX}_{lesson_id}"
+        started = time.perf_counter()
+        try:
+            # The callback view's inbox insert (autocommit) ...
+            MpesaCallback.objects.create(checkout_request_id=checkout_id, raw_body='{}')
+            # ... then the worker: read first, write after, the pattern that fails with "database is
+            # locked" when a deferred transaction can't upgrade its read lock
+            with transaction.atomic():
+                price = Lesson.objects.values_list('price', flat=True).get(pk=lesson_id)
+                MpesaTransaction.objects.create(lesson_id=lesson_id, amount=price, phone_number='254700000000',
+                                                checkout_request_id=checkout_id)
+                Lesson.objects.filter(pk=lesson_id).update(status='PAID', paid_at=timezone.now())
+        except OperationalError as e:
+            return time.perf_counter() - started, str(e)
+        return time.perf_counter() - started, None
+
+    # --- Setup and cleanup ---
+    def create_lessons(self, count):
+        teacher, _ = User.objects.get_or_create(username=f'{PREFIX}_teacher', defaults={'is_teacher': True})
+        student, _ = User.objects.get_or_create(username=f'{PREFIX}_student', defaults={'is_student': True})
+        start = timezone.now() - datetime.timedelta(days=1)
+        lessons = Lesson.objects.bulk_create([
+            Lesson(teacher=teacher, student=student, topic=TOPIC, status='PENDING_PAYMENT',
+                   start_time=start - datetime.timedelta(hours=i))
+            for i in range(count)
+        ], batch_size=1000)
+        return [lesson.pk for lesson in lessons]
+
+    def cleanup(self):
+        MpesaCallback.objects.filter(checkout_request_id__startswith=f"ws_CO_{PREFIX}_").delete()
+        MpesaTransaction.objects.filter(lesson__topic=TOPIC, lesson__teacher__username=f'{PREFIX}_teacher').delete()
+        User.objects.filter(username__in=[f'{PREFIX}_teacher', f'{PREFIX}_student']).delete()  # and their lessons
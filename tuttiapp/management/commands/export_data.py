@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tuttiapp.exports import EXPORTS, FORMATS, ExportError, parse_filters, stream
+
+
+class Command(BaseCommand):
+    help = "Writes every lesson or M-Pesa transaction (optionally filtered) as CSV or JSON Lines, in constant memory."
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=list(EXPORTS))
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--from', dest='date_from', help="First day, YYYY-MM-DD")
+        parser.add_argument('--to', dest='date_to', help="Last day (included), YYYY-MM-DD")
+        parser.add_argument('--teacher', type=int, help="Teacher user id")
+        parser.add_argument('--status', help="Lesson status, or payment state for transactions (paid, failed...)")
+        parser.add_argument('--output', '-o', help="File to write (default: stdout)")
+
+    def handle(self, *args, **options):
+        try:
+            filters = parse_filters(options['date_from'], options['date_to'], options['teacher'], options['status'])
+            lines = stream(options['kind'], options['format'], **filters)
+        except ExportError as e:
+            raise CommandError(e)
+
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+
+        rows = 0
+        with open(options['output'], 'w', newline='', encoding='utf-8') as out:
+            for line in lines:
+                out.write(line)
+                rows += 1
+        data_rows = rows - 1 if options['format'] == 'csv' else rows
+        self.stderr.write(f"Wrote {data_rows} {options['kind']} to {options['output']}")
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tuttiapp.series import materialize_due
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates the lessons of recurring series that fall inside the next LESSON_SERIES_WINDOW_WEEKS. "
+        "Safe to run several copies at once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="Series per pass")
+        parser.add_argument('--loop', action='store_true', help="Keep going every --interval seconds")
+        parser.add_argument('--interval', type=float, default=3600.0)
+
+    def handle(self, *args, **options):
+        while True:
+            while True:
+                seen, created = materialize_due(batch_size=options['batch_size'])
+                self.stdout.write(f"Rolled {seen} series forward, {created} lessons created")
+                if seen < options['batch_size']:
+                    break
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
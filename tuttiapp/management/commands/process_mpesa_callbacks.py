@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tuttiapp.callbacks import DEFAULT_BATCH_SIZE, process_pending
+
+
+class Command(BaseCommand):
+    help = "Applies pending M-Pesa callbacks from the inbox to their transactions and lessons."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--loop', action='store_true', help="Keep polling the inbox instead of exiting when it is empty")
+        parser.add_argument('--sleep', type=float, default=1.0, help="Seconds to wait between polls when the inbox is empty")
+
+    def handle(self, *args, **options):
+        total = {}
+        while True:
+            started = time.perf_counter()
+            summary = process_pending(options['batch_size'])
+            handled = sum(summary.values())
+            if handled:
+                elapsed = time.perf_counter() - started
+                for status, count in summary.items():
+                    total[status] = total.get(status, 0) + count
+                self.stdout.write(f"Applied {handled} callbacks in {elapsed * 1000:.0f} ms: {summary}")
+            elif options['loop']:
+                time.sleep(options['sleep'])
+            else:
+                break
+        self.stdout.write(self.style.SUCCESS(f"Inbox drained: {total or 'nothing to do'}"))
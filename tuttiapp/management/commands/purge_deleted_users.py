@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tuttiapp.deletion import PURGE_BATCH, purge_deleted_users
+
+
+class Command(BaseCommand):
+    help = "Deletes the lessons of users deleted from manage_users with too much history to delete inline."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PURGE_BATCH, help="Lessons deleted per transaction")
+        parser.add_argument('--loop', action='store_true', help="Keep purging every --interval seconds")
+        parser.add_argument('--interval', type=float, default=60.0)
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            users, lessons = purge_deleted_users(batch_size=options['batch_size'])
+            self.stdout.write(f"Purged {users} users ({lessons} lessons) in {time.monotonic() - started:.2f}s")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
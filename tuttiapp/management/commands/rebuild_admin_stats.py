@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from tuttiapp.stats import get_admin_stats, rebuild_admin_stats
+
+
+class Command(BaseCommand):
+    help = "Recounts the admin dashboard counters (students, teachers, revenue) from scratch."
+
+    def handle(self, *args, **options):
+        rebuild_admin_stats()
+        stats = get_admin_stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"Students: {stats['total_students']}, Teachers: {stats['total_teachers']}, "
+            f"Revenue: KES {stats['total_revenue']}"
+        ))
@@ -0,0 +1,49 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tuttiapp.reconciliation import (
+    PENDING_AGE, QUERY_WORKERS, ReconciliationError, ReconciliationReport, check_paid_lessons,
+    reconcile_pending, reconcile_statement,
+)
+
+
+class Command(BaseCommand):
+    help = "Fixes payments whose callback was lost, from an M-Pesa statement and/or STK status queries, and reports mismatches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--statement', action='append', default=[], help="Statement CSV exported from the M-Pesa portal (repeatable)")
+        parser.add_argument('--query-pending', action='store_true', help="Ask Safaricom about pushes still waiting for a callback")
+        parser.add_argument('--older-than-minutes', type=float, default=PENDING_AGE.total_seconds() / 60)
+        parser.add_argument('--workers', type=int, default=QUERY_WORKERS, help="Concurrent status queries")
+        parser.add_argument('--dry-run', action='store_true', help="Report what would change without changing it")
+        parser.add_argument('--show', type=int, default=20, help="How many mismatches to list")
+
+    def handle(self, *args, **options):
+        if not options['statement'] and not options['query_pending']:
+            raise CommandError("Give --statement FILE and/or --query-pending")
+
+        reports = []
+        for path in options['statement']:
+            try:
+                with open(path, newline='', encoding='utf-8-sig') as statement:
+                    reports.append((path, reconcile_statement(statement, dry_run=options['dry_run'])))
+            except (OSError, ReconciliationError) as e:
+                raise CommandError(f"{path}: {e}")
+        if options['query_pending']:
+            older_than = datetime.timedelta(minutes=options['older_than_minutes'])
+            reports.append(("pending pushes", reconcile_pending(older_than=older_than, workers=options['workers'],
+                                                                dry_run=options['dry_run'])))
+        reports.append(("paid lessons", check_paid_lessons(ReconciliationReport())))
+
+        verb = "would fix" if options['dry_run'] else "fixed"
+        for name, report in reports:
+            self.stdout.write(
+                f"{name}: {report.lines} checked, {report.matched} matched, {report.fixed} {verb}, "
+                f"{report.failed} failed, {report.pending} still pending, "
+                f"{sum(report.mismatch_counts.values())} mismatches in {report.seconds:.2f}s"
+            )
+            for kind, count in sorted(report.mismatch_counts.items()):
+                self.stdout.write(f"  {kind}: {count}")
+            for kind, reference, detail in report.mismatches[:options['show']]:
+                self.stdout.write(f"  - {kind} {reference} {detail}".rstrip())
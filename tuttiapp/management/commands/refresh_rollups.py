@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tuttiapp.rollups import refresh_rollups
+
+
+class Command(BaseCommand):
+    help = "Brings the analytics rollups up to date with the lessons changed since the last run."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="Recompute every day, not just the changed ones")
+        parser.add_argument('--loop', action='store_true', help="Keep refreshing every --interval seconds")
+        parser.add_argument('--interval', type=float, default=300.0)
+
+    def handle(self, *args, **options):
+        full = options['full']
+        while True:
+            started = time.monotonic()
+            days, rows = refresh_rollups(full=full)
+            self.stdout.write(f"Recomputed {days} days ({rows} rollup rows) in {time.monotonic() - started:.2f}s")
+            if not options['loop']:
+                break
+            full = False
+            time.sleep(options['interval'])
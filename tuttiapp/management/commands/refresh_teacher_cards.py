@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from tuttiapp.marketplace import refresh_stale_cards, refresh_teacher_card
+from tuttiapp.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes marketplace teacher cards whose next free slot has passed (run it from cron), "
+        "or every card with --all."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Rebuild every teacher's card")
+
+    def handle(self, *args, **options):
+        if options['all']:
+            count = 0
+            for teacher_id in User.objects.filter(is_teacher=True).values_list('pk', flat=True).iterator():
+                refresh_teacher_card(teacher_id)
+                count += 1
+        else:
+            count = refresh_stale_cards()
+        self.stdout.write(self.style.SUCCESS(f"Refreshed {count} teacher cards"))
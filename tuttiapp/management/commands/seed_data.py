@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from tuttiapp.datagen import rebuild_derived, seed_lessons, seed_transactions, seed_users
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills the database with N teachers, M students and a realistic mix of lessons and M-Pesa "
+        "transactions, in bulk. Only ever run it against a scratch DATABASE_URL (e.g. sqlite:///bench.sqlite3)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--teachers', type=int, default=200)
+        parser.add_argument('--students', type=int, default=5000)
+        parser.add_argument('--lessons', type=int, default=100000)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=42, help="Random seed, for repeatable data")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        teacher_ids = seed_users(options['teachers'], 'teacher', batch_size=options['batch_size'])
+        student_ids = seed_users(options['students'], 'student', batch_size=options['batch_size'])
+        self.stdout.write(f"{len(teacher_ids)} teachers, {len(student_ids)} students ({time.monotonic() - started:.1f}s)")
+
+        seed_lessons(options['lessons'], teacher_ids, student_ids, batch_size=options['batch_size'], seed=options['seed'])
+        self.stdout.write(f"+{options['lessons']} lessons ({time.monotonic() - started:.1f}s)")
+
+        created = seed_transactions(batch_size=options['batch_size'], seed=options['seed'])
+        self.stdout.write(f"+{created} transactions ({time.monotonic() - started:.1f}s)")
+
+        rebuild_derived()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.stdout.write(self.style.SUCCESS(f"Done in {time.monotonic() - started:.1f}s"))
@@ -0,0 +1,33 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from tuttiapp.reminders import DEFAULT_BATCH_SIZE, get_backend, sweep
+
+
+class Command(BaseCommand):
+    help = "Sends reminders for SCHEDULED lessons starting soon. Safe to run several copies at once."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window-hours', type=float, default=settings.LESSON_REMINDER_WINDOW_HOURS,
+                            help="Remind about lessons starting within this many hours")
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--backend', default=None, help="Dotted path, overrides LESSON_REMINDER_BACKEND")
+        parser.add_argument('--loop', action='store_true', help="Keep sweeping every --interval seconds")
+        parser.add_argument('--interval', type=float, default=60.0)
+
+    def handle(self, *args, **options):
+        backend = get_backend(options['backend'])
+        window = datetime.timedelta(hours=options['window_hours'])
+        while True:
+            report = sweep(window=window, batch_size=options['batch_size'], backend=backend)
+            self.stdout.write(
+                f"Sent {report.sent} reminders ({report.failed} failed, "
+                f"{report.candidates - report.claimed} taken by another sweeper) "
+                f"in {report.seconds:.2f}s, {report.per_second:.0f}/s"
+            )
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
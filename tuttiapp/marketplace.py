@@ -0,0 +1,108 @@
+import datetime
+import threading
+
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q
+from django.utils import timezone
+
+from .models import Lesson, TeacherCard, User
+from .scheduling import next_free_slots
+
+# The "Find a Conductor" marketplace.
+# Listing reads only TeacherCard rows (one per teacher, joined to the user for name/email),
+# and each rendered card is fragment-cached under (teacher id, card version).
+# refresh_teacher_card() recomputes one teacher's card; signals call it when that teacher's
+# lessons or profile change, and `manage.py refresh_teacher_cards` catches up cards whose
+# "next free slot" has slipped into the past.
+
+TEACHERS_PER_PAGE = 24
+CARD_TOPICS = 10
+CARD_CACHE_SECONDS = 60 * 60
+
+
+def refresh_teacher_card(teacher_id, now=None):
+    now = now or timezone.now()
+    lessons = Lesson.objects.filter(teacher_id=teacher_id)
+    summary = lessons.aggregate(
+        taught=Count('pk', filter=Q(status__in=Lesson.TAUGHT_STATUSES)),
+        min_price=Min('price'),
+        max_price=Max('price'),
+    )
+    topics = []
+    for topic in lessons.order_by('-start_time').values_list('topic', flat=True)[:50]:
+        if topic not in topics:
+            topics.append(topic)
+    # Suggest whole hours: from the start of the next hour
+    from_time = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+
+    fields = {
+        'lessons_taught': summary['taught'],
+        'min_price': summary['min_price'],
+        'max_price': summary['max_price'],
+        'topics': ' · '.join(topics[:CARD_TOPICS]),
+        'next_free_slot': next_free_slots(teacher_id, from_time, count=1)[0],
+        'updated_at': now,
+    }
+    if not TeacherCard.objects.filter(teacher_id=teacher_id).update(version=F('version') + 1, **fields):
+        TeacherCard.objects.create(teacher_id=teacher_id, **fields)
+
+
+_pending = threading.local()
+
+
+def schedule_refresh(teacher_id):
+    """
+    Refreshes the teacher's card once the current transaction commits (straight away outside one).
+    Many lesson changes in one transaction, like a cascade delete, end up as one refresh per teacher.
+    """
+    _pending.__dict__.setdefault('teacher_ids', set()).add(teacher_id)
+    transaction.on_commit(_flush_pending)
+
+
+def _flush_pending():
+    teacher_ids = _pending.__dict__.pop('teacher_ids', set())
+    if not teacher_ids:
+        return  # an earlier callback in the same commit already did the work
+    # The teacher may have been deleted (or stopped teaching) in the same transaction
+    for teacher_id in User.objects.filter(pk__in=teacher_ids, is_teacher=True).values_list('pk', flat=True):
+        refresh_teacher_card(teacher_id)
+
+
+def bump_card_version(teacher_id):
+    """For profile changes that don't need a recount (e.g. a new username): just retire the cached fragment."""
+    return TeacherCard.objects.filter(teacher_id=teacher_id).update(version=F('version') + 1)
+
+
+def teacher_cards(keyword=None, available_within_days=None, now=None):
+    cards = (
+        TeacherCard.objects.filter(teacher__is_teacher=True, teacher__is_active=True)
+        .select_related('teacher')
+        .only('teacher_id', 'lessons_taught', 'next_free_slot', 'min_price', 'max_price', 'topics', 'version',
+              'teacher__username', 'teacher__email')
+        .order_by('-lessons_taught', 'teacher_id')
+    )
+    if keyword:
+        cards = cards.filter(Q(topics__icontains=keyword) | Q(teacher__username__icontains=keyword))
+    if available_within_days:
+        now = now or timezone.now()
+        cards = cards.filter(next_free_slot__lt=now + datetime.timedelta(days=available_within_days))
+    return cards
+
+
+def marketplace_page(keyword=None, available_within_days=None, page=1, per_page=TEACHERS_PER_PAGE):
+    paginator = Paginator(teacher_cards(keyword, available_within_days), per_page)
+    return paginator.get_page(page)
+
+
+def refresh_stale_cards(now=None, batch_size=500):
+    """Recomputes cards whose next free slot is already in the past. Returns how many were refreshed."""
+    now = now or timezone.now()
+    stale = TeacherCard.objects.filter(Q(next_free_slot__lt=now) | Q(next_free_slot__isnull=True))
+    missing = User.objects.filter(is_teacher=True, card__isnull=True)
+    refreshed = 0
+    for queryset in (stale, missing):
+        for teacher_id in queryset.values_list('pk', flat=True).iterator(chunk_size=batch_size):
+            refresh_teacher_card(teacher_id, now)
+            refreshed += 1
+    return refreshed
@@ -0,0 +1,311 @@
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.urls import get_resolver
+
+from .cache import STATS, add_to, make_key
+
+slow_logger = logging.getLogger('tuttiapp.slow_requests')
+
+# Per-view request metrics (RequestMetricsMiddleware and the staff-only /metrics page).
+# Every request is timed, and its queries are counted and timed by an execute wrapper, so it works
+# with DEBUG off. The wrapper is installed on every connection as it opens and reports to the
+# QueryTimer of the current request, found through a context variable: under ASGI the queries run
+# on other threads (sync_to_async, sync middleware), each with its own connection, and asgiref
+# carries the context variable over to them. Requests are grouped by URL name ("dashboard", "initiate_payment"...;
+# namespaced URLs such as the Django admin by namespace). Durations go into fixed histogram buckets.
+# Counts are kept per minute in the process and added to the shared cache every FLUSH_EVERY
+# requests (or FLUSH_SECONDS), like the cache hit/miss counters, so /metrics sees every worker.
+# Each minute has its own keys, which expire after the window: /metrics sums the last
+# WINDOW_MINUTES minutes for the percentiles. The same counts are also added to running totals
+# that never expire, and those are what /metrics exports as the Prometheus histogram and counters:
+# rate() and histogram_quantile() need values that only go up (a cache restart reads as a reset).
+#
+# Requests slower than SLOW_REQUEST_MS are also logged to "tuttiapp.slow_requests" (JSON lines,
+# see LOGGING in tutti/settings.py). For streaming responses only the time to the first byte counts.
+# Under ASGI the middleware runs async, like the rest of the stack, so the async views stay async.
+
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+WINDOW_MINUTES = 10
+FLUSH_EVERY = 50
+FLUSH_SECONDS = 5
+UNRESOLVED = 'unresolved'  # 404s and anything else no URL pattern matched
+FIELDS = ('count', 'errors', 'duration_us', 'db_queries', 'db_us') + tuple(f'b{i}' for i in range(len(BUCKETS_MS) + 1))
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class QueryTimer:
+    """connection.execute_wrapper() hook: counts and times the queries run inside it."""
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.seconds += time.perf_counter() - started
+
+
+_request_timer = ContextVar('request_timer', default=None)
+
+
+def _timed_execute(execute, sql, params, many, context):
+    timer = _request_timer.get()
+    if timer is None:  # not inside a request (management commands, the purge...)
+        return execute(sql, params, many, context)
+    return timer(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_timer(sender, connection, **kwargs):
+    if _timed_execute not in connection.execute_wrappers:  # a reconnecting wrapper already has it
+        connection.execute_wrappers.append(_timed_execute)
+
+
+class RequestMetricsMiddleware:
+    sync_capable = True
+    async_capable = True  # so it doesn't push every ASGI request through a thread
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = QueryTimer()
+        started = time.perf_counter()
+        token = _request_timer.set(timer)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_timer.reset(token)
+        seconds = time.perf_counter() - started
+        if self._record(request, response, seconds, timer):
+            user = getattr(request, 'user', None)
+            self._log_slow(request, response, seconds, timer, user)
+        return response
+
+    async def __acall__(self, request):
+        timer = QueryTimer()
+        started = time.perf_counter()
+        token = _request_timer.set(timer)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_timer.reset(token)
+        seconds = time.perf_counter() - started
+        if self._record(request, response, seconds, timer):
+            user = await request.auser() if hasattr(request, 'auser') else None
+            self._log_slow(request, response, seconds, timer, user)
+        return response
+
+    def _record(self, request, response, seconds, timer):
+        """Counts the request; True if it was slow enough to log."""
+        record(view_label(request.resolver_match), seconds, timer.queries, timer.seconds, response.status_code)
+        return seconds * 1000 >= settings.SLOW_REQUEST_MS
+
+    def _log_slow(self, request, response, seconds, timer, user):
+        view = view_label(request.resolver_match)
+        slow_logger.warning("Slow request to %s", view, extra={'data': {
+            'view': view,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(seconds * 1000, 1),
+            'db_queries': timer.queries,
+            'db_ms': round(timer.seconds * 1000, 1),
+            'user_id': user.pk if user is not None and user.is_authenticated else None,
+        }})
+
+
+def view_label(resolver_match):
+    if resolver_match is None:
+        return UNRESOLVED
+    if resolver_match.namespaces:
+        return resolver_match.namespaces[0]
+    return resolver_match.url_name or UNRESOLVED
+
+
+def known_views():
+    """Every label a request can be counted under: the URL names, the namespaces and UNRESOLVED."""
+    resolver = get_resolver()
+    names = {name for name in resolver.reverse_dict if isinstance(name, str)}
+    return sorted(names | set(resolver.namespace_dict) | {UNRESOLVED})
+
+
+# --- Counting ---
+_counts = Counter()
+_counts_lock = threading.Lock()
+_pending = {'requests': 0, 'since': time.monotonic()}
+
+
+def _bucket(ms):
+    for i, bound in enumerate(BUCKETS_MS):
+        if ms <= bound:
+            return i
+    return len(BUCKETS_MS)
+
+
+def record(view, seconds, db_queries=0, db_seconds=0.0, status=200, now=None):
+    minute = int((now or time.time()) // 60)
+    with _counts_lock:
+        _counts[(minute, view, 'count')] += 1
+        _counts[(minute, view, 'errors')] += int(status >= 500)
+        _counts[(minute, view, 'duration_us')] += int(seconds * 1_000_000)
+        _counts[(minute, view, 'db_queries')] += db_queries
+        _counts[(minute, view, 'db_us')] += int(db_seconds * 1_000_000)
+        _counts[(minute, view, f'b{_bucket(seconds * 1000)}')] += 1
+        _pending['requests'] += 1
+        due = _pending['requests'] >= FLUSH_EVERY or time.monotonic() - _pending['since'] >= FLUSH_SECONDS
+    if due:
+        flush()
+
+
+def _key(minute, view, field):
+    return make_key(STATS, 'requests', minute, view, field)
+
+
+def _total_key(view, field):
+    return make_key(STATS, 'requests', 'total', view, field)
+
+
+def flush():
+    """Adds this process's counts to the shared totals."""
+    with _counts_lock:
+        counts = dict(_counts)
+        _counts.clear()
+        _pending.update(requests=0, since=time.monotonic())
+    timeout = (WINDOW_MINUTES + 1) * 60
+    totals = Counter()
+    for (minute, view, field), count in counts.items():
+        if count:
+            add_to(_key(minute, view, field), count, timeout)
+            totals[(view, field)] += count
+    for (view, field), count in totals.items():
+        add_to(_total_key(view, field), count)
+
+
+def reset():
+    with _counts_lock:
+        _counts.clear()
+
+
+# --- Reading ---
+def request_metrics(now=None):
+    """
+    {view: {'count', 'errors', 'duration_seconds', 'db_queries', 'db_seconds', 'buckets': [cumulative
+    counts per BUCKETS_MS, then +Inf], 'quantiles': {0.5: seconds, ...}, 'total': {...}}}.
+    'quantiles' and the numbers beside it are over the last WINDOW_MINUTES; 'total' has the same
+    numbers (without quantiles) since the counters were created.
+    """
+    flush()
+    minute = int((now or time.time()) // 60)
+    minutes = range(minute - WINDOW_MINUTES + 1, minute + 1)
+    views = known_views()
+    values = cache.get_many([_key(m, view, field) for m in minutes for view in views for field in FIELDS]
+                            + [_total_key(view, field) for view in views for field in FIELDS])
+
+    report = {}
+    for view in views:
+        total = _summary({field: values.get(_total_key(view, field), 0) for field in FIELDS})
+        if not total['count']:
+            continue
+        window = _summary({field: sum(values.get(_key(m, view, field), 0) for m in minutes) for field in FIELDS})
+        window['quantiles'] = {q: _quantile(window['buckets'], q) for q in QUANTILES} if window['count'] else {}
+        window['total'] = total
+        report[view] = window
+    return report
+
+
+def _summary(sums):
+    buckets, running = [], 0
+    for i in range(len(BUCKETS_MS) + 1):
+        running += sums[f'b{i}']
+        buckets.append(running)
+    return {
+        'count': sums['count'],
+        'errors': sums['errors'],
+        'duration_seconds': sums['duration_us'] / 1_000_000,
+        'db_queries': sums['db_queries'],
+        'db_seconds': sums['db_us'] / 1_000_000,
+        'buckets': buckets,
+    }
+
+
+def _quantile(buckets, q):
+    """Upper bound of the bucket holding the q-th request (inf if it's in the last one)."""
+    target = q * buckets[-1]
+    for bound, cumulative in zip(BUCKETS_MS, buckets):
+        if cumulative >= target:
+            return bound / 1000
+    return float('inf')
+
+
+def _number(value):
+    return '+Inf' if value == float('inf') else repr(round(value, 6))
+
+
+def prometheus_text(report):
+    """
+    The report in the Prometheus text exposition format: the running totals as a histogram and
+    counters, and the last WINDOW_MINUTES' percentiles as a gauge.
+    """
+    lines = [
+        '# HELP tutti_request_duration_seconds Request wall time per view.',
+        '# TYPE tutti_request_duration_seconds histogram',
+    ]
+    for view, entry in report.items():
+        total = entry['total']
+        for bound, cumulative in zip(BUCKETS_MS, total['buckets']):
+            lines.append(f'tutti_request_duration_seconds_bucket{{view="{view}",le="{bound / 1000}"}} {cumulative}')
+        lines.append(f'tutti_request_duration_seconds_bucket{{view="{view}",le="+Inf"}} {total["count"]}')
+        lines.append(f'tutti_request_duration_seconds_sum{{view="{view}"}} {_number(total["duration_seconds"])}')
+        lines.append(f'tutti_request_duration_seconds_count{{view="{view}"}} {total["count"]}')
+
+    counters = (
+        ('tutti_request_db_queries_total', 'Database queries run by the requests.', 'db_queries'),
+        ('tutti_request_db_seconds_total', 'Time spent in the database by the requests.', 'db_seconds'),
+        ('tutti_request_errors_total', 'Requests answered with a 5xx status.', 'errors'),
+    )
+    for name, help_text, field in counters:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for view, entry in report.items():
+            lines.append(f'{name}{{view="{view}"}} {_number(entry["total"][field])}')
+
+    name = 'tutti_request_duration_quantile_seconds'
+    lines += [f'# HELP {name} Request wall time percentiles over the last {WINDOW_MINUTES} minutes, '
+              'estimated from the histogram buckets.', f'# TYPE {name} gauge']
+    for view, entry in report.items():
+        for q, value in entry['quantiles'].items():
+            lines.append(f'{name}{{view="{view}",quantile="{q}"}} {_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+# --- Logging ---
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, plus the record's `data` (extra={'data': {...}})."""
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'data', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
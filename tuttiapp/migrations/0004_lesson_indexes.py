@@ -0,0 +1,33 @@
+# Generated by Django 5.2.9 on 2026-10-18 18:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tuttiapp', '0003_alter_lesson_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['teacher', 'start_time'], name='lesson_teacher_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['student', 'start_time'], name='lesson_student_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['teacher', 'status', 'start_time'], name='lesson_teacher_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['status', 'start_time'], name='lesson_status_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(condition=models.Q(('is_student_reminder_sent', False), ('status', 'SCHEDULED')), fields=['start_time'], name='lesson_reminder_due_idx'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 5.2.9 on 2026-10-18 18:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+
+
+def backfill_admin_stats(apps, schema_editor):
+    User = apps.get_model('tuttiapp', 'User')
+    MpesaTransaction = apps.get_model('tuttiapp', 'MpesaTransaction')
+    PlatformCounter = apps.get_model('tuttiapp', 'PlatformCounter')
+    DailyTeacherRevenue = apps.get_model('tuttiapp', 'DailyTeacherRevenue')
+
+    users = User.objects.aggregate(
+        students=Count('pk', filter=Q(is_student=True)),
+        teachers=Count('pk', filter=Q(is_teacher=True)),
+    )
+    paid = MpesaTransaction.objects.filter(is_successful=True)
+    PlatformCounter.objects.bulk_create([
+        PlatformCounter(name='students', value=users['students']),
+        PlatformCounter(name='teachers', value=users['teachers']),
+        PlatformCounter(name='revenue', value=paid.aggregate(total=Sum('amount'))['total'] or 0),
+    ])
+    DailyTeacherRevenue.objects.bulk_create([
+        DailyTeacherRevenue(day=row['day'], teacher_id=row['lesson__teacher'], amount=row['amount'], payments=row['payments'])
+        for row in paid.annotate(day=TruncDate('transaction_date'))
+        .values('day', 'lesson__teacher')
+        .annotate(amount=Sum('amount'), payments=Count('pk'))
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('tuttiapp', '0004_lesson_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyTeacherRevenue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('payments', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PlatformCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('value', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='mpesatransaction',
+            name='transaction_date',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['-date_joined'], name='user_date_joined_idx'),
+        ),
+        migrations.AddField(
+            model_name='dailyteacherrevenue',
+            name='teacher',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='daily_revenue', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyteacherrevenue',
+            constraint=models.UniqueConstraint(fields=('day', 'teacher'), name='daily_revenue_day_teacher_uniq'),
+        ),
+        migrations.RunPython(backfill_admin_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,88 @@
+from django.db import migrations
+
+# Search indexes for the admin user search (tuttiapp/search.py).
+# These are engine specific, so they are plain SQL run only on the matching database.
+
+SEARCH_FIELDS = ('username', 'email', 'phone_number')
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE tuttiapp_user_search USING fts5(
+        username, email, phone_number,
+        content='tuttiapp_user', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER tuttiapp_user_search_ai AFTER INSERT ON tuttiapp_user BEGIN
+        INSERT INTO tuttiapp_user_search(rowid, username, email, phone_number)
+        VALUES (new.id, new.username, new.email, new.phone_number);
+    END
+    """,
+    """
+    CREATE TRIGGER tuttiapp_user_search_ad AFTER DELETE ON tuttiapp_user BEGIN
+        INSERT INTO tuttiapp_user_search(tuttiapp_user_search, rowid, username, email, phone_number)
+        VALUES ('delete', old.id, old.username, old.email, old.phone_number);
+    END
+    """,
+    """
+    CREATE TRIGGER tuttiapp_user_search_au AFTER UPDATE OF username, email, phone_number ON tuttiapp_user BEGIN
+        INSERT INTO tuttiapp_user_search(tuttiapp_user_search, rowid, username, email, phone_number)
+        VALUES ('delete', old.id, old.username, old.email, old.phone_number);
+        INSERT INTO tuttiapp_user_search(rowid, username, email, phone_number)
+        VALUES (new.id, new.username, new.email, new.phone_number);
+    END
+    """,
+    "INSERT INTO tuttiapp_user_search(tuttiapp_user_search) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS tuttiapp_user_search_ai",
+    "DROP TRIGGER IF EXISTS tuttiapp_user_search_ad",
+    "DROP TRIGGER IF EXISTS tuttiapp_user_search_au",
+    "DROP TABLE IF EXISTS tuttiapp_user_search",
+]
+
+# icontains on Postgres compiles to UPPER(col::text) LIKE UPPER(%s), so index that expression
+POSTGRES_FORWARD = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] + [
+    f'CREATE INDEX IF NOT EXISTS user_{field}_trgm_idx ON tuttiapp_user USING gin (UPPER("{field}"::text) gin_trgm_ops)'
+    for field in SEARCH_FIELDS
+]
+
+POSTGRES_BACKWARD = [f"DROP INDEX IF EXISTS user_{field}_trgm_idx" for field in SEARCH_FIELDS]
+
+
+def sqlite_has_fts5(cursor):
+    cursor.execute("PRAGMA compile_options")
+    return any('ENABLE_FTS5' in row[0] for row in cursor.fetchall())
+
+
+def create_search_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite' and sqlite_has_fts5(cursor):
+            statements = SQLITE_FORWARD
+        elif connection.vendor == 'postgresql':
+            statements = POSTGRES_FORWARD
+        else:
+            return  # tuttiapp.search falls back to a bounded icontains scan
+        for sql in statements:
+            cursor.execute(sql)
+
+
+def drop_search_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    statements = {'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}.get(connection.vendor, [])
+    with connection.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tuttiapp', '0005_admin_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
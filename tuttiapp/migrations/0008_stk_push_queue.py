@@ -0,0 +1,28 @@
+# Generated by Django 5.2.9 on 2026-10-18 18:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tuttiapp', '0007_mpesa_callback_inbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='push_error',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='push_status',
+            field=models.CharField(choices=[('QUEUED', 'Queued'), ('SENT', 'Sent'), ('REJECTED', 'Rejected')], default='SENT', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='mpesatransaction',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tuttiapp', '0008_stk_push_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lesson',
+            name='reminder_claim',
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.9 on 2026-10-18 18:41
+
+import django.core.validators
+import datetime
+
+from django.db import migrations, models
+
+
+def backfill_end_time(apps, schema_editor):
+    Lesson = apps.get_model('tuttiapp', 'Lesson')
+    batch = []
+    for lesson in Lesson.objects.filter(end_time__isnull=True).only('id', 'start_time', 'duration_minutes').iterator(chunk_size=2000):
+        lesson.end_time = lesson.start_time + datetime.timedelta(minutes=lesson.duration_minutes)
+        batch.append(lesson)
+        if len(batch) >= 2000:
+            Lesson.objects.bulk_update(batch, ['end_time'])
+            batch = []
+    if batch:
+        Lesson.objects.bulk_update(batch, ['end_time'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tuttiapp', '0009_lesson_reminder_claim'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lesson',
+            name='end_time',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='lesson',
+            name='duration_minutes',
+            field=models.PositiveIntegerField(default=60, validators=[django.core.validators.MaxValueValidator(480)]),
+        ),
+        migrations.RunPython(backfill_end_time, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.9 on 2026-10-18 18:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Q
+
+
+def backfill_teacher_cards(apps, schema_editor):
+    # next_free_slot is left empty here; `manage.py refresh_teacher_cards` fills it in
+    User = apps.get_model('tuttiapp', 'User')
+    TeacherCard = apps.get_model('tuttiapp', 'TeacherCard')
+    teachers = User.objects.filter(is_teacher=True).annotate(
+        taught=Count('lessons_taught', filter=Q(lessons_taught__status__in=('COMPLETED', 'PENDING_PAYMENT', 'PAID'))),
+        min_price=Min('lessons_taught__price'),
+        max_price=Max('lessons_taught__price'),
+    )
+    TeacherCard.objects.bulk_create([
+        TeacherCard(teacher_id=t.pk, lessons_taught=t.taught, min_price=t.min_price, max_price=t.max_price)
+        for t in teachers.iterator(chunk_size=2000)
+    ], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tuttiapp', '0010_lesson_end_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeacherCard',
+            fields=[
+                ('teacher', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='card', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('lessons_taught', models.PositiveIntegerField(default=0)),
+                ('next_free_slot', models.DateTimeField(blank=True, null=True)),
+                ('min_price', models.DecimalField(blank=True, decimal_places=2, max_digits=8, null=True)),
+                ('max_price', models.DecimalField(blank=True, decimal_places=2, max_digits=8, null=True)),
+                ('topics', models.TextField(blank=True)),
+                ('version', models.PositiveIntegerField(default=1)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-lessons_taught', 'teacher'], name='card_popular_idx'), models.Index(fields=['next_free_slot'], name='card_next_free_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_teacher_cards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:01
+
+import django.core.validators
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tuttiapp', '0011_teacher_cards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LessonSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('topic', models.CharField(max_length=200)),
+                ('price', models.DecimalField(decimal_places=2, default=1500.0, max_digits=8)),
+                ('duration_minutes', models.PositiveIntegerField(default=60, validators=[django.core.validators.MaxValueValidator(480)])),
+                ('first_start', models.DateTimeField()),
+                ('interval_weeks', models.PositiveSmallIntegerField(choices=[(1, 'Every week'), (2, 'Every two weeks')], default=1)),
+                ('occurrences', models.PositiveSmallIntegerField(validators=[django.core.validators.MaxValueValidator(52)])),
+                ('status', models.CharField(choices=[('REQUESTED', 'Requested'), ('ACTIVE', 'Active'), ('CANCELLED', 'Cancelled')], default='REQUESTED', max_length=10)),
+                ('materialized_count', models.PositiveSmallIntegerField(default=0)),
+                ('next_start', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='series_taken', to=settings.AUTH_USER_MODEL)),
+                ('teacher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='series_taught', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'lesson series',
+            },
+        ),
+        migrations.AddField(
+            model_name='lesson',
+            name='series',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='lessons', to='tuttiapp.lessonseries'),
+        ),
+        migrations.AddConstraint(
+            model_name='lesson',
+            constraint=models.UniqueConstraint(fields=('series', 'start_time'), name='lesson_series_occurrence_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='lessonseries',
+            index=models.Index(condition=models.Q(('next_start__isnull', False), ('status__in', ['REQUESTED', 'ACTIVE'])), fields=['next_start'], name='series_due_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.9 on 2026-10-18 21:02
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def merge_unassigned_revenue(apps, schema_editor):
+    # Rows left behind by deleted teachers could repeat a day; fold each day into one row
+    DailyTeacherRevenue = apps.get_model('tuttiapp', 'DailyTeacherRevenue')
+    unassigned = DailyTeacherRevenue.objects.filter(teacher=None)
+    for row in unassigned.values('day').annotate(rows=Count('pk'), total=Sum('amount'), paid=Sum('payments')).filter(rows__gt=1):
+        keep = unassigned.filter(day=row['day']).order_by('pk').first()
+        unassigned.filter(day=row['day']).exclude(pk=keep.pk).delete()
+        unassigned.filter(pk=keep.pk).update(amount=row['total'], payments=row['paid'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tuttiapp', '0014_user_deletion_requested_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_unassigned_revenue, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='dailyteacherrevenue',
+            constraint=models.UniqueConstraint(condition=models.Q(('teacher__isnull', True)), fields=('day',), name='daily_revenue_day_unassigned_uniq'),
+        ),
+    ]
@@ -2,6 +2,13 @@ from django.db import models # to define database models for the app
 from django.contrib.auth.models import AbstractUser # to extend the default user model which comes with django
 from django.conf import settings # to reference the custom user model wehn defining relationships
 from django.core.exceptions import ValidationError # to raise validation errors when phone number is invalid. the number must be in the format 2547XXXXXXXX
+from django.core.validators import MaxValueValidator
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+from django.dispatch import Signal # lesson_transitioned
+from django.utils import timezone
+from .cache import USER, invalidate # versioned cache entries (tuttiapp/cache.py)
+import datetime
 import re # for regex validation for phone numbers when saving users at signup for M-Pesa payments
 
 #EVERY TIME YOU ADD A NEW MODE MAKE SURE TO RUN:
@@ -11,10 +18,15 @@ import re # for regex validation for phone numbers when saving users at signup f
 
 # --- 1. THE HELPER (Phone Sanitizer) ---
 # This ensures that if a user enters "0712..." it saves as "254712..."
-def validate_kenyan_phone(value):
+def normalize_kenyan_phone(value):
+    # Only the clean-up half of validate_kenyan_phone: also safe on partial numbers like "0712"
     value = str(value).replace("+", "").replace(" ", "").replace("-", "")
     if value.startswith("07") or value.startswith("01"):
         value = "254" + value[1:]
+    return value
+
+def validate_kenyan_phone(value):
+    value = normalize_kenyan_phone(value)
     if not re.match(r"^254\d{9}$", value):
         raise ValidationError(f"{value} is not a valid M-Pesa number. Use format 2547XXXXXXXX")
     return value
@@ -32,6 +44,26 @@ class User(AbstractUser):
     is_teacher = models.BooleanField(default=False)
     is_student = models.BooleanField(default=False)
     phone_number = models.CharField(max_length=15, blank=True, null=True, validators=[validate_kenyan_phone])
+    # Set when an admin deletes a user with too much history to delete inline: the account is
+    # disabled at once and `manage.py purge_deleted_users` clears it out later (tuttiapp/deletion.py)
+    deletion_requested_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # "New Users" table on the admin dashboard
+            models.Index(fields=['-date_joined'], name='user_date_joined_idx'),
+            # The purge worker's queue
+            models.Index(fields=['deletion_requested_at'], name='user_deletion_due_idx',
+                         condition=models.Q(deletion_requested_at__isnull=False)),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # Remember the roles as loaded, so the admin stats counters can tell a role change apart
+        # from a plain profile save (see tuttiapp/signals.py).
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_roles = (instance.__dict__.get('is_student'), instance.__dict__.get('is_teacher'))
+        return instance
 
     def save(self, *args, **kwargs):
         if self.phone_number:
@@ -44,6 +76,8 @@ class User(AbstractUser):
                 pass
         
         super().save(*args, **kwargs)
+        # Retire everything cached for this user, including the logged-in user cached by tuttiapp/auth.py
+        invalidate(USER, self.pk)
     
     
 '''
@@ -53,6 +87,64 @@ The phone number is validated to ensure it is in the correct format for M-Pesa t
 '''
 
 # --- 3. THE LESSON (The Core Logic) ---
+class LessonQuerySet(models.QuerySet):
+    # Only the columns the dashboard lesson table actually renders.
+    # Keep this in sync with tuttiapp/dashboard.html if the table grows a new column.
+    FEED_FIELDS = (
+        'id', 'start_time', 'topic', 'status', 'series_id',
+        'teacher_id', 'teacher__username',
+        'student_id', 'student__username',
+    )
+
+    def feed(self):
+        """
+        Lessons ready for listing: teacher and student are joined in the same
+        query so the template can show `lesson.student.username` without an
+        extra query per row, and the unused columns (notes, price...) are skipped.
+        """
+        return self.select_related('teacher', 'student').only(*self.FEED_FIELDS)
+
+    def for_teacher(self, user):
+        return self.filter(teacher=user)
+
+    def for_student(self, user):
+        return self.filter(student=user)
+
+    # Dashboard segments: "upcoming" reads forward from now, "history" reads backwards.
+    def upcoming(self, now):
+        return self.filter(start_time__gte=now)
+
+    def history(self, now):
+        return self.filter(start_time__lt=now)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create skips save(), so fill in the computed end time here too
+        objs = list(objs)
+        for lesson in objs:
+            lesson.set_end_time()
+        return super().bulk_create(objs, *args, **kwargs)
+
+
+# Upper bound on a lesson's length. The double-booking check relies on it to only look at
+# lessons starting at most this long before the slot (see tuttiapp/scheduling.py).
+MAX_LESSON_MINUTES = 8 * 60
+
+
+# Sent after every successful Lesson.transition() (and for each lesson of a bulk action), with
+# lesson, from_status and to_status. The status is written with update(), which doesn't send
+# post_save, so receivers of this do the bookkeeping (see tuttiapp/signals.py).
+# `lesson` can be a partial instance: only pk, teacher_id and status are guaranteed.
+lesson_transitioned = Signal()
+
+
+class InvalidTransition(ValueError):
+    def __init__(self, lesson, to_status):
+        self.lesson = lesson
+        self.current = lesson.status
+        self.to_status = to_status
+        super().__init__(f"Lesson {lesson.pk} can't go from {lesson.status} to {to_status}")
+
+
 class Lesson(models.Model):
     STATUS_CHOICES = [
         ('REQUESTED', 'Requested'),  # Student requested a lesson
@@ -68,7 +160,9 @@ class Lesson(models.Model):
     student = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='lessons_taken')
     
     start_time = models.DateTimeField()
-    duration_minutes = models.PositiveIntegerField(default=60)
+    duration_minutes = models.PositiveIntegerField(default=60, validators=[MaxValueValidator(MAX_LESSON_MINUTES)])
+    # start_time + duration_minutes, kept by save() so overlap checks are a plain indexed range query
+    end_time = models.DateTimeField(blank=True, null=True, editable=False)
     
     topic = models.CharField(max_length=200, help_text="What are you teaching? e.g. Major Scales")
     teacher_notes = models.TextField(blank=True, help_text="Notes for the student to practice")
@@ -76,21 +170,377 @@ class Lesson(models.Model):
     price = models.DecimalField(max_digits=8, decimal_places=2, default=1500.00)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='SCHEDULED')
 
+    # The legal status changes. Change the status only through transition(), never by
+    # assigning lesson.status and saving.
+    TRANSITIONS = {
+        'REQUESTED': ('SCHEDULED', 'CANCELLED'),
+        'SCHEDULED': ('RESCHEDULE_PENDING', 'COMPLETED', 'PENDING_PAYMENT', 'CANCELLED'),
+        'RESCHEDULE_PENDING': ('SCHEDULED', 'RESCHEDULE_PENDING', 'CANCELLED'),
+        'COMPLETED': ('PENDING_PAYMENT', 'PAID'),
+        'PENDING_PAYMENT': ('PAID',),
+        'PAID': (),
+        'CANCELLED': (),
+    }
+    TRANSITION_ATTEMPTS = 3
+    # Reaching any of these means the lesson took place (completed_at is set the first time)
+    TAUGHT_STATUSES = ('COMPLETED', 'PENDING_PAYMENT', 'PAID')
+
+    # For the analytics rollups (tuttiapp/rollups.py): updated_at is their watermark, and
+    # completed_at -> paid_at is the completion-to-payment latency. Lesson.transition() keeps them.
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(blank=True, null=True, editable=False)
+    paid_at = models.DateTimeField(blank=True, null=True, editable=False)
+
+    # Set for lessons created from a recurring booking (tuttiapp/series.py)
+    series = models.ForeignKey('LessonSeries', on_delete=models.SET_NULL, blank=True, null=True, related_name='lessons')
+
     # Reminders to notify students when almost class time
     is_student_reminder_sent = models.BooleanField(default=False)
+    # Set together with is_student_reminder_sent by the sweeper that claimed the reminder (tuttiapp/reminders.py)
+    reminder_claim = models.UUIDField(blank=True, null=True, editable=False)
+
+    objects = LessonQuerySet.as_manager()
+
+    class Meta:
+        # Matched to the hot access paths (see `manage.py bench_lesson_indexes`):
+        indexes = [
+            # dashboard feeds: one user's lessons, paged by time
+            models.Index(fields=['teacher', 'start_time'], name='lesson_teacher_start_idx'),
+            models.Index(fields=['student', 'start_time'], name='lesson_student_start_idx'),
+            # a teacher's lessons in one state (e.g. everything waiting for approval)
+            models.Index(fields=['teacher', 'status', 'start_time'], name='lesson_teacher_status_idx'),
+            # admin list_filter on status, ordered/filtered by start_time
+            models.Index(fields=['status', 'start_time'], name='lesson_status_start_idx'),
+            # reminder sweeps only ever look at scheduled lessons nobody was reminded about yet
+            models.Index(
+                fields=['start_time'],
+                name='lesson_reminder_due_idx',
+                condition=models.Q(status='SCHEDULED', is_student_reminder_sent=False),
+            ),
+            # the analytics refresh reads only the lessons changed since its last run
+            models.Index(fields=['updated_at'], name='lesson_updated_idx'),
+        ]
+        constraints = [
+            # one lesson per occurrence, so a series can't be expanded twice
+            models.UniqueConstraint(fields=['series', 'start_time'], name='lesson_series_occurrence_unique'),
+        ]
+
+    def set_end_time(self):
+        if self.start_time is not None:
+            self.end_time = self.start_time + datetime.timedelta(minutes=self.duration_minutes or 0)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # Remember where the lesson was, so the analytics rollups can redo the day it moved away from
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_start_time = instance.__dict__.get('start_time')
+        return instance
+
+    def save(self, *args, **kwargs):
+        self.set_end_time()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields) | {'updated_at'}
+            if {'start_time', 'duration_minutes'} & update_fields:
+                update_fields.add('end_time')
+            kwargs['update_fields'] = update_fields
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def status_columns(cls, to_status):
+        """The bookkeeping columns to write along with a status change made with update()."""
+        now = timezone.now()
+        columns = {'updated_at': now}
+        if to_status in cls.TAUGHT_STATUSES:
+            columns['completed_at'] = Coalesce(F('completed_at'), Value(now))
+        if to_status == 'PAID':
+            columns['paid_at'] = now
+        return columns
+
+    @classmethod
+    def sources(cls, to_status):
+        """The statuses a lesson can move to `to_status` from."""
+        return tuple(status for status, targets in cls.TRANSITIONS.items() if to_status in targets)
+
+    def can_transition(self, to_status):
+        return to_status in self.TRANSITIONS.get(self.status, ())
+
+    def transition(self, to_status, *fields, retry=False):
+        """
+        Moves the lesson to `to_status` with a compare-and-set:
+            UPDATE ... SET status = <to_status>, <fields> WHERE id = <pk> AND status = <self.status>
+        so only the status and the named `fields` (already set on the instance) are written, and a
+        concurrent change of status is never overwritten.
+
+        Raises InvalidTransition when the edge isn't in TRANSITIONS, or when another request changed
+        the status first. With retry=True (for facts like a received payment) it tries again from
+        the new status as long as the edge is still legal.
+        """
+        fields = set(fields)
+        if fields & {'start_time', 'duration_minutes'}:
+            self.set_end_time()
+            fields.add('end_time')
+        values = {field: getattr(self, field) for field in fields}
+        values.update(self.status_columns(to_status))
+
+        for _ in range(self.TRANSITION_ATTEMPTS):
+            if not self.can_transition(to_status):
+                raise InvalidTransition(self, to_status)
+            if Lesson.objects.filter(pk=self.pk, status=self.status).update(status=to_status, **values):
+                break
+            # Lost the race: find out what the status is now
+            current = Lesson.objects.filter(pk=self.pk).values_list('status', flat=True).first()
+            if current is None:
+                raise Lesson.DoesNotExist(f"Lesson {self.pk} was deleted")
+            self.status = current
+            if not retry:
+                raise InvalidTransition(self, to_status)
+        else:
+            raise InvalidTransition(self, to_status)
+
+        from_status, self.status = self.status, to_status
+        self.updated_at = values['updated_at']
+        lesson_transitioned.send(sender=Lesson, lesson=self, from_status=from_status, to_status=to_status)
 
     def __str__(self):
         return f"{self.topic} ({self.student.username})"
 
+# --- 3b. RECURRING LESSONS ---
+class LessonSeries(models.Model):
+    """
+    A weekly (or every-other-week) booking with the same teacher.
+    Its lessons are created a few weeks ahead at a time by tuttiapp/series.py, never all at once;
+    materialized_count says how many occurrences have been handled so far, and next_start when
+    the next one is (empty once they all have).
+    """
+    REQUESTED = 'REQUESTED'  # waiting for the teacher; its lessons are REQUESTED too
+    ACTIVE = 'ACTIVE'        # approved; new lessons are created SCHEDULED
+    CANCELLED = 'CANCELLED'
+    STATUS_CHOICES = [
+        (REQUESTED, 'Requested'),
+        (ACTIVE, 'Active'),
+        (CANCELLED, 'Cancelled'),
+    ]
+    INTERVAL_CHOICES = [
+        (1, 'Every week'),
+        (2, 'Every two weeks'),
+    ]
+    MAX_OCCURRENCES = 52
+
+    teacher = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='series_taught')
+    student = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='series_taken')
+    topic = models.CharField(max_length=200)
+    price = models.DecimalField(max_digits=8, decimal_places=2, default=1500.00)
+    duration_minutes = models.PositiveIntegerField(default=60, validators=[MaxValueValidator(MAX_LESSON_MINUTES)])
+
+    first_start = models.DateTimeField()
+    interval_weeks = models.PositiveSmallIntegerField(choices=INTERVAL_CHOICES, default=1)
+    occurrences = models.PositiveSmallIntegerField(validators=[MaxValueValidator(MAX_OCCURRENCES)])
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=REQUESTED)
+
+    materialized_count = models.PositiveSmallIntegerField(default=0)
+    next_start = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = 'lesson series'
+        indexes = [
+            # the materializer only looks at live series with occurrences still to create
+            models.Index(
+                fields=['next_start'],
+                name='series_due_idx',
+                condition=models.Q(status__in=['REQUESTED', 'ACTIVE'], next_start__isnull=False),
+            ),
+        ]
+
+    def occurrence(self, n):
+        """Start of the n-th lesson (from 0), or None past the end of the series."""
+        if n >= self.occurrences:
+            return None
+        # Fixed weekly steps in UTC (Kenya has no daylight saving, so the local time stays put)
+        return self.first_start + datetime.timedelta(weeks=self.interval_weeks * n)
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.next_start is None:
+            self.next_start = self.first_start
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.topic} x{self.occurrences} ({self.get_interval_weeks_display().lower()})"
+
 # --- 4. THE MONEY (M-Pesa) ---
 class MpesaTransaction(models.Model):
+    # Where the STK push itself is (the payment result comes later, from the callback)
+    PUSH_QUEUED = 'QUEUED'      # waiting for the background push worker
+    PUSH_SENT = 'SENT'          # Safaricom accepted it, the phone is showing the PIN prompt
+    PUSH_REJECTED = 'REJECTED'  # Safaricom refused it or could not be reached
+    PUSH_STATUS_CHOICES = [
+        (PUSH_QUEUED, 'Queued'),
+        (PUSH_SENT, 'Sent'),
+        (PUSH_REJECTED, 'Rejected'),
+    ]
+
     lesson = models.OneToOneField(Lesson, on_delete=models.CASCADE, related_name='transaction')
-    checkout_request_id = models.CharField(max_length=100, unique=True)
+    # Empty until Safaricom accepts the STK push
+    checkout_request_id = models.CharField(max_length=100, unique=True, blank=True, null=True)
+    push_status = models.CharField(max_length=10, choices=PUSH_STATUS_CHOICES, default=PUSH_SENT)
+    push_error = models.CharField(max_length=255, blank=True)
     phone_number = models.CharField(max_length=15)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     mpesa_receipt_number = models.CharField(max_length=20, blank=True, null=True)
     is_successful = models.BooleanField(default=False)
-    transaction_date = models.DateTimeField(auto_now_add=True)
+    transaction_date = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Filled in from Safaricom's callback. A non-null result_code means the callback was applied.
+    result_code = models.IntegerField(blank=True, null=True)
+    result_desc = models.CharField(max_length=255, blank=True)
+
+    @property
+    def payment_state(self):
+        """One word for the pay page: queued, waiting_for_pin, paid or failed."""
+        if self.is_successful:
+            return 'paid'
+        if self.push_status == self.PUSH_REJECTED or self.result_code is not None:
+            return 'failed'
+        if self.push_status == self.PUSH_QUEUED:
+            return 'queued'
+        return 'waiting_for_pin'
+
+    def __str__(self):
+        return f"Tx for Lesson {self.lesson.id}" #shows which lesson this transaction is for then its id
+
+
+class MpesaCallback(models.Model):
+    """
+    Inbox of raw callbacks from Safaricom. The callback view only appends here and returns;
+    `manage.py process_mpesa_callbacks` applies them to the transactions in batches.
+    """
+    PENDING = 'PENDING'
+    PROCESSED = 'PROCESSED'
+    DUPLICATE = 'DUPLICATE'  # a retry of a callback we already applied
+    FAILED = 'FAILED'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (PROCESSED, 'Processed'),
+        (DUPLICATE, 'Duplicate'),
+        (FAILED, 'Failed'),
+    ]
+
+    checkout_request_id = models.CharField(max_length=100, blank=True, db_index=True)
+    raw_body = models.TextField() # kept exactly as received, so any callback can be replayed
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # the worker only ever reads the pending rows, oldest first
+            models.Index(fields=['id'], name='mpesa_callback_pending_idx', condition=models.Q(status='PENDING')),
+        ]
+
+    def __str__(self):
+        return f"Callback {self.checkout_request_id or '?'} ({self.status})"
+
+
+# --- 4b. THE MARKETPLACE (Teacher Cards) ---
+class TeacherCard(models.Model):
+    """
+    Precomputed summary shown on the "Find a Conductor" page, one row per teacher.
+    Refreshed whenever one of the teacher's lessons changes (tuttiapp/marketplace.py), so the
+    marketplace never aggregates over Lesson while rendering. `version` goes up on every
+    refresh and is part of the card's fragment-cache key.
+    """
+    teacher = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='card')
+    lessons_taught = models.PositiveIntegerField(default=0)
+    next_free_slot = models.DateTimeField(blank=True, null=True)
+    min_price = models.DecimalField(max_digits=8, decimal_places=2, blank=True, null=True)
+    max_price = models.DecimalField(max_digits=8, decimal_places=2, blank=True, null=True)
+    topics = models.TextField(blank=True) # recent lesson topics, for the keyword filter
+    version = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-lessons_taught', 'teacher'], name='card_popular_idx'),
+            models.Index(fields=['next_free_slot'], name='card_next_free_idx'),
+        ]
+
+    def __str__(self):
+        return f"Card for teacher {self.teacher_id} (v{self.version})"
+
+
+# --- 5. THE ADMIN STATS (Running Totals) ---
+# The admin dashboard used to COUNT(*) the users and SUM() every payment on each load.
+# These tables keep the totals up to date as things happen instead (see tuttiapp/stats.py).
+class PlatformCounter(models.Model):
+    STUDENTS = 'students'
+    TEACHERS = 'teachers'
+    REVENUE = 'revenue'
+
+    name = models.CharField(max_length=50, unique=True)
+    value = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+
+class DailyTeacherRevenue(models.Model):
+    day = models.DateField()
+    teacher = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name='daily_revenue')
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    payments = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'teacher'], name='daily_revenue_day_teacher_uniq'),
+            # NULLs never clash in the constraint above, so payments whose teacher is gone need their own:
+            # one unassigned row per day (stats.release_teacher_revenue() folds a deleted teacher into it)
+            models.UniqueConstraint(fields=['day'], condition=models.Q(teacher__isnull=True), name='daily_revenue_day_unassigned_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} / {self.teacher_id}: KES {self.amount}"
+
+
+# --- 6. THE ANALYTICS ROLLUPS (tuttiapp/rollups.py) ---
+class DailyLessonRollup(models.Model):
+    """One teacher's lessons on one day (by start time), as of the last `manage.py refresh_rollups`."""
+    day = models.DateField()
+    teacher = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='daily_lessons')
+
+    # lessons per status
+    requested = models.PositiveIntegerField(default=0)
+    scheduled = models.PositiveIntegerField(default=0)
+    reschedule_pending = models.PositiveIntegerField(default=0)
+    completed = models.PositiveIntegerField(default=0)
+    pending_payment = models.PositiveIntegerField(default=0)
+    paid = models.PositiveIntegerField(default=0)
+    cancelled = models.PositiveIntegerField(default=0)
+
+    booked_minutes = models.PositiveIntegerField(default=0)  # everything but cancelled
+    taught_minutes = models.PositiveIntegerField(default=0)  # completed, pending payment or paid
+    # completion -> payment, over the lessons with both timestamps
+    payment_latency_seconds = models.BigIntegerField(default=0)
+    payment_latency_lessons = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'teacher'], name='daily_lesson_rollup_day_teacher_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} / {self.teacher_id}"
+
+
+class RollupDirtyDay(models.Model):
+    """Days to recompute that the updated_at watermark can't see: lessons deleted or moved away from them."""
+    day = models.DateField(unique=True)
+
+
+class RollupWatermark(models.Model):
+    """How far the last refresh got: lessons with updated_at after this are not in the rollups yet."""
+    name = models.CharField(max_length=30, primary_key=True)
+    value = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
-        return f"Tx for Lesson {self.lesson.id}" #shows which lesson this transaction is for then its id
\ No newline at end of file
+        return f"{self.name} @ {self.value}"
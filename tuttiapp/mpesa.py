@@ -0,0 +1,331 @@
+import asyncio
+import base64
+import threading
+import time
+import weakref
+from collections import deque
+from datetime import datetime
+
+import requests
+from django.conf import settings
+from django_daraja.mpesa.exceptions import MpesaConnectionError, MpesaError, MpesaInvalidParameterException
+from django_daraja.mpesa.utils import api_base_url, format_phone_number, mpesa_config, mpesa_response
+
+try:
+    import httpx
+except ImportError:  # optional: AsyncMpesaGateway falls back to a thread per call
+    httpx = None
+
+# Process-wide M-Pesa (Daraja) gateway.
+#
+# django_daraja's MpesaClient opens a new HTTPS connection for every call and reads its OAuth
+# token from the database each time (fetching a new one every ~50 minutes). This gateway keeps
+# one pooled requests.Session and the token in memory for the life of the process:
+#   - the token is refreshed a little before it expires (MPESA_TOKEN_REFRESH_MARGIN seconds),
+#   - only one thread fetches a new token while the others wait for it ("single flight"),
+#   - every call is timed, see MpesaGateway.metrics().
+# Besides STK pushes it can query how a push ended (stk_query, used by tuttiapp/reconciliation.py).
+# It returns the same MpesaResponse objects as MpesaClient, so callers don't change.
+# Point MPESA_API_BASE_URL at tuttiapp.daraja_stub to test or benchmark without Safaricom.
+#
+# AsyncMpesaGateway has the same calls as coroutines, for the async STK push path (tuttiapp/payments.py).
+# With httpx installed they go through a pooled httpx.AsyncClient, so no thread waits for Safaricom;
+# without it each call runs the sync gateway in a worker thread.
+
+TOKEN_REFRESH_MARGIN = 300  # seconds before expiry
+TOKEN_PATH = 'oauth/v1/generate?grant_type=client_credentials'
+STK_PUSH_PATH = 'mpesa/stkpush/v1/processrequest'
+STK_QUERY_PATH = 'mpesa/stkpushquery/v1/query'
+LATENCY_SAMPLES = 1000
+
+
+class MpesaGateway:
+    def __init__(self, base_url=None, timeout=None, pool_size=None, refresh_margin=None):
+        self.base_url = (base_url or getattr(settings, 'MPESA_API_BASE_URL', '') or api_base_url()).rstrip('/') + '/'
+        self.timeout = timeout or getattr(settings, 'MPESA_TIMEOUT', (3.05, 30))
+        self.refresh_margin = refresh_margin if refresh_margin is not None else getattr(settings, 'MPESA_TOKEN_REFRESH_MARGIN', TOKEN_REFRESH_MARGIN)
+
+        self.pool_size = pool_size or getattr(settings, 'MPESA_POOL_SIZE', 10)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._token = None
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self._metrics = {}
+
+    # --- OAuth token ---
+    def access_token(self):
+        if self._token_is_fresh():
+            return self._token
+        with self._token_lock:
+            # Another thread may have refreshed it while we waited for the lock
+            if self._token_is_fresh():
+                return self._token
+            self._store_token(self._request('token', 'GET', TOKEN_PATH, auth=_consumer_credentials()))
+            return self._token
+
+    def _token_is_fresh(self):
+        return self._token and time.monotonic() < self._token_expires_at - self.refresh_margin
+
+    def _store_token(self, response):
+        if response.status_code != 200:
+            raise MpesaError('Unable to generate access token')
+        data = response.json()
+        self._token = data['access_token']
+        self._token_expires_at = time.monotonic() + int(data.get('expires_in', 3599))
+
+    def invalidate_token(self):
+        with self._token_lock:
+            self._token = None
+
+    # --- Lipa na M-Pesa Online (STK push) ---
+    def stk_push(self, phone_number, amount, account_reference, transaction_desc, callback_url):
+        """Same arguments and result as django_daraja's MpesaClient.stk_push()."""
+        data = self._stk_push_data(phone_number, amount, account_reference, transaction_desc, callback_url)
+        return mpesa_response(self._authorized_post('stk_push', STK_PUSH_PATH, data))
+
+    def _stk_push_data(self, phone_number, amount, account_reference, transaction_desc, callback_url):
+        if str(account_reference).strip() == '':
+            raise MpesaInvalidParameterException('Account reference cannot be blank')
+        if str(transaction_desc).strip() == '':
+            raise MpesaInvalidParameterException('Transaction description cannot be blank')
+        if not isinstance(amount, int):
+            raise MpesaInvalidParameterException('Amount must be an integer')
+
+        phone_number = format_phone_number(phone_number)
+        short_code, password, timestamp = self._stk_credentials()
+        data = {
+            'BusinessShortCode': short_code,
+            'Password': password,
+            'Timestamp': timestamp,
+            'TransactionType': 'CustomerPayBillOnline',
+            'Amount': amount,
+            'PartyA': phone_number,
+            'PartyB': short_code,
+            'PhoneNumber': phone_number,
+            'CallBackURL': callback_url,
+            'AccountReference': account_reference,
+            'TransactionDesc': transaction_desc,
+        }
+        return data
+
+    def stk_query(self, checkout_request_id):
+        """
+        Asks how an STK push ended (for payments whose callback never came). The outcome is in
+        .result_code ('0' = paid) and .result_desc; while the push is still running Safaricom
+        answers with an .error_code instead and .result_code is ''.
+        """
+        return _with_query_result(mpesa_response(
+            self._authorized_post('stk_query', STK_QUERY_PATH, self._stk_query_data(checkout_request_id))
+        ))
+
+    def _stk_query_data(self, checkout_request_id):
+        short_code, password, timestamp = self._stk_credentials()
+        return {
+            'BusinessShortCode': short_code,
+            'Password': password,
+            'Timestamp': timestamp,
+            'CheckoutRequestID': checkout_request_id,
+        }
+
+    def _stk_credentials(self):
+        if mpesa_config('MPESA_ENVIRONMENT') == 'sandbox':
+            short_code = mpesa_config('MPESA_EXPRESS_SHORTCODE')
+        else:
+            short_code = mpesa_config('MPESA_SHORTCODE')
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode((short_code + mpesa_config('MPESA_PASSKEY') + timestamp).encode('ascii')).decode('utf-8')
+        return short_code, password, timestamp
+
+    def _authorized_post(self, operation, path, data):
+        response = self._request(operation, 'POST', path, json=data, headers={'Authorization': 'Bearer ' + self.access_token()})
+        if response.status_code == 401:
+            # Token revoked or expired early on Safaricom's side: fetch a new one and retry once
+            self.invalidate_token()
+            response = self._request(operation, 'POST', path, json=data, headers={'Authorization': 'Bearer ' + self.access_token()})
+        return response
+
+    def _request(self, operation, method, path, **kwargs):
+        started = time.perf_counter()
+        failed = False
+        try:
+            return self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+        except requests.exceptions.ConnectionError:
+            failed = True
+            raise MpesaConnectionError('Connection failed')
+        except requests.exceptions.RequestException as ex:
+            failed = True
+            raise MpesaConnectionError(str(ex))
+        finally:
+            self._record(operation, time.perf_counter() - started, failed)
+
+    # --- Metrics ---
+    def _record(self, operation, seconds, failed):
+        with self._metrics_lock:
+            entry = self._metrics.setdefault(operation, {'calls': 0, 'errors': 0, 'total_seconds': 0.0, 'samples': deque(maxlen=LATENCY_SAMPLES)})
+            entry['calls'] += 1
+            entry['errors'] += int(failed)
+            entry['total_seconds'] += seconds
+            entry['samples'].append(seconds)
+
+    def metrics(self):
+        """{operation: {calls, errors, mean_ms, p50_ms, p95_ms, p99_ms}} over the last LATENCY_SAMPLES calls."""
+        with self._metrics_lock:
+            snapshot = {op: dict(entry, samples=sorted(entry['samples'])) for op, entry in self._metrics.items()}
+        report = {}
+        for operation, entry in snapshot.items():
+            samples = entry['samples']
+
+            def pct(p):
+                return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 2) if samples else 0.0
+
+            report[operation] = {
+                'calls': entry['calls'],
+                'errors': entry['errors'],
+                'mean_ms': round(entry['total_seconds'] / entry['calls'] * 1000, 2),
+                'p50_ms': pct(0.50),
+                'p95_ms': pct(0.95),
+                'p99_ms': pct(0.99),
+            }
+        return report
+
+    def close(self):
+        self.session.close()
+
+
+def _consumer_credentials():
+    return mpesa_config('MPESA_CONSUMER_KEY'), mpesa_config('MPESA_CONSUMER_SECRET')
+
+
+def _with_query_result(response):
+    body = response.json()
+    response.result_code = str(body.get('ResultCode', ''))
+    response.result_desc = body.get('ResultDesc', '')
+    return response
+
+
+class AsyncMpesaGateway:
+    """
+    MpesaGateway's calls as coroutines. The token, the request bodies and the metrics are those
+    of the MpesaGateway it wraps (.gateway); only the HTTP calls differ. use_httpx=False forces
+    the thread fallback.
+    """
+    def __init__(self, base_url=None, timeout=None, pool_size=None, refresh_margin=None, use_httpx=None):
+        self.gateway = MpesaGateway(base_url=base_url, timeout=timeout, pool_size=pool_size, refresh_margin=refresh_margin)
+        self.client = None
+        if httpx is not None and use_httpx is not False:
+            connect, read = self.gateway.timeout if isinstance(self.gateway.timeout, tuple) else (self.gateway.timeout,) * 2
+            self.client = httpx.AsyncClient(
+                base_url=self.gateway.base_url,
+                timeout=httpx.Timeout(read, connect=connect),
+                limits=httpx.Limits(max_connections=self.gateway.pool_size, max_keepalive_connections=self.gateway.pool_size),
+            )
+        self._token_lock = asyncio.Lock()
+
+    async def access_token(self):
+        gateway = self.gateway
+        if gateway._token_is_fresh():
+            return gateway._token
+        async with self._token_lock:  # single flight, as in MpesaGateway
+            if gateway._token_is_fresh():
+                return gateway._token
+            gateway._store_token(await self._request('token', 'GET', TOKEN_PATH, auth=_consumer_credentials()))
+            return gateway._token
+
+    async def stk_push(self, phone_number, amount, account_reference, transaction_desc, callback_url):
+        if self.client is None:
+            return await asyncio.to_thread(self.gateway.stk_push, phone_number, amount, account_reference,
+                                           transaction_desc, callback_url)
+        data = self.gateway._stk_push_data(phone_number, amount, account_reference, transaction_desc, callback_url)
+        return mpesa_response(await self._authorized_post('stk_push', STK_PUSH_PATH, data))
+
+    async def stk_query(self, checkout_request_id):
+        if self.client is None:
+            return await asyncio.to_thread(self.gateway.stk_query, checkout_request_id)
+        return _with_query_result(mpesa_response(
+            await self._authorized_post('stk_query', STK_QUERY_PATH, self.gateway._stk_query_data(checkout_request_id))
+        ))
+
+    async def _authorized_post(self, operation, path, data):
+        response = await self._request(operation, 'POST', path, json=data,
+                                       headers={'Authorization': 'Bearer ' + await self.access_token()})
+        if response.status_code == 401:
+            self.gateway.invalidate_token()
+            response = await self._request(operation, 'POST', path, json=data,
+                                           headers={'Authorization': 'Bearer ' + await self.access_token()})
+        return response
+
+    async def _request(self, operation, method, path, **kwargs):
+        started = time.perf_counter()
+        failed = False
+        try:
+            response = await self.client.request(method, path, **kwargs)
+        except httpx.ConnectError:
+            failed = True
+            raise MpesaConnectionError('Connection failed')
+        except httpx.HTTPError as ex:
+            failed = True
+            raise MpesaConnectionError(str(ex))
+        finally:
+            self.gateway._record(operation, time.perf_counter() - started, failed)
+        return _as_requests_response(response)
+
+    def metrics(self):
+        return self.gateway.metrics()
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+        self.gateway.close()
+
+
+def _as_requests_response(response):
+    """mpesa_response() turns a requests.Response into an MpesaResponse: copy the httpx response into one."""
+    converted = requests.Response()
+    converted.status_code = response.status_code
+    converted._content = response.content
+    converted.headers = requests.structures.CaseInsensitiveDict(response.headers)
+    converted.encoding = response.encoding
+    converted.url = str(response.url)
+    return converted
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    """The shared gateway for this process (created on first use)."""
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = MpesaGateway()
+    return _gateway
+
+
+# One per event loop: an httpx client can't be used from a loop other than its own
+_async_gateways = weakref.WeakKeyDictionary()
+
+
+def get_async_gateway():
+    """The async gateway for the running event loop (created on first use)."""
+    loop = asyncio.get_running_loop()
+    with _gateway_lock:
+        if loop not in _async_gateways:
+            _async_gateways[loop] = AsyncMpesaGateway()
+        return _async_gateways[loop]
+
+
+def reset_gateway():
+    """Drops the shared gateways, e.g. after changing MPESA_* settings in tests."""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is not None:
+            _gateway.close()
+        _gateway = None
+        _async_gateways.clear()
@@ -0,0 +1,86 @@
+import base64
+import binascii
+from datetime import datetime
+
+from django.db.models import Q
+
+# Keyset ("cursor") pagination for the dashboard lesson table.
+# Instead of OFFSET (which makes the database walk and throw away every earlier row),
+# each page remembers the (start_time, id) of its last row and the next page asks for
+# rows strictly after it. Every page is one indexed range query, however deep the history.
+
+DEFAULT_PAGE_SIZE = 25
+
+
+def encode_cursor(start_time, pk):
+    raw = f"{start_time.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns (start_time, id) or None if the cursor is missing or has been tampered with."""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        stamp, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(stamp), int(pk)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+
+def keyset_paginate(queryset, cursor=None, descending=False, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Slice `queryset` by (start_time, id), oldest first (or newest first when `descending`).
+    We fetch one extra row to know whether there is a next page, so no COUNT(*) is needed.
+    """
+    rows = list(_page_query(queryset, cursor, descending, page_size))
+    return _page(rows, page_size)
+
+
+async def akeyset_paginate(queryset, cursor=None, descending=False, page_size=DEFAULT_PAGE_SIZE):
+    """keyset_paginate() for async views."""
+    rows = [row async for row in _page_query(queryset, cursor, descending, page_size)]
+    return _page(rows, page_size)
+
+
+def _page_query(queryset, cursor, descending, page_size):
+    position = decode_cursor(cursor)
+    if position:
+        start_time, pk = position
+        if descending:
+            after = Q(start_time__lt=start_time) | Q(start_time=start_time, id__lt=pk)
+        else:
+            after = Q(start_time__gt=start_time) | Q(start_time=start_time, id__gt=pk)
+        queryset = queryset.filter(after)
+
+    ordering = ('-start_time', '-id') if descending else ('start_time', 'id')
+    return queryset.order_by(*ordering)[:page_size + 1]
+
+
+def _page(rows, page_size):
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = encode_cursor(last.start_time, last.id)
+    return KeysetPage(rows, next_cursor)
@@ -0,0 +1,230 @@
+import asyncio
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from .cache import PAYMENT, aget_or_set, get_or_set, invalidate
+from .models import MpesaTransaction
+from .mpesa import get_async_gateway, get_gateway
+
+logger = logging.getLogger(__name__)
+
+# Non-blocking STK pushes.
+# initiate_payment only saves a QUEUED MpesaTransaction and hands its id to send_stk_push(),
+# which runs on a small thread pool (MPESA_PUSH_WORKERS threads; 0 = run inline) once the row is
+# committed. The pay page then polls payment_status, which is served from the cache, so a slow
+# Safaricom never holds a gunicorn worker.
+# With MPESA_PUSH_ASYNC=True the pushes run as asend_stk_push() coroutines on one event loop
+# thread instead: any number of them can wait for Safaricom at once without a thread each.
+# The queue only lives in the process's memory: a push lost there (the worker restarted between
+# the commit and the send) leaves its row QUEUED. After QUEUED_TIMEOUT initiate_payment lets the
+# student try again, and reconcile_payments --query-pending marks such pushes as failed.
+
+PAYMENT_STATUS_TIMEOUT = 30  # seconds; every write to the transaction invalidates it anyway
+QUEUED_TIMEOUT = datetime.timedelta(minutes=2)  # a push takes seconds; one still queued after this was lost
+
+_executor = None
+_loop = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.MPESA_PUSH_WORKERS, thread_name_prefix='stk-push')
+    return _executor
+
+
+def queue_stk_push(lesson, phone_number):
+    """
+    Creates (or resets, for a retry after a failure) the lesson's transaction as QUEUED and
+    schedules the push. Returns the transaction; its id is what the pay page polls.
+    """
+    amount = int(lesson.price)
+    with transaction.atomic():
+        mpesa_transaction, _created = MpesaTransaction.objects.update_or_create(
+            lesson=lesson,
+            defaults={
+                'phone_number': phone_number,
+                'amount': amount,
+                'push_status': MpesaTransaction.PUSH_QUEUED,
+                'push_error': '',
+                'checkout_request_id': None,
+                'result_code': None,
+                'result_desc': '',
+                'is_successful': False,
+                'mpesa_receipt_number': None,
+                'transaction_date': timezone.now(),  # this attempt's, for QUEUED_TIMEOUT and reconciliation
+            },
+        )
+        invalidate_payment_status(mpesa_transaction.pk)
+        transaction.on_commit(lambda: submit(mpesa_transaction.pk))
+    return mpesa_transaction
+
+
+def is_stale_push(mpesa_transaction, now=None):
+    """A push still QUEUED after QUEUED_TIMEOUT: it was lost before it reached Safaricom."""
+    return (mpesa_transaction.push_status == MpesaTransaction.PUSH_QUEUED
+            and mpesa_transaction.transaction_date < (now or timezone.now()) - QUEUED_TIMEOUT)
+
+
+def stale_pushes(now=None, older_than=QUEUED_TIMEOUT):
+    return MpesaTransaction.objects.filter(push_status=MpesaTransaction.PUSH_QUEUED,
+                                           transaction_date__lt=(now or timezone.now()) - older_than)
+
+
+def expire_stale_pushes(now=None, older_than=QUEUED_TIMEOUT):
+    """Marks lost pushes as failed, so the pay page says so and offers a retry. Returns how many."""
+    stale = stale_pushes(now, older_than)
+    transaction_ids = list(stale.values_list('pk', flat=True))
+    # Filtered again by the update itself: a student may retry (and reset the row) in between
+    expired = stale.filter(pk__in=transaction_ids).update(
+        push_status=MpesaTransaction.PUSH_REJECTED, push_error="The payment request was never sent. Please try again.",
+    )
+    for transaction_id in transaction_ids:
+        invalidate_payment_status(transaction_id)
+    return expired
+
+
+def submit(transaction_id):
+    if settings.MPESA_PUSH_ASYNC:
+        asyncio.run_coroutine_threadsafe(asend_stk_push(transaction_id), _get_loop())
+    elif settings.MPESA_PUSH_WORKERS <= 0:
+        send_stk_push(transaction_id)
+    else:
+        _get_executor().submit(_send_in_thread, transaction_id)
+
+
+def _get_loop():
+    """The event loop the async pushes run on, in its own daemon thread (started on first use)."""
+    global _loop
+    if _loop is None:
+        with _executor_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='stk-push-loop', daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+def _send_in_thread(transaction_id):
+    # Pool threads get their own DB connection; close it so it isn't leaked per thread
+    close_old_connections()
+    try:
+        send_stk_push(transaction_id)
+    finally:
+        connection.close()
+
+
+def send_stk_push(transaction_id):
+    try:
+        mpesa_transaction = MpesaTransaction.objects.select_related('lesson').get(pk=transaction_id)
+        updates = _push_outcome(get_gateway().stk_push(*_push_arguments(mpesa_transaction)))
+    except MpesaTransaction.DoesNotExist:
+        return  # deleted (with its lesson) before the push went out
+    except Exception as e:
+        updates = _push_failure(transaction_id, e)
+
+    # Only touch a push that is still queued (the student may have retried meanwhile)
+    MpesaTransaction.objects.filter(pk=transaction_id, push_status=MpesaTransaction.PUSH_QUEUED).update(**updates)
+    invalidate_payment_status(transaction_id)
+
+
+async def asend_stk_push(transaction_id):
+    """send_stk_push() on the event loop: no thread waits for Safaricom (see tuttiapp/mpesa.py)."""
+    try:
+        mpesa_transaction = await MpesaTransaction.objects.select_related('lesson').aget(pk=transaction_id)
+        updates = _push_outcome(await get_async_gateway().stk_push(*_push_arguments(mpesa_transaction)))
+    except MpesaTransaction.DoesNotExist:
+        return
+    except Exception as e:
+        updates = _push_failure(transaction_id, e)
+
+    await MpesaTransaction.objects.filter(pk=transaction_id, push_status=MpesaTransaction.PUSH_QUEUED).aupdate(**updates)
+    await sync_to_async(invalidate_payment_status)(transaction_id)
+
+
+def _push_arguments(mpesa_transaction):
+    lesson = mpesa_transaction.lesson
+    return (
+        mpesa_transaction.phone_number,
+        int(mpesa_transaction.amount),
+        f"Tutti-{lesson.id}",
+        f"Lesson: {lesson.topic}",
+        settings.MPESA_CALLBACK_URL,
+    )
+
+
+def _push_outcome(response):
+    if response.response_code == '0':
+        return {'push_status': MpesaTransaction.PUSH_SENT, 'checkout_request_id': response.checkout_request_id}
+    return {'push_status': MpesaTransaction.PUSH_REJECTED,
+            'push_error': f"M-Pesa Error: {response.response_description or response.error_message}"[:255]}
+
+
+def _push_failure(transaction_id, error):
+    logger.warning("STK push for transaction %s failed: %s", transaction_id, error)
+    return {'push_status': MpesaTransaction.PUSH_REJECTED, 'push_error': f"Error: {error}"[:255]}
+
+
+# --- Status for the pay page ---
+def get_payment_status(transaction_id):
+    """{'id', 'state', 'message', 'lesson_id', 'student_id', 'teacher_id'} or None if there is no such payment."""
+    return get_or_set(PAYMENT, transaction_id, 'status', lambda: _load_payment_status(transaction_id),
+                      PAYMENT_STATUS_TIMEOUT)
+
+
+async def aget_payment_status(transaction_id):
+    """get_payment_status() for the async views."""
+    return await aget_or_set(PAYMENT, transaction_id, 'status', lambda: _aload_payment_status(transaction_id),
+                             PAYMENT_STATUS_TIMEOUT)
+
+
+def _status_query(transaction_id):
+    return (
+        MpesaTransaction.objects.select_related('lesson')
+        .only('id', 'push_status', 'push_error', 'result_code', 'result_desc', 'is_successful',
+              'mpesa_receipt_number', 'lesson__id', 'lesson__student_id', 'lesson__teacher_id')
+        .filter(pk=transaction_id)
+    )
+
+
+def _load_payment_status(transaction_id):
+    return _status_of(_status_query(transaction_id).first())
+
+
+async def _aload_payment_status(transaction_id):
+    return _status_of(await _status_query(transaction_id).afirst())
+
+
+def _status_of(mpesa_transaction):
+    if mpesa_transaction is None:
+        return None
+    state = mpesa_transaction.payment_state
+    message = {
+        'queued': "Sending the payment request to your phone...",
+        'waiting_for_pin': "Check your phone and enter your M-Pesa PIN.",
+        'paid': f"Payment received ({mpesa_transaction.mpesa_receipt_number or 'receipt pending'}).",
+        'failed': mpesa_transaction.push_error or mpesa_transaction.result_desc or "Payment failed.",
+    }[state]
+    return {
+        'id': mpesa_transaction.pk,
+        'state': state,
+        'message': message,
+        'lesson_id': mpesa_transaction.lesson.id,
+        'student_id': mpesa_transaction.lesson.student_id,
+        'teacher_id': mpesa_transaction.lesson.teacher_id,
+    }
+
+
+def invalidate_payment_status(transaction_id):
+    """For writes that skip the MpesaTransaction signals (queryset.update())."""
+    invalidate(PAYMENT, transaction_id)
@@ -0,0 +1,70 @@
+import os
+import re
+import sys
+from collections import Counter
+from dataclasses import dataclass
+
+from django.template.base import Node, TokenType
+
+# Query budgets (used by ViewQueryBudgetTestCase in tuttiapp/tests.py).
+# Every URL name in tutti/urls.py declares how many queries one request may run: `base` plus
+# `per_row` for each row of the fixture (0 for every view today: a page must not cost more
+# because a user has more lessons). The test requests each view against a small and a large
+# fixture with QueryRecorder installed. It records where each query came from: the template
+# tag or variable that was rendering when it ran (the usual culprit is a lazy foreign key like
+# {{ lesson.student.username }} inside a {% for %}), or else the line of our own code. When a
+# view runs more queries for the large fixture, growth_report() lists the extra queries by origin.
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Frames from these files are the harness itself, not the code being measured
+_HARNESS_FILES = {os.path.join(APP_DIR, 'querybudget.py'), os.path.join(APP_DIR, 'tests.py')}
+# Savepoint names are unique per use: without this, no two runs would ever share their savepoint queries
+_SAVEPOINT_ID = re.compile(r'"s\d+_x\d+"')
+
+
+@dataclass(frozen=True)
+class Budget:
+    base: int
+    per_row: int = 0
+
+    def allows(self, rows):
+        return self.base + self.per_row * rows
+
+
+def query_origin(frame):
+    """'<template> line <n>: {{ ... }}' for the innermost template node on the stack, else 'file.py:<n>' of our code."""
+    code_line = None
+    while frame is not None:
+        node = frame.f_locals.get('self')
+        # type(), not isinstance(): that would evaluate lazy objects (request.user...) and run more queries
+        if issubclass(type(node), Node) and getattr(node, 'token', None) is not None and getattr(node, 'origin', None):
+            token = node.token
+            tag = f'{{{{ {token.contents} }}}}' if token.token_type == TokenType.VAR else f'{{% {token.contents} %}}'
+            return f'{node.origin.template_name} line {token.lineno}: {tag}'
+        filename = frame.f_code.co_filename
+        if code_line is None and filename.startswith(APP_DIR) and filename not in _HARNESS_FILES:
+            code_line = f'{os.path.relpath(filename, os.path.dirname(APP_DIR))}:{frame.f_lineno}'
+        frame = frame.f_back
+    return code_line or 'unknown'
+
+
+class QueryRecorder:
+    """connection.execute_wrapper() hook: remembers each query's SQL (without its parameters) and origin."""
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append((query_origin(sys._getframe(1)), _SAVEPOINT_ID.sub('"<savepoint>"', sql)))
+        return execute(sql, params, many, context)
+
+    def __len__(self):
+        return len(self.queries)
+
+
+def growth_report(small, large):
+    """The queries `large` ran more often than `small`, most repeated first, one line each with their origin."""
+    extra = Counter(large.queries) - Counter(small.queries)
+    lines = []
+    for (origin, sql), count in extra.most_common():
+        lines.append(f'  +{count} at {origin}\n      {sql[:200]}')
+    return '\n'.join(lines)
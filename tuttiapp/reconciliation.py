@@ -0,0 +1,322 @@
+import csv
+import datetime
+import logging
+import re
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Lesson, MpesaTransaction, lesson_transitioned
+from .mpesa import get_gateway
+from .payments import expire_stale_pushes, invalidate_payment_status, stale_pushes
+from .stats import record_payments
+
+logger = logging.getLogger(__name__)
+
+# Payment reconciliation (manage.py reconcile_payments).
+# A lost callback leaves an MpesaTransaction unpaid forever. This puts it right from either
+#   - a statement exported from the M-Pesa portal (CSV), matched on the receipt number, or else on
+#     the account reference "Tutti-<lesson id>" that send_stk_push() gives every payment, or
+#   - the STK push query API, asked about every push still waiting for its callback. Pushes that
+#     never left our queue (payments.QUEUED_TIMEOUT) are marked failed first, so they can be retried.
+# Statement lines are handled STATEMENT_CHUNK at a time: one query loads the chunk's transactions by
+# receipt and one by lesson, into dicts the lines are matched against, and the fixes are written with
+# one bulk_update per chunk. A statement of a few hundred thousand lines is a few hundred queries.
+#
+# Only unpaid transactions are ever changed. Anything that doesn't add up (a different amount or
+# receipt, a payment we know nothing about, a PAID lesson without a payment) is reported instead.
+
+STATEMENT_CHUNK = 2000
+QUERY_BATCH = 200
+QUERY_WORKERS = 4
+PENDING_AGE = datetime.timedelta(minutes=10)  # give the callback this long before asking
+MAX_REPORTED = 1000  # mismatches listed in the report; all of them are counted
+
+UNMATCHED = 'unmatched'                 # a statement payment with no transaction
+AMOUNT_MISMATCH = 'amount_mismatch'
+RECEIPT_CONFLICT = 'receipt_conflict'   # the transaction was paid under another receipt
+PAID_WITHOUT_PAYMENT = 'paid_without_payment'  # a PAID lesson with no successful transaction
+
+ACCOUNT_REFERENCE = re.compile(r'\bTutti-(\d+)\b', re.IGNORECASE)
+
+StatementLine = namedtuple('StatementLine', 'receipt amount lesson_id details')
+
+
+@dataclass
+class ReconciliationReport:
+    lines: int = 0      # statement lines read / pending pushes queried
+    matched: int = 0    # already right
+    fixed: int = 0      # marked paid by this run
+    failed: int = 0     # marked failed by this run (status query)
+    pending: int = 0    # still running, or the query itself failed
+    mismatch_counts: Counter = field(default_factory=Counter)
+    mismatches: list = field(default_factory=list)  # (kind, reference, detail), the first MAX_REPORTED
+    seconds: float = 0.0
+
+    def mismatch(self, kind, reference, detail=''):
+        self.mismatch_counts[kind] += 1
+        if len(self.mismatches) < MAX_REPORTED:
+            self.mismatches.append((kind, reference, detail))
+
+
+class ReconciliationError(ValueError):
+    pass
+
+
+# --- Statements ---
+def read_statement(lines):
+    """
+    Yields the completed incoming payments of a portal statement (CSV lines). Everything above the
+    "Receipt No." header (account details, period...) is skipped.
+    """
+    reader = csv.reader(lines)
+    for header in reader:
+        if 'Receipt No.' in header:
+            break
+    else:
+        raise ReconciliationError("No 'Receipt No.' header: is this an M-Pesa statement?")
+    columns = {name.strip(): i for i, name in enumerate(header)}
+    for name in ('Receipt No.', 'Paid In'):
+        if name not in columns:
+            raise ReconciliationError(f"Statement has no {name!r} column")
+
+    def cell(row, name):
+        i = columns.get(name)
+        return row[i].strip() if i is not None and i < len(row) else ''
+
+    for row in reader:
+        if not row or not cell(row, 'Receipt No.'):
+            continue
+        if cell(row, 'Transaction Status') not in ('', 'Completed'):
+            continue
+        try:
+            amount = Decimal(cell(row, 'Paid In').replace(',', '') or 0)
+        except InvalidOperation:
+            raise ReconciliationError(f"Bad amount {cell(row, 'Paid In')!r} for {cell(row, 'Receipt No.')}")
+        if amount <= 0:
+            continue  # withdrawals, charges
+        details = cell(row, 'Details')
+        reference = ACCOUNT_REFERENCE.search(cell(row, 'A/C No.') or details)
+        yield StatementLine(cell(row, 'Receipt No.'), amount, int(reference.group(1)) if reference else None, details)
+
+
+def reconcile_statement(lines, dry_run=False):
+    """Matches a statement (any iterable of CSV lines, e.g. an open file) against our transactions."""
+    started = time.perf_counter()
+    report = ReconciliationReport()
+    statement = read_statement(lines)
+    while True:
+        chunk = list(islice(statement, STATEMENT_CHUNK))
+        if not chunk:
+            break
+        _reconcile_chunk(chunk, report, dry_run)
+    report.seconds = time.perf_counter() - started
+    return report
+
+
+TX_COLUMNS = ('pk', 'lesson_id', 'amount', 'is_successful', 'mpesa_receipt_number')
+
+
+def _reconcile_chunk(chunk, report, dry_run):
+    report.lines += len(chunk)
+    by_receipt = {
+        row[4]: row for row in
+        MpesaTransaction.objects.filter(mpesa_receipt_number__in={line.receipt for line in chunk}).values_list(*TX_COLUMNS)
+    }
+    lesson_ids = {line.lesson_id for line in chunk if line.receipt not in by_receipt and line.lesson_id}
+    by_lesson = {
+        row[1]: row for row in
+        MpesaTransaction.objects.filter(lesson_id__in=lesson_ids).values_list(*TX_COLUMNS)
+    } if lesson_ids else {}
+
+    to_pay = {}   # transaction id -> receipt
+    to_fill = {}  # paid (by a status query) but without the receipt yet
+    for line in chunk:
+        row = by_receipt.get(line.receipt) or by_lesson.get(line.lesson_id)
+        if row is None:
+            report.mismatch(UNMATCHED, line.receipt, line.details)
+            continue
+        pk, lesson_id, amount, is_successful, receipt = row
+        if amount != line.amount:
+            report.mismatch(AMOUNT_MISMATCH, line.receipt, f"lesson {lesson_id}: expected {amount}, paid {line.amount}")
+        elif receipt == line.receipt:
+            report.matched += 1
+        elif is_successful and not receipt and pk not in to_fill:
+            to_fill[pk] = line.receipt
+            report.matched += 1
+        elif is_successful or pk in to_pay:
+            other = receipt or to_pay.get(pk) or to_fill.get(pk)
+            report.mismatch(RECEIPT_CONFLICT, line.receipt, f"lesson {lesson_id} was paid with {other}")
+        else:
+            to_pay[pk] = line.receipt
+
+    if dry_run:
+        report.fixed += len(to_pay)
+    else:
+        report.fixed += mark_paid(to_pay, "Reconciled from M-Pesa statement")
+        fill_receipts(to_fill)
+
+
+# --- Pending pushes (STK query) ---
+def pending_transactions(now=None, older_than=PENDING_AGE):
+    """Pushes Safaricom accepted but whose callback hasn't come after `older_than`."""
+    now = now or timezone.now()
+    return MpesaTransaction.objects.filter(
+        is_successful=False, result_code__isnull=True, push_status=MpesaTransaction.PUSH_SENT,
+        checkout_request_id__isnull=False, transaction_date__lt=now - older_than,
+    )
+
+
+def reconcile_pending(client=None, now=None, older_than=PENDING_AGE, batch_size=QUERY_BATCH,
+                      workers=QUERY_WORKERS, dry_run=False):
+    """
+    Asks `client` (anything with the gateway's stk_query(); the shared gateway by default) how each
+    pending push ended, QUERY_BATCH at a time over `workers` threads, and applies the answers.
+    """
+    started = time.perf_counter()
+    client = client or get_gateway()
+    report = ReconciliationReport()
+    report.failed += stale_pushes(now).count() if dry_run else expire_stale_pushes(now)
+    pending = pending_transactions(now, older_than).order_by('pk').values_list('pk', 'checkout_request_id')
+    last_pk = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stk-query') as pool:
+        while True:
+            batch = list(pending.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            report.lines += len(batch)
+            # Only the HTTP calls run in the pool; the database is only touched from this thread
+            answers = pool.map(lambda row: _query(client, row[1]), batch)
+            paid, failed = {}, {}
+            for (pk, _), answer in zip(batch, answers):
+                if answer is None:
+                    report.pending += 1
+                elif answer[0] == 0:
+                    paid[pk] = None  # the query doesn't tell the receipt; a statement run fills it in
+                else:
+                    failed[pk] = answer
+            if dry_run:
+                report.fixed += len(paid)
+                report.failed += len(failed)
+            else:
+                report.fixed += mark_paid(paid, "Confirmed by M-Pesa status query")
+                report.failed += mark_failed(failed)
+    report.seconds = time.perf_counter() - started
+    return report
+
+
+def _query(client, checkout_request_id):
+    """(result code, description) once the push has ended, None while it runs or if we couldn't ask."""
+    try:
+        response = client.stk_query(checkout_request_id)
+    except Exception as e:
+        logger.warning("STK query for %s failed: %s", checkout_request_id, e)
+        return None
+    if response.error_code or response.result_code in ('', None):
+        return None
+    return int(response.result_code), (response.result_desc or '')[:255]
+
+
+# --- Applying the fixes ---
+def mark_paid(receipts, reason):
+    """
+    {transaction id: receipt or None}: marks those still unpaid as paid, adds them to the revenue
+    totals and moves their lessons to PAID. Returns how many were changed.
+    """
+    if not receipts:
+        return 0
+    with transaction.atomic():
+        transactions = list(
+            MpesaTransaction.objects.select_for_update()
+            .filter(pk__in=list(receipts), is_successful=False)
+            .only('pk', 'lesson_id', 'amount', 'transaction_date')
+        )
+        for mpesa_transaction in transactions:
+            mpesa_transaction.is_successful = True
+            mpesa_transaction.result_code = 0
+            mpesa_transaction.result_desc = reason
+            mpesa_transaction.mpesa_receipt_number = receipts[mpesa_transaction.pk]
+        MpesaTransaction.objects.bulk_update(
+            transactions, ['is_successful', 'result_code', 'result_desc', 'mpesa_receipt_number'], batch_size=500,
+        )
+        record_payments(transactions)
+        _mark_lessons_paid([mpesa_transaction.lesson_id for mpesa_transaction in transactions])
+        # bulk_update skips the signals that retire the cached payment status
+        for mpesa_transaction in transactions:
+            invalidate_payment_status(mpesa_transaction.pk)
+    return len(transactions)
+
+
+def fill_receipts(receipts):
+    """{transaction id: receipt} for payments confirmed without one (by a status query)."""
+    if not receipts:
+        return 0
+    with transaction.atomic():
+        transactions = list(
+            MpesaTransaction.objects.select_for_update()
+            .filter(pk__in=list(receipts), is_successful=True, mpesa_receipt_number__isnull=True)
+            .only('pk')
+        )
+        for mpesa_transaction in transactions:
+            mpesa_transaction.mpesa_receipt_number = receipts[mpesa_transaction.pk]
+        MpesaTransaction.objects.bulk_update(transactions, ['mpesa_receipt_number'], batch_size=500)
+        for mpesa_transaction in transactions:
+            invalidate_payment_status(mpesa_transaction.pk)
+    return len(transactions)
+
+
+def mark_failed(results):
+    """{transaction id: (result code, description)} for pushes that ended without a payment."""
+    if not results:
+        return 0
+    with transaction.atomic():
+        transactions = list(
+            MpesaTransaction.objects.select_for_update()
+            .filter(pk__in=list(results), is_successful=False, result_code__isnull=True)
+            .only('pk')
+        )
+        for mpesa_transaction in transactions:
+            mpesa_transaction.result_code, mpesa_transaction.result_desc = results[mpesa_transaction.pk]
+        MpesaTransaction.objects.bulk_update(transactions, ['result_code', 'result_desc'], batch_size=500)
+        for mpesa_transaction in transactions:
+            invalidate_payment_status(mpesa_transaction.pk)
+    return len(transactions)
+
+
+def _mark_lessons_paid(lesson_ids):
+    # The batch version of callbacks.mark_lesson_paid(): one guarded UPDATE, like tuttiapp/bulk.py
+    sources = Lesson.sources('PAID')
+    current = list(
+        Lesson.objects.select_for_update().filter(pk__in=lesson_ids).exclude(status='PAID')
+        .values_list('pk', 'teacher_id', 'status')
+    )
+    movable = [(pk, teacher_id, status) for pk, teacher_id, status in current if status in sources]
+    for pk, _, status in current:
+        if status not in sources:
+            logger.warning("Payment reconciled but lesson %s is %s, not moving it to PAID", pk, status)
+    Lesson.objects.filter(pk__in=[pk for pk, _, _ in movable], status__in=sources).update(
+        status='PAID', **Lesson.status_columns('PAID'),
+    )
+    for pk, teacher_id, status in movable:
+        lesson_transitioned.send(sender=Lesson, lesson=Lesson(pk=pk, teacher_id=teacher_id, status='PAID'),
+                                 from_status=status, to_status='PAID')
+
+
+# --- Lessons paid outside M-Pesa ---
+def check_paid_lessons(report):
+    """Adds every PAID lesson with no successful transaction to the report."""
+    orphans = (
+        Lesson.objects.filter(status='PAID')
+        .exclude(transaction__is_successful=True)
+        .order_by('pk').values_list('pk', flat=True)
+    )
+    for lesson_id in orphans.iterator(chunk_size=STATEMENT_CHUNK):
+        report.mismatch(PAID_WITHOUT_PAYMENT, f"lesson {lesson_id}")
+    return report
@@ -0,0 +1,162 @@
+import datetime
+import logging
+import time
+import uuid
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.mail import send_mass_mail
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Lesson
+
+logger = logging.getLogger(__name__)
+
+# Lesson reminders ("your lesson starts soon").
+#
+# sweep() walks the SCHEDULED lessons starting within the next `window` that haven't been
+# reminded yet (the partial index lesson_reminder_due_idx), one batch of ids at a time.
+# Each batch is claimed with a single
+#     UPDATE ... SET is_student_reminder_sent = true, reminder_claim = <uuid>
+#     WHERE id IN (...) AND is_student_reminder_sent = false
+# and only the rows carrying our uuid are sent, so several sweepers running at once never
+# double-send. If delivery fails the claim is released and the next sweep tries again.
+
+DEFAULT_BATCH_SIZE = 500
+
+
+# --- Delivery backends (LESSON_REMINDER_BACKEND) ---
+class ReminderBackend:
+    def message(self, lesson):
+        start = timezone.localtime(lesson.start_time)
+        return (
+            f"Hi {lesson.student.username}, your lesson \"{lesson.topic}\" with "
+            f"{lesson.teacher.username} starts {start:%a %d %b at %H:%M}."
+        )
+
+    def send(self, lesson):
+        raise NotImplementedError
+
+    def send_batch(self, lessons):
+        """Sends every reminder it can. Returns the ids that could not be delivered."""
+        failed = []
+        for lesson in lessons:
+            try:
+                self.send(lesson)
+            except Exception:
+                logger.exception("Reminder for lesson %s failed", lesson.pk)
+                failed.append(lesson.pk)
+        return failed
+
+
+class ConsoleReminderBackend(ReminderBackend):
+    def send(self, lesson):
+        logger.info("Reminder: %s", self.message(lesson))
+
+
+class EmailReminderBackend(ReminderBackend):
+    subject = "Lesson reminder"
+
+    def send_batch(self, lessons):
+        with_email = [lesson for lesson in lessons if lesson.student.email]
+        try:
+            send_mass_mail(
+                [(self.subject, self.message(lesson), None, [lesson.student.email]) for lesson in with_email],
+                fail_silently=False,
+            )
+        except Exception:
+            # One SMTP connection for the batch: we can't tell how far it got, so the whole batch is retried
+            logger.exception("Reminder emails for %s lessons failed", len(with_email))
+            return [lesson.pk for lesson in with_email]
+        # Nothing to deliver to students without an email address; don't retry them forever
+        return []
+
+    def send(self, lesson):
+        self.send_batch([lesson])
+
+
+class SmsStubReminderBackend(ReminderBackend):
+    """Stand-in for an SMS gateway: keeps the messages in `outbox` (per process)."""
+    outbox = []
+
+    def send(self, lesson):
+        if not lesson.student.phone_number:
+            return
+        self.outbox.append((lesson.student.phone_number, self.message(lesson)))
+
+
+def get_backend(path=None):
+    return import_string(path or settings.LESSON_REMINDER_BACKEND)()
+
+
+# --- The sweep ---
+@dataclass
+class SweepReport:
+    candidates: int = 0
+    claimed: int = 0
+    sent: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+
+    @property
+    def per_second(self):
+        return self.sent / self.seconds if self.seconds else 0.0
+
+
+def due_reminders(now, window):
+    return Lesson.objects.filter(
+        status='SCHEDULED', is_student_reminder_sent=False,
+        start_time__gte=now, start_time__lt=now + window,
+    )
+
+
+def claim(lesson_ids):
+    """Marks the given lessons as reminded, returning those that *this* call won."""
+    token = uuid.uuid4()
+    Lesson.objects.filter(pk__in=lesson_ids, is_student_reminder_sent=False, status='SCHEDULED').update(
+        is_student_reminder_sent=True, reminder_claim=token,
+    )
+    return list(
+        Lesson.objects.filter(pk__in=lesson_ids, reminder_claim=token)
+        .select_related('teacher', 'student')
+        .only('id', 'topic', 'start_time', 'teacher__username', 'student__username',
+              'student__email', 'student__phone_number')
+    )
+
+
+def release(lesson_ids):
+    Lesson.objects.filter(pk__in=lesson_ids).update(is_student_reminder_sent=False, reminder_claim=None)
+
+
+def sweep(window=None, batch_size=DEFAULT_BATCH_SIZE, backend=None, now=None):
+    window = window or datetime.timedelta(hours=settings.LESSON_REMINDER_WINDOW_HOURS)
+    backend = backend or get_backend()
+    now = now or timezone.now()
+    report = SweepReport()
+    started = time.perf_counter()
+
+    due = due_reminders(now, window).order_by('start_time', 'id')
+    last = None
+    while True:
+        # Keyset walk over (start_time, id): only `batch_size` ids are in memory at a time
+        page = due
+        if last:
+            page = page.filter(Q(start_time__gt=last[0]) | Q(start_time=last[0], id__gt=last[1]))
+        rows = list(page.values_list('start_time', 'id')[:batch_size])
+        if not rows:
+            break
+        last = rows[-1]
+        report.candidates += len(rows)
+
+        lessons = claim([pk for _start, pk in rows])
+        report.claimed += len(lessons)
+        failed = backend.send_batch(lessons) if lessons else []
+        if failed:
+            release(failed)
+        report.failed += len(failed)
+        report.sent += len(lessons) - len(failed)
+
+    report.seconds = time.perf_counter() - started
+    return report
@@ -0,0 +1,176 @@
+import datetime
+import threading
+
+from django.db import transaction
+from django.db.models import Count, ExpressionWrapper, F, DurationField, Q, Sum
+from django.db.models.functions import TruncDate, TruncMonth
+from django.utils import timezone
+
+from .models import DailyLessonRollup, DailyTeacherRevenue, Lesson, RollupDirtyDay, RollupWatermark
+
+# Analytics rollups.
+# DailyLessonRollup holds one row per (day, teacher) with lesson counts per status, booked and taught
+# minutes and the completion-to-payment latency. `manage.py refresh_rollups` keeps it up to date
+# incrementally: it only recomputes the days of lessons whose updated_at is past the watermark, plus
+# the days in RollupDirtyDay (lessons deleted or moved away from a day, which updated_at can't show;
+# tuttiapp/signals.py records those). Each touched day is recomputed from scratch, so running the
+# same day twice is harmless: that's what makes the overlap below safe.
+#
+# Revenue per teacher and day is already kept live in DailyTeacherRevenue (tuttiapp/stats.py).
+# The analytics page reads only these two tables.
+
+LESSONS = 'lessons'
+# A row written just before the last refresh may only have committed after it read the table:
+# look back this far past the watermark to pick those up.
+WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
+DAYS_PER_QUERY = 50
+
+STATUS_FIELDS = {status: status.lower() for status, _ in Lesson.STATUS_CHOICES}
+
+
+# --- Dirty days (deletes and moves) ---
+_pending = threading.local()
+
+
+def mark_dirty(start_time):
+    """Recompute the day of `start_time` on the next refresh. Written once per transaction."""
+    if start_time is None:
+        return
+    _pending.__dict__.setdefault('days', set()).add(timezone.localdate(start_time))
+    # Registered on every call, as in marketplace.schedule_refresh(): a rolled-back transaction drops
+    # its callbacks, so registering only for the first day would lose every later one. Days left over
+    # from a rollback get written with the next commit, which only costs a harmless recompute.
+    transaction.on_commit(_flush_dirty)
+
+
+def _flush_dirty():
+    days = _pending.__dict__.pop('days', set())
+    if days:  # an earlier callback in the same commit already wrote them
+        RollupDirtyDay.objects.bulk_create([RollupDirtyDay(day=day) for day in days], ignore_conflicts=True)
+
+
+# --- Refresh ---
+def _day_bounds(day):
+    start = datetime.datetime.combine(day, datetime.time.min, tzinfo=timezone.get_current_timezone())
+    return start, start + datetime.timedelta(days=1)
+
+
+def recompute_days(days):
+    """Replaces the rollup rows of `days` with fresh aggregates. Returns how many rows were written."""
+    days = sorted(set(days))
+    written = 0
+    for i in range(0, len(days), DAYS_PER_QUERY):
+        chunk = days[i:i + DAYS_PER_QUERY]
+        in_chunk = Q()
+        for day in chunk:
+            start, end = _day_bounds(day)
+            in_chunk |= Q(start_time__gte=start, start_time__lt=end)
+
+        latency = ExpressionWrapper(F('paid_at') - F('completed_at'), output_field=DurationField())
+        has_latency = Q(paid_at__isnull=False, completed_at__isnull=False)
+        rows = (
+            Lesson.objects.filter(in_chunk)
+            .annotate(day=TruncDate('start_time'))
+            .values('day', 'teacher_id')
+            .annotate(
+                **{field: Count('pk', filter=Q(status=status)) for status, field in STATUS_FIELDS.items()},
+                booked_minutes=Sum('duration_minutes', filter=~Q(status='CANCELLED'), default=0),
+                taught_minutes=Sum('duration_minutes', filter=Q(status__in=Lesson.TAUGHT_STATUSES), default=0),
+                latency=Sum(latency, filter=has_latency),
+                payment_latency_lessons=Count('pk', filter=has_latency),
+            )
+        )
+        rollups = []
+        for row in rows:
+            latency_total = row.pop('latency') or datetime.timedelta(0)
+            rollups.append(DailyLessonRollup(
+                payment_latency_seconds=int(latency_total.total_seconds()),
+                **{key: value for key, value in row.items() if key != 'teacher_id'},
+                teacher_id=row['teacher_id'],
+            ))
+        with transaction.atomic():
+            DailyLessonRollup.objects.filter(day__in=chunk).delete()
+            DailyLessonRollup.objects.bulk_create(rollups, batch_size=1000)
+        written += len(rollups)
+    return written
+
+
+def refresh_rollups(full=False, now=None):
+    """
+    Brings the rollups up to date with the lessons changed since the last run (all lessons with full=True).
+    Returns (days recomputed, rollup rows written).
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        watermark, _ = RollupWatermark.objects.select_for_update().get_or_create(name=LESSONS)
+        changed = Lesson.objects.all()
+        if watermark.value is not None and not full:
+            changed = changed.filter(updated_at__gt=watermark.value - WATERMARK_OVERLAP)
+        days = set(changed.annotate(day=TruncDate('start_time')).values_list('day', flat=True).distinct())
+
+        dirty = list(RollupDirtyDay.objects.values_list('pk', 'day'))
+        days.update(day for _, day in dirty)
+        if full:
+            days.update(DailyLessonRollup.objects.values_list('day', flat=True).distinct())
+
+        written = recompute_days(days)
+        RollupDirtyDay.objects.filter(pk__in=[pk for pk, _ in dirty]).delete()
+        watermark.value = now
+        watermark.save(update_fields=['value'])
+    return len(days), written
+
+
+# --- Reading (the admin analytics page) ---
+TEACHER_MINUTES_PER_DAY = 8 * 60  # what "100% utilised" means for one teacher-day
+TOP_TEACHERS = 10
+
+
+def analytics_summary(days=30, today=None):
+    """Everything the analytics page shows for the last `days` days, from the rollup tables only."""
+    today = today or timezone.localdate()
+    since = today - datetime.timedelta(days=days - 1)
+    lessons = DailyLessonRollup.objects.filter(day__gte=since, day__lte=today)
+    revenue = DailyTeacherRevenue.objects.filter(day__gte=since, day__lte=today)
+
+    totals = lessons.aggregate(
+        **{field: Sum(field, default=0) for field in STATUS_FIELDS.values()},
+        booked_minutes=Sum('booked_minutes', default=0),
+        taught_minutes=Sum('taught_minutes', default=0),
+        latency_seconds=Sum('payment_latency_seconds', default=0),
+        latency_lessons=Sum('payment_latency_lessons', default=0),
+    )
+    average_latency = None
+    if totals['latency_lessons']:
+        average_latency = datetime.timedelta(seconds=round(totals['latency_seconds'] / totals['latency_lessons']))
+
+    teachers = list(
+        lessons.values('teacher_id', 'teacher__username')
+        .annotate(taught_minutes=Sum('taught_minutes'), booked_minutes=Sum('booked_minutes'))
+        .order_by('-taught_minutes', 'teacher_id')[:TOP_TEACHERS]
+    )
+    for row in teachers:
+        row['utilisation'] = row['taught_minutes'] / (days * TEACHER_MINUTES_PER_DAY)
+
+    months_since = (today.replace(day=1) - datetime.timedelta(days=335)).replace(day=1)
+    return {
+        'days': days,
+        'since': since,
+        'until': today,
+        'lessons_by_status': [(label, totals[STATUS_FIELDS[status]]) for status, label in Lesson.STATUS_CHOICES],
+        'booked_hours': totals['booked_minutes'] / 60,
+        'taught_hours': totals['taught_minutes'] / 60,
+        'average_payment_latency': average_latency,
+        'revenue_total': revenue.aggregate(total=Sum('amount', default=0))['total'],
+        'revenue_by_day': list(revenue.values('day').annotate(amount=Sum('amount'), payments=Sum('payments')).order_by('-day')),
+        'revenue_by_month': list(
+            DailyTeacherRevenue.objects.filter(day__gte=months_since, day__lte=today)
+            .annotate(month=TruncMonth('day')).values('month')
+            .annotate(amount=Sum('amount'), payments=Sum('payments')).order_by('-month')
+        ),
+        'revenue_by_teacher': list(
+            revenue.values('teacher_id', 'teacher__username')
+            .annotate(amount=Sum('amount'), payments=Sum('payments'))
+            .order_by('-amount', 'teacher_id')[:TOP_TEACHERS]
+        ),
+        'teacher_utilisation': teachers,
+    }
@@ -0,0 +1,89 @@
+import datetime
+
+from django.db import transaction
+
+from .models import MAX_LESSON_MINUTES, Lesson, User
+
+# Teacher availability / double-booking detection.
+#
+# Two lessons overlap when   other.start < new.end   and   other.end > new.start.
+# Because no lesson is longer than MAX_LESSON_MINUTES, any overlapping lesson must also start
+# after new.start - MAX_LESSON_MINUTES. That turns the check into a bounded range scan on the
+# (teacher, start_time) index: O(log n) to find the range, plus the handful of lessons inside it,
+# however long the teacher's history is.
+#
+# The check alone is a read: two students can both see the slot free and both insert. Anything that
+# creates lessons takes lock_teacher() first and checks again inside that transaction (book() for a
+# single request, series.materialize() for a series), so bookings for one teacher go one at a time.
+
+# Lessons in these states don't hold the teacher's time
+FREE_STATUSES = ('CANCELLED',)
+MAX_LESSON_LENGTH = datetime.timedelta(minutes=MAX_LESSON_MINUTES)
+
+
+class SlotTaken(ValueError):
+    """Another booking took the slot between the form's check and the insert."""
+
+
+def lock_teacher(teacher):
+    """Serialises bookings for this teacher until the current transaction ends.
+
+    A row lock on Postgres; on SQLite the write lock BEGIN IMMEDIATE takes does the same job.
+    """
+    User.objects.select_for_update().filter(pk=getattr(teacher, 'pk', teacher)).values_list('pk', flat=True).first()
+
+
+def book(lesson):
+    """Saves a new lesson if its slot is still free, raising SlotTaken otherwise."""
+    with transaction.atomic():
+        lock_teacher(lesson.teacher_id)
+        if not is_slot_free(lesson.teacher_id, lesson.start_time, lesson.duration_minutes):
+            raise SlotTaken(lesson.start_time)
+        lesson.save()
+    return lesson
+
+
+def busy_lessons(teacher):
+    return Lesson.objects.filter(teacher=teacher).exclude(status__in=FREE_STATUSES)
+
+
+def conflicts(teacher, start_time, duration_minutes=60, exclude=None):
+    """The teacher's lessons overlapping [start_time, start_time + duration)."""
+    end_time = start_time + datetime.timedelta(minutes=duration_minutes)
+    overlapping = busy_lessons(teacher).filter(
+        start_time__gt=start_time - MAX_LESSON_LENGTH,
+        start_time__lt=end_time,
+        end_time__gt=start_time,
+    )
+    if exclude is not None:
+        overlapping = overlapping.exclude(pk=getattr(exclude, 'pk', exclude))
+    return overlapping
+
+
+def is_slot_free(teacher, start_time, duration_minutes=60, exclude=None):
+    return not conflicts(teacher, start_time, duration_minutes, exclude).exists()
+
+
+def next_free_slots(teacher, after, duration_minutes=60, count=3, exclude=None):
+    """
+    The first `count` start times at or after `after` where a lesson of `duration_minutes` fits,
+    found by walking the teacher's lessons in start order and stopping as soon as we have enough.
+    """
+    length = datetime.timedelta(minutes=duration_minutes)
+    upcoming = busy_lessons(teacher).filter(start_time__gt=after - MAX_LESSON_LENGTH, end_time__gt=after)
+    if exclude is not None:
+        upcoming = upcoming.exclude(pk=getattr(exclude, 'pk', exclude))
+
+    slots = []
+    cursor = after
+    for start, end in upcoming.order_by('start_time').values_list('start_time', 'end_time').iterator(chunk_size=50):
+        while cursor + length <= start and len(slots) < count:
+            slots.append(cursor)
+            cursor += length
+        if len(slots) >= count:
+            return slots
+        cursor = max(cursor, end)
+    while len(slots) < count:
+        slots.append(cursor)
+        cursor += length
+    return slots
@@ -0,0 +1,121 @@
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import User, normalize_kenyan_phone
+
+# User search for the admin "Manage Users" page.
+#
+# Postgres: pg_trgm GIN indexes on username/email/phone (migration 0006) make the
+#           icontains filters index scans, and results are ranked by trigram similarity.
+# SQLite:   an FTS5 table with the trigram tokenizer (tuttiapp_user_search, kept in sync by
+#           triggers) answers substring queries, ranked by bm25.
+# Anything else (or queries too short for trigrams) falls back to a bounded icontains scan.
+#
+# Phone queries are normalised like validate_kenyan_phone, so "0712 345" finds "254712345...".
+
+SEARCH_PAGE_SIZE = 25
+FTS_TABLE = 'tuttiapp_user_search'
+MIN_TRIGRAM_LENGTH = 3
+PHONE_QUERY = re.compile(r"^\+?[\d\s-]+$")
+
+
+class SearchPage:
+    def __init__(self, results, number, has_next):
+        self.results = results
+        self.number = number
+        self.has_next = has_next
+
+    @property
+    def has_previous(self):
+        return self.number > 1
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+
+def search_terms(query):
+    """The raw query plus its normalised phone form (when it looks like a phone number)."""
+    query = query.strip()
+    terms = [query]
+    if PHONE_QUERY.match(query):
+        phone = normalize_kenyan_phone(query)
+        if phone not in terms:
+            terms.append(phone)
+    return terms
+
+
+def search_users(query, page=1, per_page=SEARCH_PAGE_SIZE):
+    """Ranked, paginated user search. Costs one or two queries and never loads the whole table."""
+    page = max(int(page), 1)
+    offset = (page - 1) * per_page
+    terms = search_terms(query)
+
+    if connection.vendor == 'postgresql':
+        rows = _postgres_search(terms, offset, per_page + 1)
+    elif connection.vendor == 'sqlite' and min(len(t) for t in terms) >= MIN_TRIGRAM_LENGTH and _fts_available():
+        rows = _sqlite_search(terms, offset, per_page + 1)
+    else:
+        rows = list(_contains_filter(User.objects.all(), terms).order_by('-date_joined')[offset:offset + per_page + 1])
+    return SearchPage(rows[:per_page], page, len(rows) > per_page)
+
+
+def list_users(page=1, per_page=SEARCH_PAGE_SIZE):
+    """The page shown when there is no search term: newest users first (indexed on date_joined)."""
+    page = max(int(page), 1)
+    offset = (page - 1) * per_page
+    rows = list(User.objects.order_by('-date_joined')[offset:offset + per_page + 1])
+    return SearchPage(rows[:per_page], page, len(rows) > per_page)
+
+
+def _contains_filter(queryset, terms):
+    match = Q()
+    for term in terms:
+        match |= Q(username__icontains=term) | Q(email__icontains=term) | Q(phone_number__icontains=term)
+    return queryset.filter(match)
+
+
+def _postgres_search(terms, offset, limit):
+    from django.contrib.postgres.search import TrigramSimilarity
+    from django.db.models.functions import Greatest
+
+    similarities = [
+        TrigramSimilarity(field, term)
+        for term in terms
+        for field in ('username', 'email', 'phone_number')
+    ]
+    return list(
+        _contains_filter(User.objects.all(), terms)
+        .annotate(rank=Greatest(*similarities))
+        .order_by('-rank', '-date_joined')[offset:offset + limit]
+    )
+
+
+_fts_checked = None
+
+
+def _fts_available():
+    # The FTS5 table is only created when the SQLite build supports it (see migration 0006)
+    global _fts_checked
+    if _fts_checked is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+            _fts_checked = cursor.fetchone() is not None
+    return _fts_checked
+
+
+def _sqlite_search(terms, offset, limit):
+    # Each term becomes an FTS5 phrase ("..." with quotes doubled), OR-ed together
+    match = ' OR '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY rank LIMIT %s OFFSET %s",
+            [match, limit, offset],
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+    users = User.objects.in_bulk(ids)
+    return [users[pk] for pk in ids if pk in users]
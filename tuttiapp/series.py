@@ -0,0 +1,125 @@
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import marketplace
+from .bulk import apply_bulk_action
+from .models import Lesson, LessonSeries
+from .scheduling import MAX_LESSON_LENGTH, busy_lessons, lock_teacher
+
+logger = logging.getLogger(__name__)
+
+# Recurring lessons.
+# A LessonSeries is just the rule (first start, every 1 or 2 weeks, N times). Its Lesson rows are
+# created lazily: only the occurrences starting within the next LESSON_SERIES_WINDOW_WEEKS, in one
+# bulk_create, and `manage.py materialize_lesson_series` rolls the window forward. Once created they
+# are ordinary lessons, so reminders, payments, rescheduling and the dashboard need nothing special.
+#
+# Occurrences that clash with another of the teacher's lessons are skipped (and logged), like the
+# double-booking check does for a single request.
+
+BATCH_SIZE = 500
+
+
+def window():
+    return datetime.timedelta(weeks=settings.LESSON_SERIES_WINDOW_WEEKS)
+
+
+def create_series(teacher, student, topic, first_start, interval_weeks, occurrences, **extra):
+    """Saves the rule and creates the lessons of the first window. Returns the series."""
+    with transaction.atomic():
+        series = LessonSeries.objects.create(
+            teacher=teacher, student=student, topic=topic, first_start=first_start,
+            interval_weeks=interval_weeks, occurrences=occurrences, **extra,
+        )
+        materialize(series)
+    return series
+
+
+def materialize(series, now=None):
+    """Creates the series' lessons up to now + window(). Returns how many lessons were created."""
+    now = now or timezone.now()
+    horizon = now + window()
+    with transaction.atomic():
+        # Lock the rule, so two workers can't expand the same occurrences
+        series = LessonSeries.objects.select_for_update().get(pk=series.pk)
+        if series.status == LessonSeries.CANCELLED:
+            return 0
+        # ...and the teacher, so a single booking can't land between the busy read and the insert
+        lock_teacher(series.teacher_id)
+
+        n = series.materialized_count
+        starts = []
+        while series.occurrence(n) is not None and series.occurrence(n) <= horizon:
+            starts.append(series.occurrence(n))
+            n += 1
+        if not starts:
+            return 0
+
+        # The teacher's other lessons around those dates, in one query
+        length = datetime.timedelta(minutes=series.duration_minutes)
+        busy = list(
+            busy_lessons(series.teacher_id)
+            .filter(start_time__gt=starts[0] - MAX_LESSON_LENGTH, start_time__lt=starts[-1] + length)
+            .values_list('start_time', 'end_time')
+        )
+        status = 'SCHEDULED' if series.status == LessonSeries.ACTIVE else 'REQUESTED'
+        lessons = []
+        for start in starts:
+            if any(other_start < start + length and other_end > start for other_start, other_end in busy):
+                logger.info("Series %s: skipping %s, the teacher is booked", series.pk, start)
+                continue
+            lessons.append(Lesson(
+                series=series, teacher_id=series.teacher_id, student_id=series.student_id,
+                topic=series.topic, price=series.price, duration_minutes=series.duration_minutes,
+                start_time=start, status=status,
+            ))
+        # ignore_conflicts: the (series, start_time) constraint makes a repeat a no-op
+        Lesson.objects.bulk_create(lessons, batch_size=BATCH_SIZE, ignore_conflicts=True)
+        LessonSeries.objects.filter(pk=series.pk).update(materialized_count=n, next_start=series.occurrence(n))
+        # bulk_create skips post_save
+        marketplace.schedule_refresh(series.teacher_id)
+    return len(lessons)
+
+
+def materialize_due(now=None, batch_size=100):
+    """Rolls every live series' window forward. Returns (series looked at, lessons created)."""
+    now = now or timezone.now()
+    due = (
+        LessonSeries.objects.filter(status__in=(LessonSeries.REQUESTED, LessonSeries.ACTIVE),
+                                    next_start__lte=now + window())
+        .order_by('next_start')
+        .values_list('pk', flat=True)
+    )
+    seen = created = 0
+    for series_id in due[:batch_size]:
+        created += materialize(LessonSeries(pk=series_id), now)
+        seen += 1
+    return seen, created
+
+
+def approve_series(series):
+    """The teacher accepts the whole booking: the series and all its requested lessons."""
+    with transaction.atomic():
+        if not LessonSeries.objects.filter(pk=series.pk, status=LessonSeries.REQUESTED).update(status=LessonSeries.ACTIVE):
+            return 0
+        return _apply_to_requested(series, 'approve')
+
+
+def decline_series(series):
+    """The teacher turns the booking down: the series is cancelled and its requested lessons removed."""
+    with transaction.atomic():
+        if not LessonSeries.objects.filter(pk=series.pk, status=LessonSeries.REQUESTED).update(status=LessonSeries.CANCELLED):
+            return 0
+        return _apply_to_requested(series, 'decline')
+
+
+def _apply_to_requested(series, action):
+    lesson_ids = list(Lesson.objects.filter(series_id=series.pk, status='REQUESTED').values_list('pk', flat=True))
+    if not lesson_ids:
+        return 0
+    results = apply_bulk_action(series.teacher, action, lesson_ids)
+    return sum(1 for result in results.values() if result['outcome'] in ('updated', 'deleted'))
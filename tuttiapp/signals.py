@@ -0,0 +1,106 @@
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import marketplace, rollups, stats
+from .cache import LESSON, PAYMENT, USER, invalidate
+from .models import Lesson, MpesaTransaction, TeacherCard, User, lesson_transitioned
+
+# Keeps the admin stats counters, the marketplace teacher cards and the cache version stamps
+# (tuttiapp/cache.py) in step with the User, Lesson and MpesaTransaction tables.
+# Note: queryset.update() and bulk_create() skip these signals, so anything that changes
+# roles or payments in bulk must call tuttiapp.stats (and tuttiapp.cache.invalidate) itself.
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw:  # loaddata
+        return
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return  # the save done at every login changes nothing we track
+
+    # Marketplace card: teachers get one, and profile edits retire the cached fragment
+    if instance.is_teacher:
+        if created or not marketplace.bump_card_version(instance.pk):
+            marketplace.schedule_refresh(instance.pk)
+    elif not created:
+        TeacherCard.objects.filter(teacher_id=instance.pk).delete()
+
+    roles = (instance.is_student, instance.is_teacher)
+    if created:
+        stats.record_user_roles(None, roles)
+    else:
+        loaded = getattr(instance, '_loaded_roles', None)
+        if loaded and None not in loaded:
+            stats.record_user_roles(loaded, roles)
+    instance._loaded_roles = roles
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+    stats.release_teacher_revenue(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    stats.record_user_roles((instance.is_student, instance.is_teacher), None)
+
+
+@receiver(post_delete, sender=MpesaTransaction)
+def transaction_deleted(sender, instance, **kwargs):
+    # Deleting a paid lesson takes its payment out of the lifetime revenue, like the old SUM() did
+    if instance.is_successful:
+        stats.record_payment(instance, sign=-1)
+
+
+@receiver(post_save, sender=Lesson)
+@receiver(post_delete, sender=Lesson)
+def lesson_changed(sender, instance, raw=False, **kwargs):
+    if raw or not instance.teacher_id:
+        return
+    marketplace.schedule_refresh(instance.teacher_id)
+    if kwargs['signal'] is post_delete:
+        rollups.mark_dirty(instance.start_time)
+    else:
+        _track_move(instance)
+
+
+@receiver(lesson_transitioned)
+def lesson_status_changed(sender, lesson, from_status, to_status, **kwargs):
+    # Lesson.transition() writes with update(), so post_save (above and below) doesn't fire
+    marketplace.schedule_refresh(lesson.teacher_id)
+    invalidate(LESSON, lesson.pk)
+    _track_move(lesson)
+
+
+def _track_move(lesson):
+    # The analytics refresh finds the lesson's new day by its updated_at, but not the day it left
+    loaded = getattr(lesson, '_loaded_start_time', None)
+    current = lesson.__dict__.get('start_time')  # never load a deferred field just for this
+    if loaded is not None and current is not None and loaded != current:
+        rollups.mark_dirty(loaded)
+    if current is not None:
+        lesson._loaded_start_time = current
+
+
+# --- Cache version stamps ---
+# (User.save() bumps its own stamp)
+@receiver(post_delete, sender=User)
+def user_cache_changed(sender, instance, **kwargs):
+    invalidate(USER, instance.pk)
+
+
+@receiver(post_save, sender=Lesson)
+@receiver(post_delete, sender=Lesson)
+def lesson_cache_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    invalidate(LESSON, instance.pk)
+
+
+@receiver(post_save, sender=MpesaTransaction)
+@receiver(post_delete, sender=MpesaTransaction)
+def transaction_cache_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    invalidate(PAYMENT, instance.pk)
+    invalidate(LESSON, instance.lesson_id)
@@ -0,0 +1,169 @@
+import datetime
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .cache import STATS, aget_or_set, get_or_set, invalidate
+from .models import DailyTeacherRevenue, Lesson, MpesaTransaction, PlatformCounter, User
+
+# Admin KPI panel.
+# Totals are kept as running counters (PlatformCounter / DailyTeacherRevenue) that are bumped
+# when users are created/deleted (tuttiapp/signals.py) and when a payment succeeds (mpesa_callback),
+# so reading them costs the same whether we have 10 users or 10 million.
+# The panel itself is served from the cache and invalidated explicitly whenever a counter moves.
+
+ADMIN_STATS_TIMEOUT = 60 * 5  # safety net only: every counter update invalidates the entry
+REVENUE_DAYS = 7
+
+
+def get_admin_stats():
+    return get_or_set(STATS, 'admin', 'panel', _load_admin_stats, ADMIN_STATS_TIMEOUT)
+
+
+async def aget_admin_stats():
+    """get_admin_stats() for the async dashboard."""
+    return await aget_or_set(STATS, 'admin', 'panel', _aload_admin_stats, ADMIN_STATS_TIMEOUT)
+
+
+def invalidate_admin_stats():
+    invalidate(STATS, 'admin')
+
+
+def _load_admin_stats():
+    counters = dict(PlatformCounter.objects.values_list('name', 'value'))
+    return _admin_stats(counters, list(_revenue_by_day()))
+
+
+async def _aload_admin_stats():
+    counters = {name: value async for name, value in PlatformCounter.objects.values_list('name', 'value')}
+    return _admin_stats(counters, [row async for row in _revenue_by_day()])
+
+
+def _revenue_by_day():
+    since = timezone.localdate() - datetime.timedelta(days=REVENUE_DAYS - 1)
+    return (
+        DailyTeacherRevenue.objects.filter(day__gte=since)
+        .values('day')
+        .annotate(amount=Sum('amount'), payments=Sum('payments'))
+        .order_by('-day')
+    )
+
+
+def _admin_stats(counters, revenue_by_day):
+    return {
+        'total_students': int(counters.get(PlatformCounter.STUDENTS, 0)),
+        'total_teachers': int(counters.get(PlatformCounter.TEACHERS, 0)),
+        'total_revenue': counters.get(PlatformCounter.REVENUE, 0),
+        'revenue_by_day': revenue_by_day,
+    }
+
+
+# --- Incremental updates ---
+def increment(name, by):
+    """Atomically add `by` to a counter (an UPDATE ... SET value = value + by, no read first)."""
+    if not by:
+        return
+    with transaction.atomic():
+        if not PlatformCounter.objects.filter(name=name).update(value=F('value') + by):
+            try:
+                with transaction.atomic():
+                    PlatformCounter.objects.create(name=name, value=by)
+            except IntegrityError:
+                # Someone else created the row between our UPDATE and INSERT
+                PlatformCounter.objects.filter(name=name).update(value=F('value') + by)
+    # Drops the cached panel now and again on commit (see tuttiapp/cache.py)
+    invalidate_admin_stats()
+
+
+def record_user_roles(was, now):
+    """`was`/`now` are (is_student, is_teacher) tuples; None means "did not exist"."""
+    was = was or (False, False)
+    now = now or (False, False)
+    increment(PlatformCounter.STUDENTS, int(bool(now[0])) - int(bool(was[0])))
+    increment(PlatformCounter.TEACHERS, int(bool(now[1])) - int(bool(was[1])))
+
+
+def record_payment(mpesa_transaction, sign=1):
+    """Adds a successful payment to the revenue totals (sign=-1 takes it back out)."""
+    amount = mpesa_transaction.amount * sign
+    day = timezone.localdate(mpesa_transaction.transaction_date) if mpesa_transaction.transaction_date else timezone.localdate()
+    # Read just the teacher id: during a cascade delete the Lesson instance may already be gone
+    teacher_id = Lesson.objects.filter(pk=mpesa_transaction.lesson_id).values_list('teacher_id', flat=True).first()
+    increment(PlatformCounter.REVENUE, amount)
+    _add_revenue(day, teacher_id, amount, sign)
+
+
+def record_payments(mpesa_transactions):
+    """record_payment() for many payments at once: one counter update, one upsert per (day, teacher)."""
+    teacher_of = dict(
+        Lesson.objects.filter(pk__in=[t.lesson_id for t in mpesa_transactions]).values_list('pk', 'teacher_id')
+    )
+    totals = defaultdict(lambda: [0, 0])
+    for mpesa_transaction in mpesa_transactions:
+        day = timezone.localdate(mpesa_transaction.transaction_date) if mpesa_transaction.transaction_date else timezone.localdate()
+        entry = totals[(day, teacher_of.get(mpesa_transaction.lesson_id))]
+        entry[0] += mpesa_transaction.amount
+        entry[1] += 1
+    increment(PlatformCounter.REVENUE, sum(amount for amount, _ in totals.values()))
+    for (day, teacher_id), (amount, payments) in totals.items():
+        _add_revenue(day, teacher_id, amount, payments)
+
+
+def _add_revenue(day, teacher_id, amount, payments):
+    with transaction.atomic():
+        updated = DailyTeacherRevenue.objects.filter(day=day, teacher_id=teacher_id).update(
+            amount=F('amount') + amount, payments=F('payments') + payments,
+        )
+        if not updated and payments > 0:
+            try:
+                with transaction.atomic():
+                    DailyTeacherRevenue.objects.create(day=day, teacher_id=teacher_id, amount=amount, payments=payments)
+            except IntegrityError:
+                DailyTeacherRevenue.objects.filter(day=day, teacher_id=teacher_id).update(
+                    amount=F('amount') + amount, payments=F('payments') + payments,
+                )
+
+
+def release_teacher_revenue(teacher_id):
+    """Folds a teacher's revenue rows into each day's unassigned (teacher=NULL) row before they are deleted.
+
+    SET_NULL alone would leave a second NULL row for any day that already had one.
+    """
+    rows = DailyTeacherRevenue.objects.filter(teacher_id=teacher_id)
+    unassigned = DailyTeacherRevenue.objects.filter(teacher=None)
+    same_day = rows.filter(day=OuterRef('day'))
+    with transaction.atomic():
+        unassigned.filter(day__in=rows.values('day')).update(
+            amount=F('amount') + Subquery(same_day.values('amount')),
+            payments=F('payments') + Subquery(same_day.values('payments')),
+        )
+        rows.filter(day__in=unassigned.values('day')).delete()
+        rows.update(teacher=None)
+
+
+# --- Full recount (manage.py rebuild_admin_stats) ---
+def rebuild_admin_stats():
+    """Recomputes every counter from the source tables. Slow by design: only for repairs."""
+    with transaction.atomic():
+        users = User.objects.aggregate(
+            students=Count('pk', filter=Q(is_student=True)),
+            teachers=Count('pk', filter=Q(is_teacher=True)),
+        )
+        revenue = MpesaTransaction.objects.filter(is_successful=True).aggregate(total=Sum('amount'))['total'] or 0
+        for name, value in ((PlatformCounter.STUDENTS, users['students']),
+                            (PlatformCounter.TEACHERS, users['teachers']),
+                            (PlatformCounter.REVENUE, revenue)):
+            PlatformCounter.objects.update_or_create(name=name, defaults={'value': value})
+
+        DailyTeacherRevenue.objects.all().delete()
+        DailyTeacherRevenue.objects.bulk_create([
+            DailyTeacherRevenue(day=row['day'], teacher_id=row['lesson__teacher'], amount=row['amount'], payments=row['payments'])
+            for row in MpesaTransaction.objects.filter(is_successful=True)
+            .annotate(day=TruncDate('transaction_date'))
+            .values('day', 'lesson__teacher')
+            .annotate(amount=Sum('amount'), payments=Count('pk'))
+        ])
+    invalidate_admin_stats()
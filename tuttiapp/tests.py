@@ -1,9 +1,13 @@
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from .models import Lesson
+from .callbacks import process_pending
+from .querybudget import Budget
 from django.utils import timezone
 import datetime
+import os
+import json
 
 User = get_user_model()
 
@@ -58,3 +62,1843 @@ class ViewsTestCase(TestCase):
         self.client.login(username='admin', password='password')
         response = self.client.get(reverse('manage_users'))
         self.assertEqual(response.status_code, 200)
+
+
+class DashboardQueryBudgetTestCase(TestCase):
+    """
+    The dashboard must cost the same number of queries no matter how many
+    lessons a user has. Any per-row lazy FK access in dashboard.html breaks this.
+    """
+    # session + user + lesson feed
+    QUERY_BUDGET = 3
+
+    def setUp(self):
+        self.client = Client()
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True)
+
+    def seed_lessons(self, count):
+        start = timezone.now() + datetime.timedelta(days=1)
+        Lesson.objects.bulk_create([
+            Lesson(
+                teacher=self.teacher,
+                student=self.student,
+                start_time=start + datetime.timedelta(hours=i),
+                topic=f"Lesson {i}",
+                status='SCHEDULED',
+            )
+            for i in range(count)
+        ], batch_size=1000)
+
+    def count_dashboard_queries(self, username):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        self.client.login(username=username, password='password')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_teacher_dashboard_query_count_is_flat(self):
+        counts = {}
+        seeded = 0
+        for size in (10, 1000, 10000):
+            self.seed_lessons(size - seeded)
+            seeded = size
+            counts[size] = self.count_dashboard_queries('teacher')
+        self.assertEqual(len(set(counts.values())), 1, f"Query count grew with lesson count: {counts}")
+        self.assertLessEqual(counts[10], self.QUERY_BUDGET)
+
+    def test_student_dashboard_query_count_is_flat(self):
+        self.seed_lessons(10)
+        small = self.count_dashboard_queries('student')
+        self.seed_lessons(990)
+        self.assertEqual(self.count_dashboard_queries('student'), small)
+
+    def test_feed_joins_teacher_and_student(self):
+        self.seed_lessons(5)
+        with self.assertNumQueries(1):
+            rows = [(l.teacher.username, l.student.username) for l in Lesson.objects.feed()]
+        self.assertEqual(len(rows), 5)
+
+
+class DashboardPaginationTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True)
+        now = timezone.now()
+        lessons = []
+        for i in range(30):
+            # Pairs of lessons share a start_time so the id tie-breaker is exercised
+            offset = datetime.timedelta(hours=(i // 2) + 1)
+            lessons.append(Lesson(teacher=self.teacher, student=self.student, topic=f"Future {i}", start_time=now + offset))
+            lessons.append(Lesson(teacher=self.teacher, student=self.student, topic=f"Past {i}", start_time=now - offset))
+        Lesson.objects.bulk_create(lessons)
+
+    def walk(self, queryset, descending=False):
+        from .pagination import keyset_paginate
+
+        seen, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                page = keyset_paginate(queryset, cursor, descending=descending, page_size=7)
+                seen.extend(lesson.id for lesson in page)
+            if not page.has_next:
+                return seen
+            cursor = page.next_cursor
+
+    def test_upcoming_pages_cover_every_lesson_once_in_order(self):
+        upcoming = Lesson.objects.feed().for_teacher(self.teacher).upcoming(timezone.now())
+        expected = list(upcoming.order_by('start_time', 'id').values_list('id', flat=True))
+        self.assertEqual(self.walk(upcoming), expected)
+        self.assertEqual(len(expected), 30)
+
+    def test_history_pages_run_newest_first(self):
+        history = Lesson.objects.feed().for_teacher(self.teacher).history(timezone.now())
+        expected = list(history.order_by('-start_time', '-id').values_list('id', flat=True))
+        self.assertEqual(self.walk(history, descending=True), expected)
+
+    def test_dashboard_segments_and_bad_cursor(self):
+        self.client.login(username='student', password='password')
+        response = self.client.get(reverse('dashboard'), {'segment': 'history'})
+        self.assertEqual(response.context['segment'], 'history')
+        self.assertTrue(all(l.topic.startswith('Past') for l in response.context['lessons']))
+        self.assertIsNotNone(response.context['next_cursor'])
+
+        # A garbage cursor falls back to the first page instead of erroring
+        response = self.client.get(reverse('dashboard'), {'segment': 'upcoming', 'cursor': '!!nope'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['lessons'].items[0].topic, 'Future 0')
+
+
+class LessonIndexesTestCase(TestCase):
+    def test_access_path_indexes_exist(self):
+        from django.db import connection
+
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Lesson._meta.db_table)
+        for name in ('lesson_teacher_start_idx', 'lesson_student_start_idx', 'lesson_teacher_status_idx',
+                     'lesson_status_start_idx', 'lesson_reminder_due_idx'):
+            self.assertIn(name, constraints)
+        self.assertEqual(constraints['lesson_teacher_start_idx']['columns'], ['teacher_id', 'start_time'])
+
+
+class AdminStatsTestCase(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.client = Client()
+        self.admin = User.objects.create_superuser(username='admin', password='password', email='admin@example.com')
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True)
+
+    def pay(self, checkout_id, amount=1500):
+        from .models import MpesaTransaction
+        lesson = Lesson.objects.create(teacher=self.teacher, student=self.student, topic="Scales",
+                                       start_time=timezone.now(), status='PENDING_PAYMENT')
+        MpesaTransaction.objects.create(lesson=lesson, checkout_request_id=checkout_id,
+                                        phone_number='254712345678', amount=amount)
+        payload = {'Body': {'stkCallback': {
+            'ResultCode': 0, 'ResultDesc': 'OK', 'CheckoutRequestID': checkout_id,
+            'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': f'R{checkout_id}'}]},
+        }}}
+        self.client.post(reverse('mpesa_callback'), data=payload, content_type='application/json')
+        process_pending()
+        return lesson
+
+    def test_counters_follow_user_changes(self):
+        from .stats import get_admin_stats
+        self.assertEqual(get_admin_stats()['total_students'], 1)
+        self.assertEqual(get_admin_stats()['total_teachers'], 1)
+
+        User.objects.create_user(username='student2', password='password', is_student=True)
+        self.assertEqual(get_admin_stats()['total_students'], 2)
+
+        # A student who becomes a teacher moves between the counters
+        student = User.objects.get(username='student2')
+        student.is_student, student.is_teacher = False, True
+        student.save()
+        stats = get_admin_stats()
+        self.assertEqual((stats['total_students'], stats['total_teachers']), (1, 2))
+
+        student.delete()
+        self.assertEqual(get_admin_stats()['total_teachers'], 1)
+
+    def test_revenue_counts_each_payment_once(self):
+        from .stats import get_admin_stats
+        self.pay('ws_CO_1')
+        self.pay('ws_CO_2', amount=500)
+        # Safaricom retrying the same callback must not double count
+        self.client.post(reverse('mpesa_callback'), data={'Body': {'stkCallback': {
+            'ResultCode': 0, 'CheckoutRequestID': 'ws_CO_1'}}}, content_type='application/json')
+        process_pending()
+        stats = get_admin_stats()
+        self.assertEqual(stats['total_revenue'], 2000)
+        self.assertEqual(stats['revenue_by_day'][0]['payments'], 2)
+
+    def test_deleted_teachers_share_one_unassigned_row_per_day(self):
+        from django.db import IntegrityError, transaction
+        from .models import DailyTeacherRevenue
+        from .stats import _add_revenue
+        day = timezone.localdate()
+        other = User.objects.create_user(username='teacher2', is_teacher=True)
+        DailyTeacherRevenue.objects.create(day=day, teacher=self.teacher, amount=1500, payments=1)
+        DailyTeacherRevenue.objects.create(day=day, teacher=other, amount=500, payments=1)
+
+        self.teacher.delete()
+        other.delete()
+        row = DailyTeacherRevenue.objects.get(day=day, teacher=None)
+        self.assertEqual((row.amount, row.payments), (2000, 2))
+
+        # A later payment without a teacher lands on that one row, not once per duplicate
+        _add_revenue(day, None, 100, 1)
+        self.assertEqual(DailyTeacherRevenue.objects.get(day=day, teacher=None).amount, 2100)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            DailyTeacherRevenue.objects.create(day=day, teacher=None, amount=1, payments=1)
+
+    def test_admin_dashboard_query_count_is_flat(self):
+        self.client.login(username='admin', password='password')
+        self.client.get(reverse('dashboard'))  # warm the stats cache
+        with self.assertNumQueries(2):  # recent transactions, recent users (session and user are cached)
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.context['total_students'], 1)
+
+
+class UserSearchTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.admin = User.objects.create_superuser(username='admin', password='password', email='admin@example.com')
+        User.objects.create_user(username='wanjiru', password='password', email='wanjiru@tutti.co.ke', phone_number='0712345678', is_student=True)
+        User.objects.create_user(username='otieno', password='password', email='otieno@example.com', phone_number='0798765432', is_teacher=True)
+
+    def usernames(self, query, **kwargs):
+        from .search import search_users
+        return [u.username for u in search_users(query, **kwargs)]
+
+    def test_substring_search(self):
+        self.assertEqual(self.usernames('anjir'), ['wanjiru'])
+        self.assertEqual(self.usernames('tutti.co'), ['wanjiru'])
+
+    def test_local_phone_format_matches_stored_number(self):
+        self.assertEqual(self.usernames('0712 345'), ['wanjiru'])
+        self.assertEqual(self.usernames('+254798'), ['otieno'])
+
+    def test_search_follows_profile_changes(self):
+        User.objects.filter(username='otieno').update(email='maestro@example.com')
+        self.assertEqual(self.usernames('maestro'), ['otieno'])
+        User.objects.filter(username='otieno').delete()
+        self.assertEqual(self.usernames('maestro'), [])
+
+    def test_results_are_paginated(self):
+        from .search import search_users
+        for i in range(5):
+            User.objects.create_user(username=f'pianist{i}', password='password')
+        first = search_users('pianist', per_page=3)
+        second = search_users('pianist', page=2, per_page=3)
+        self.assertTrue(first.has_next)
+        self.assertFalse(second.has_next)
+        self.assertEqual(len({u.pk for u in first} | {u.pk for u in second}), 5)
+
+    def test_manage_users_view(self):
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('manage_users'), {'q': '0798'})
+        self.assertEqual([u.username for u in response.context['users']], ['otieno'])
+
+
+class MpesaCallbackInboxTestCase(TestCase):
+    def setUp(self):
+        from .models import MpesaTransaction
+        self.client = Client()
+        teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        student = User.objects.create_user(username='student', password='password', is_student=True)
+        self.lesson = Lesson.objects.create(teacher=teacher, student=student, topic="Scales",
+                                            start_time=timezone.now(), status='PENDING_PAYMENT')
+        self.tx = MpesaTransaction.objects.create(lesson=self.lesson, checkout_request_id='ws_CO_1',
+                                                  phone_number='254712345678', amount=1500)
+
+    def callback(self, result_code=0, checkout_id='ws_CO_1', receipt='QWE123'):
+        payload = {'Body': {'stkCallback': {
+            'ResultCode': result_code, 'ResultDesc': 'done', 'CheckoutRequestID': checkout_id,
+            'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': receipt}]},
+        }}}
+        return self.client.post(reverse('mpesa_callback'), data=payload, content_type='application/json')
+
+    def test_callback_only_queues(self):
+        from .models import MpesaCallback
+        with self.assertNumQueries(1):
+            response = self.callback()
+        self.assertEqual(response.json()['ResultCode'], 0)
+        self.assertEqual(MpesaCallback.objects.get().checkout_request_id, 'ws_CO_1')
+        self.lesson.refresh_from_db()
+        self.assertEqual(self.lesson.status, 'PENDING_PAYMENT')  # not applied until the worker runs
+
+    def test_worker_applies_callback_once(self):
+        from django.core.management import call_command
+        from .models import MpesaCallback
+
+        self.callback()
+        self.callback(receipt='RETRY')  # Safaricom retry
+        call_command('process_mpesa_callbacks', stdout=open(os.devnull, 'w'))
+
+        self.tx.refresh_from_db()
+        self.lesson.refresh_from_db()
+        self.assertTrue(self.tx.is_successful)
+        self.assertEqual(self.tx.mpesa_receipt_number, 'QWE123')
+        self.assertEqual(self.lesson.status, 'PAID')
+        self.assertEqual(
+            sorted(MpesaCallback.objects.values_list('status', flat=True)),
+            [MpesaCallback.DUPLICATE, MpesaCallback.PROCESSED],
+        )
+
+    def test_bad_callbacks_fail_without_blocking_the_batch(self):
+        from .models import MpesaCallback
+
+        self.client.post(reverse('mpesa_callback'), data='not json', content_type='application/json')
+        self.callback(checkout_id='ws_CO_unknown')
+        self.callback(result_code=1032)  # cancelled by user
+        with self.assertLogs('tuttiapp.callbacks', 'WARNING'):
+            self.assertEqual(process_pending(), {MpesaCallback.FAILED: 2, MpesaCallback.PROCESSED: 1})
+
+        self.tx.refresh_from_db()
+        self.assertFalse(self.tx.is_successful)
+        self.assertEqual(self.tx.result_code, 1032)
+        self.assertEqual(MpesaCallback.objects.filter(error__contains='Unknown').count(), 1)
+
+
+class MpesaGatewayTestCase(TestCase):
+    def setUp(self):
+        from .daraja_stub import DarajaStub
+        self.stub = DarajaStub().start()
+        self.addCleanup(self.stub.stop)
+
+    def push(self, gateway, i=0):
+        return gateway.stk_push('0712345678', 1500, f"Tutti-{i}", "Lesson", 'https://example.com/cb/')
+
+    def test_token_is_fetched_once_and_reused(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from .mpesa import MpesaGateway
+
+        gateway = MpesaGateway(base_url=self.stub.url)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            responses = list(pool.map(lambda i: self.push(gateway, i), range(40)))
+        self.assertTrue(all(r.response_code == '0' for r in responses))
+        self.assertEqual(self.stub.calls, {'token': 1, 'stk_push': 40})
+        self.assertEqual(self.stub.pushes[0]['PhoneNumber'], '254712345678')
+        self.assertEqual(gateway.metrics()['stk_push']['calls'], 40)
+
+    def test_token_refreshed_before_expiry_and_after_revocation(self):
+        from .mpesa import MpesaGateway
+
+        # Token lives 10s but we refresh 30s early, so every call needs a new one
+        self.stub.token_ttl = 10
+        gateway = MpesaGateway(base_url=self.stub.url, refresh_margin=30)
+        self.push(gateway)
+        self.push(gateway)
+        self.assertEqual(self.stub.calls['token'], 2)
+
+        gateway = MpesaGateway(base_url=self.stub.url)
+        self.push(gateway)
+        self.stub.revoke_tokens()
+        self.assertEqual(self.push(gateway).response_code, '0')  # 401 -> new token -> retried
+
+    def test_initiate_payment_uses_shared_gateway(self):
+        from django.test import override_settings
+        from .models import MpesaTransaction
+        from .mpesa import reset_gateway
+
+        teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        student = User.objects.create_user(username='student', password='password', is_student=True)
+        lesson = Lesson.objects.create(teacher=teacher, student=student, topic="Scales",
+                                       start_time=timezone.now(), status='PENDING_PAYMENT')
+        self.client.login(username='student', password='password')
+        with override_settings(MPESA_API_BASE_URL=self.stub.url, MPESA_PUSH_WORKERS=0):
+            reset_gateway()
+            self.addCleanup(reset_gateway)
+            for _ in range(2):
+                MpesaTransaction.objects.filter(lesson=lesson).delete()
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.client.post(reverse('initiate_payment', args=[lesson.id]), {'phone_number': '0712345678'})
+        self.assertTrue(MpesaTransaction.objects.filter(lesson=lesson, amount=1500).exists())
+        self.assertEqual(self.stub.calls, {'token': 1, 'stk_push': 2})
+
+
+@override_settings(MPESA_PUSH_WORKERS=0)
+class QueuedPaymentTestCase(TestCase):
+    def setUp(self):
+        from .daraja_stub import DarajaStub
+        from .mpesa import reset_gateway
+        from django.core.cache import cache
+
+        cache.clear()
+        self.stub = DarajaStub().start()
+        self.addCleanup(self.stub.stop)
+        settings_override = override_settings(MPESA_API_BASE_URL=self.stub.url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_gateway()
+        self.addCleanup(reset_gateway)
+
+        self.client = Client()
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True)
+        self.lesson = Lesson.objects.create(teacher=self.teacher, student=self.student, topic="Scales",
+                                            start_time=timezone.now(), status='PENDING_PAYMENT')
+        self.client.login(username='student', password='password')
+
+    def pay(self, run_push=True):
+        with self.captureOnCommitCallbacks(execute=run_push):
+            return self.client.post(reverse('initiate_payment', args=[self.lesson.id]), {'phone_number': '0712345678'})
+
+    def status(self, payment_id):
+        return self.client.get(reverse('payment_status', args=[payment_id])).json()
+
+    def test_view_returns_before_the_push_is_sent(self):
+        from .models import MpesaTransaction
+
+        response = self.pay(run_push=False)
+        payment = MpesaTransaction.objects.get(lesson=self.lesson)
+        self.assertRedirects(response, reverse('payment_pending', args=[payment.id]))
+        self.assertEqual(self.stub.calls['stk_push'], 0)
+        self.assertEqual(self.status(payment.id)['state'], 'queued')
+
+    def test_status_follows_push_and_callback(self):
+        from .models import MpesaTransaction
+
+        self.pay()
+        payment = MpesaTransaction.objects.get(lesson=self.lesson)
+        self.assertEqual(self.stub.calls['stk_push'], 1)
+        self.assertEqual(self.status(payment.id)['state'], 'waiting_for_pin')
+
+        # Status is cached: polling again costs no payment queries
+        with self.assertNumQueries(0):  # session and user are cached too
+            self.status(payment.id)
+
+        self.client.post(reverse('mpesa_callback'), data={'Body': {'stkCallback': {
+            'ResultCode': 0, 'CheckoutRequestID': payment.checkout_request_id}}}, content_type='application/json')
+        process_pending()
+        self.assertEqual(self.status(payment.id)['state'], 'paid')
+
+        # A paid lesson goes straight to the status page instead of pushing again
+        self.assertRedirects(self.pay(), reverse('payment_pending', args=[payment.id]))
+        self.assertEqual(self.stub.calls['stk_push'], 1)
+
+    def test_rejected_push_can_be_retried(self):
+        from .models import MpesaTransaction
+
+        with override_settings(MPESA_API_BASE_URL='http://127.0.0.1:9/'):
+            from .mpesa import reset_gateway
+            reset_gateway()
+            with self.assertLogs('tuttiapp.payments', 'WARNING'):
+                self.pay()
+        payment = MpesaTransaction.objects.get(lesson=self.lesson)
+        self.assertEqual(self.status(payment.id)['state'], 'failed')
+
+        reset_gateway()
+        self.pay()
+        self.assertEqual(self.status(payment.id)['state'], 'waiting_for_pin')
+
+    def test_lost_push_can_be_retried_and_is_expired(self):
+        from .models import MpesaTransaction
+        from .mpesa import get_gateway
+        from .payments import send_stk_push
+        from .reconciliation import reconcile_pending
+
+        self.pay(run_push=False)  # the worker restarted before sending it
+        payment = MpesaTransaction.objects.get(lesson=self.lesson)
+        self.assertRedirects(self.pay(run_push=False), reverse('payment_pending', args=[payment.id]))
+
+        # Past QUEUED_TIMEOUT the sweep marks it failed, and the student may pay again
+        MpesaTransaction.objects.filter(pk=payment.pk).update(transaction_date=timezone.now() - datetime.timedelta(minutes=5))
+        self.assertEqual(reconcile_pending(client=get_gateway()).failed, 1)
+        self.assertEqual(self.status(payment.id)['state'], 'failed')
+        self.pay()
+        self.assertEqual(self.status(payment.id)['state'], 'waiting_for_pin')
+
+        # Even without the sweep, a stale queued push doesn't block a new attempt
+        MpesaTransaction.objects.filter(pk=payment.pk).update(push_status=MpesaTransaction.PUSH_QUEUED,
+                                                              transaction_date=timezone.now() - datetime.timedelta(minutes=5))
+        self.pay()
+        self.assertEqual(self.stub.calls['stk_push'], 2)
+
+        send_stk_push(payment.pk + 1000)  # gone before the push went out: nothing to do
+
+    def test_only_lesson_participants_see_the_payment(self):
+        from .models import MpesaTransaction
+
+        self.pay()
+        payment = MpesaTransaction.objects.get(lesson=self.lesson)
+        User.objects.create_user(username='other', password='password', is_student=True)
+        self.client.login(username='other', password='password')
+        self.assertEqual(self.client.get(reverse('payment_status', args=[payment.id])).status_code, 404)
+
+
+class LessonReminderTestCase(TestCase):
+    def setUp(self):
+        from .reminders import SmsStubReminderBackend
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True, phone_number='0712345678')
+        self.now = timezone.now()
+        self.backend = SmsStubReminderBackend()
+        self.backend.outbox = []
+
+    def lessons(self, count, hours_from_now=2, status='SCHEDULED'):
+        Lesson.objects.bulk_create([
+            Lesson(teacher=self.teacher, student=self.student, topic=f"L{i}", status=status,
+                   start_time=self.now + datetime.timedelta(hours=hours_from_now, seconds=i))
+            for i in range(count)
+        ])
+
+    def test_sweep_sends_each_due_reminder_once(self):
+        from .reminders import sweep
+
+        self.lessons(1000)
+        self.lessons(5, hours_from_now=48)  # outside the window
+        self.lessons(5, status='REQUESTED')  # not confirmed yet
+        report = sweep(window=datetime.timedelta(hours=24), batch_size=128, backend=self.backend, now=self.now)
+        self.assertEqual((report.sent, report.failed), (1000, 0))
+        self.assertEqual(len(self.backend.outbox), 1000)
+        self.assertEqual(self.backend.outbox[0][0], '254712345678')
+
+        again = sweep(window=datetime.timedelta(hours=24), backend=self.backend, now=self.now)
+        self.assertEqual(again.sent, 0)
+        self.assertEqual(Lesson.objects.filter(is_student_reminder_sent=True).count(), 1000)
+
+    def test_competing_claims_never_overlap(self):
+        from .reminders import claim
+
+        self.lessons(10)
+        ids = list(Lesson.objects.values_list('id', flat=True))
+        first = claim(ids[:6])
+        second = claim(ids)  # a second sweeper racing over the same rows
+        self.assertEqual(len(first), 6)
+        self.assertEqual(len(second), 4)
+        self.assertFalse({l.id for l in first} & {l.id for l in second})
+
+    def test_failed_delivery_is_released_for_retry(self):
+        from .reminders import ReminderBackend, sweep
+
+        class Broken(ReminderBackend):
+            def send(self, lesson):
+                raise ConnectionError("SMS gateway down")
+
+        self.lessons(3)
+        with self.assertLogs('tuttiapp.reminders', 'ERROR'):
+            report = sweep(window=datetime.timedelta(hours=24), backend=Broken(), now=self.now)
+        self.assertEqual(report.failed, 3)
+        self.assertEqual(sweep(window=datetime.timedelta(hours=24), backend=self.backend, now=self.now).sent, 3)
+
+    def test_failed_email_batch_is_released_for_retry(self):
+        from django.core import mail
+        from .reminders import EmailReminderBackend, sweep
+
+        User.objects.filter(pk=self.student.pk).update(email='student@example.com')
+        self.lessons(3)
+        window = datetime.timedelta(hours=24)
+        # Nothing listens on port 9: the SMTP connection is refused
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST='127.0.0.1', EMAIL_PORT=9):
+            with self.assertLogs('tuttiapp.reminders', 'ERROR'):
+                report = sweep(window=window, backend=EmailReminderBackend(), now=self.now)
+        self.assertEqual((report.sent, report.failed), (0, 3))
+        self.assertEqual(sweep(window=window, backend=EmailReminderBackend(), now=self.now).sent, 3)
+        self.assertEqual(len(mail.outbox), 3)
+
+
+class SchedulingTestCase(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True)
+        self.base = timezone.now().replace(microsecond=0) + datetime.timedelta(days=1)
+        self.lesson = Lesson.objects.create(teacher=self.teacher, student=self.student, topic="Scales",
+                                            start_time=self.base, duration_minutes=60)
+
+    def at(self, minutes):
+        return self.base + datetime.timedelta(minutes=minutes)
+
+    def test_end_time_is_kept_in_sync(self):
+        self.assertEqual(self.lesson.end_time, self.at(60))
+        Lesson.objects.bulk_create([Lesson(teacher=self.teacher, student=self.student, topic="Bulk",
+                                           start_time=self.at(300), duration_minutes=45)])
+        self.assertEqual(Lesson.objects.get(topic="Bulk").end_time, self.at(345))
+
+    def test_overlap_detection(self):
+        from .scheduling import is_slot_free
+
+        self.assertFalse(is_slot_free(self.teacher, self.at(30)))   # starts during the lesson
+        self.assertFalse(is_slot_free(self.teacher, self.at(-30)))  # runs into it
+        self.assertTrue(is_slot_free(self.teacher, self.at(60)))    # back to back is fine
+        self.assertTrue(is_slot_free(self.teacher, self.at(-60)))
+        self.assertTrue(is_slot_free(self.teacher, self.at(30), exclude=self.lesson))
+
+        self.lesson.status = 'CANCELLED'
+        self.lesson.save()
+        self.assertTrue(is_slot_free(self.teacher, self.at(30)))
+
+    def test_next_free_slots_skip_busy_time(self):
+        from .scheduling import next_free_slots
+
+        Lesson.objects.create(teacher=self.teacher, student=self.student, topic="Theory", start_time=self.at(90))
+        # busy 0-60 and 90-150: a 60 minute slot first fits at 150
+        self.assertEqual(next_free_slots(self.teacher, self.at(0), count=2), [self.at(150), self.at(210)])
+        # a 30 minute slot fits in the gap
+        self.assertEqual(next_free_slots(self.teacher, self.at(0), duration_minutes=30, count=1), [self.at(60)])
+
+    def test_overlap_query_is_bounded_by_the_index(self):
+        from .scheduling import conflicts
+
+        sql = str(conflicts(self.teacher, self.at(0)).query)
+        self.assertIn('"start_time" >', sql)
+        self.assertIn('"start_time" <', sql)
+
+    def test_forms_reject_double_booking(self):
+        from .forms import LessonRequestForm, LessonRescheduleForm
+
+        clash = {'topic': 'Jazz', 'start_time': timezone.localtime(self.at(15)).strftime('%Y-%m-%dT%H:%M')}
+        form = LessonRequestForm(clash, teacher=self.teacher)
+        self.assertFalse(form.is_valid())
+        self.assertIn('Next free slots', form.errors['start_time'][0])
+
+        # Moving a lesson by 15 minutes only overlaps itself, which is allowed
+        self.assertTrue(LessonRescheduleForm(clash, instance=self.lesson).is_valid())
+
+    def test_second_booking_of_a_checked_slot_is_refused(self):
+        from .forms import LessonRequestForm
+        from .scheduling import SlotTaken, book
+
+        # Two students both pass the form's check for the same free slot...
+        free = {'topic': 'Jazz', 'start_time': timezone.localtime(self.at(120)).strftime('%Y-%m-%dT%H:%M')}
+        first, second = (LessonRequestForm(free, teacher=self.teacher) for _ in range(2))
+        self.assertTrue(first.is_valid() and second.is_valid())
+
+        # ...but only the first insert gets it
+        for form in (first, second):
+            form.instance.teacher, form.instance.student = self.teacher, self.student
+        book(first.save(commit=False))
+        with self.assertRaises(SlotTaken):
+            book(second.save(commit=False))
+        self.assertEqual(Lesson.objects.filter(teacher=self.teacher, topic='Jazz').count(), 1)
+
+    def test_availability_endpoint(self):
+        self.client.login(username='student', password='password')
+        response = self.client.get(reverse('teacher_availability', args=[self.teacher.id]),
+                                   {'start': self.at(30).isoformat()})
+        data = response.json()
+        self.assertFalse(data['is_free'])
+        self.assertEqual(len(data['next_free_slots']), 3)
+
+
+class TeacherMarketplaceTestCase(TestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+            self.student = User.objects.create_user(username='student', password='password', is_student=True)
+        self.start = timezone.now().replace(microsecond=0) + datetime.timedelta(days=2)
+
+    def card(self):
+        from .models import TeacherCard
+        return TeacherCard.objects.get(teacher=self.teacher)
+
+    def test_card_follows_lessons(self):
+        self.assertEqual(self.card().lessons_taught, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            lesson = Lesson.objects.create(teacher=self.teacher, student=self.student, topic="Jazz Piano",
+                                           start_time=self.start, status='COMPLETED', price=2000)
+        card = self.card()
+        self.assertEqual((card.lessons_taught, card.min_price, card.topics), (1, 2000, "Jazz Piano"))
+        self.assertIsNotNone(card.next_free_slot)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            lesson.delete()
+        self.assertEqual(self.card().lessons_taught, 0)
+
+    def test_profile_change_bumps_version(self):
+        version = self.card().version
+        self.teacher.username = 'maestro'
+        self.teacher.save()
+        self.assertEqual(self.card().version, version + 1)
+        # Logging in only touches last_login, which isn't on the card
+        self.client.login(username='maestro', password='password')
+        self.assertEqual(self.card().version, version + 1)
+
+    def test_filters(self):
+        from .marketplace import teacher_cards
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Lesson.objects.create(teacher=self.teacher, student=self.student, topic="Jazz Piano", start_time=self.start)
+        self.assertEqual(teacher_cards('jazz').count(), 1)
+        self.assertEqual(teacher_cards('violin').count(), 0)
+        self.assertEqual(teacher_cards(available_within_days=7).count(), 1)
+
+        self.card().__class__.objects.update(next_free_slot=self.start + datetime.timedelta(days=30))
+        self.assertEqual(teacher_cards(available_within_days=7).count(), 0)
+
+    def test_listing_is_paginated_with_a_flat_query_count(self):
+        from .datagen import seed_users
+        from .marketplace import refresh_stale_cards
+
+        seed_users(30, 'teacher')
+        self.assertEqual(refresh_stale_cards(), 30)
+
+        self.client.login(username='student', password='password')
+        url = reverse('teacher_list')
+        self.client.get(url)  # caches the logged-in user
+        # count, page of cards
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(len(response.context['teachers']), 24)
+        self.assertTrue(response.context['teachers'].has_next())
+
+        response = self.client.get(url, {'page': 2})
+        self.assertEqual(len(response.context['teachers']), 7)
+
+
+class CacheLayerTestCase(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        from . import cache as app_cache
+
+        cache.clear()
+        app_cache.reset_stats()
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True)
+
+    def test_saves_retire_versioned_entries(self):
+        from . import cache as app_cache
+
+        loads = []
+        def load():
+            loads.append(1)
+            return 'profile of teacher'
+
+        app_cache.get_or_set(app_cache.USER, self.teacher.pk, 'lessons', load)
+        app_cache.get_or_set(app_cache.USER, self.teacher.pk, 'lessons', load)
+        self.assertEqual(len(loads), 1)
+
+        self.teacher.first_name = 'Ada'
+        self.teacher.save()
+        app_cache.get_or_set(app_cache.USER, self.teacher.pk, 'lessons', load)
+        self.assertEqual(len(loads), 2)
+
+        # Lessons have stamps of their own
+        lesson = Lesson.objects.create(teacher=self.teacher, student=self.student, topic="Scales", start_time=timezone.now())
+        stamp = app_cache.get_stamp(app_cache.LESSON, lesson.pk)
+        lesson.save()
+        self.assertGreater(app_cache.get_stamp(app_cache.LESSON, lesson.pk), stamp)
+
+        with self.assertRaises(ValueError):
+            app_cache.make_key('nope', 1)
+
+    def test_hit_miss_view(self):
+        from .stats import get_admin_stats
+
+        get_admin_stats()
+        get_admin_stats()
+        self.client.login(username='student', password='password')
+        self.assertEqual(self.client.get(reverse('cache_stats')).status_code, 302)
+
+        self.client.login(username='admin', password='password')
+        data = self.client.get(reverse('cache_stats')).json()
+        self.assertEqual(data['namespaces']['stats'], {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+    def test_file_backend(self):
+        import tempfile
+        from . import cache as app_cache
+
+        with tempfile.TemporaryDirectory() as location:
+            backend = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+            with override_settings(CACHES={'default': backend}):
+                self.assertEqual(app_cache.get_or_set(app_cache.LESSON, 1, 'x', lambda: 'v'), 'v')
+                self.assertEqual(app_cache.get_or_set(app_cache.LESSON, 1, 'x', lambda: 'w'), 'v')
+                app_cache.bump(app_cache.LESSON, 1)
+                self.assertEqual(app_cache.get_or_set(app_cache.LESSON, 1, 'x', lambda: 'w'), 'w')
+
+
+class CachedSessionTestCase(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.user = User.objects.create_user(username='student', password='password', is_student=True)
+        self.client.login(username='student', password='password')
+        self.client.get(reverse('teacher_list'))  # caches the session and the user
+
+    def test_no_queries_before_the_view(self):
+        from django.contrib.auth import SESSION_KEY
+        from django.contrib.sessions.backends.cached_db import SessionStore
+
+        self.assertIsInstance(self.client.session, SessionStore)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('cache_stats'))  # superusers only: no view queries
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(int(self.client.session[SESSION_KEY]), self.user.pk)
+
+    def test_user_save_refreshes_the_cached_user(self):
+        self.user.is_teacher = True
+        self.user.save()
+        response = self.client.get(reverse('teacher_list'))
+        self.assertTrue(response.wsgi_request.user.is_teacher)
+
+        # Deactivated users are logged out straight away
+        self.user.is_active = False
+        self.user.save()
+        self.assertFalse(self.client.get(reverse('teacher_list')).wsgi_request.user.is_authenticated)
+
+
+class BulkLessonActionsTestCase(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.other = User.objects.create_user(username='other', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True)
+        self.start = timezone.now() + datetime.timedelta(days=1)
+        self.client.login(username='teacher', password='password')
+
+    def lessons(self, count, status='REQUESTED', teacher=None):
+        return [
+            Lesson.objects.create(teacher=teacher or self.teacher, student=self.student, topic=f"Lesson {i}",
+                                  start_time=self.start + datetime.timedelta(hours=2 * i), status=status).pk
+            for i in range(count)
+        ]
+
+    def post(self, action, ids):
+        return self.client.post(reverse('bulk_lessons', args=[action]), data={'ids': ids},
+                                content_type='application/json')
+
+    def test_per_id_outcomes(self):
+        requested = self.lessons(2)
+        scheduled = self.lessons(1, status='SCHEDULED')
+        not_mine = self.lessons(1, teacher=self.other)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            data = self.post('approve', requested + scheduled + not_mine + [999999]).json()
+        self.assertEqual(data['changed'], 2)
+        results = data['results']
+        self.assertEqual(results[str(requested[0])], {'outcome': 'updated', 'status': 'SCHEDULED'})
+        self.assertEqual(results[str(scheduled[0])], {'outcome': 'invalid_status', 'status': 'SCHEDULED'})
+        self.assertEqual(results[str(not_mine[0])]['outcome'], 'not_found')
+        self.assertEqual(results['999999']['outcome'], 'not_found')
+        self.assertEqual(Lesson.objects.filter(status='SCHEDULED', teacher=self.teacher).count(), 3)
+        self.assertEqual(Lesson.objects.get(pk=not_mine[0]).status, 'REQUESTED')
+
+        data = self.post('delete', requested).json()
+        self.assertEqual(data['changed'], 2)
+        self.assertFalse(Lesson.objects.filter(pk__in=requested).exists())
+
+    def test_query_count_does_not_grow_with_the_batch(self):
+        few, many = self.lessons(2, status='SCHEDULED'), self.lessons(40, status='SCHEDULED')
+        self.post('complete', few)  # warm the session/user caches
+        # savepoint, read, conditional UPDATE, release (the card refresh runs on commit)
+        with self.assertNumQueries(4):
+            self.post('complete', many)
+        self.assertEqual(Lesson.objects.filter(status='PENDING_PAYMENT').count(), 42)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.post('teleport', [1]).status_code, 400)
+        self.assertEqual(self.post('approve', ['x']).status_code, 400)
+        self.assertEqual(self.client.get(reverse('bulk_lessons', args=['approve'])).status_code, 405)
+
+
+class LessonStateMachineTestCase(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True)
+        self.lesson = Lesson.objects.create(teacher=self.teacher, student=self.student, topic="Scales",
+                                            start_time=timezone.now() + datetime.timedelta(days=1), status='REQUESTED')
+
+    def test_only_declared_edges(self):
+        from .models import InvalidTransition, lesson_transitioned
+
+        events = []
+        def record(sender, lesson, from_status, to_status, **kwargs):
+            events.append((from_status, to_status))
+        lesson_transitioned.connect(record)
+        self.addCleanup(lesson_transitioned.disconnect, record)
+
+        with self.assertRaises(InvalidTransition):
+            self.lesson.transition('PAID')
+        with self.assertNumQueries(1):  # just the conditional UPDATE
+            self.lesson.transition('SCHEDULED')
+        self.lesson.transition('PENDING_PAYMENT')
+        self.assertEqual(events, [('REQUESTED', 'SCHEDULED'), ('SCHEDULED', 'PENDING_PAYMENT')])
+        self.assertEqual(Lesson.objects.get(pk=self.lesson.pk).status, 'PENDING_PAYMENT')
+
+    def test_stale_instance_does_not_overwrite(self):
+        from .models import InvalidTransition
+
+        stale = Lesson.objects.get(pk=self.lesson.pk)
+        self.lesson.transition('CANCELLED')
+        with self.assertRaises(InvalidTransition) as caught:
+            stale.transition('SCHEDULED')
+        self.assertEqual(caught.exception.current, 'CANCELLED')
+        self.assertEqual(Lesson.objects.get(pk=self.lesson.pk).status, 'CANCELLED')
+
+    def test_views_report_illegal_moves(self):
+        self.client.login(username='teacher', password='password')
+        response = self.client.post(reverse('mark_lesson_paid', args=[self.lesson.pk]), follow=True)
+        self.assertContains(response, "already Requested")
+        self.assertEqual(Lesson.objects.get(pk=self.lesson.pk).status, 'REQUESTED')
+
+        self.client.post(reverse('approve_lesson', args=[self.lesson.pk]))
+        self.assertEqual(Lesson.objects.get(pk=self.lesson.pk).status, 'SCHEDULED')
+
+    def test_views_report_a_lesson_deleted_meanwhile(self):
+        from django.contrib.messages import get_messages
+        from django.contrib.messages.storage.fallback import FallbackStorage
+        from django.test import RequestFactory
+        from .views import _transition
+
+        # The lesson is loaded, then deleted by another request before the UPDATE
+        request = RequestFactory().post('/')
+        request.session = self.client.session
+        request._messages = FallbackStorage(request)
+        Lesson.objects.filter(pk=self.lesson.pk).delete()
+        self.assertFalse(_transition(request, self.lesson, 'SCHEDULED'))
+        self.assertEqual([str(m) for m in get_messages(request)], ["This lesson no longer exists."])
+
+
+class LessonTransitionConcurrencyTestCase(TransactionTestCase):
+    """Several requests act on the same lessons at once: exactly one change per lesson must win."""
+    ROUNDS = 10
+    THREADS = 6
+
+    def test_concurrent_transitions(self):
+        import threading
+        from django.db import OperationalError, connection
+        from .models import InvalidTransition, lesson_transitioned
+
+        teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        student = User.objects.create_user(username='student', password='password', is_student=True)
+        start = timezone.now() + datetime.timedelta(days=1)
+        lessons = [Lesson.objects.create(teacher=teacher, student=student, topic=f"L{i}",
+                                         start_time=start + datetime.timedelta(hours=i))
+                   for i in range(self.ROUNDS)]
+
+        events, lock = [], threading.Lock()
+        def record(sender, lesson, from_status, to_status, **kwargs):
+            with lock:
+                events.append((lesson.pk, from_status, to_status))
+        lesson_transitioned.connect(record)
+        self.addCleanup(lesson_transitioned.disconnect, record)
+
+        # every thread starts from SCHEDULED and wants a different next status
+        targets = ('RESCHEDULE_PENDING', 'PENDING_PAYMENT', 'CANCELLED', 'COMPLETED')
+        wins, errors = [], []
+
+        def worker(lesson_id, to_status, barrier):
+            try:
+                lesson = Lesson.objects.only('id', 'status', 'teacher_id').get(pk=lesson_id)
+                barrier.wait()
+                for _ in range(20):
+                    try:
+                        lesson.transition(to_status)
+                        with lock:
+                            wins.append((lesson_id, to_status))
+                        break
+                    except InvalidTransition:
+                        break
+                    except OperationalError:  # SQLite "database is locked": try again
+                        continue
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        for lesson in lessons:
+            barrier = threading.Barrier(self.THREADS)
+            threads = [threading.Thread(target=worker, args=(lesson.pk, targets[i % len(targets)], barrier))
+                       for i in range(self.THREADS)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(lesson_id for lesson_id, _ in wins), [lesson.pk for lesson in lessons])
+        self.assertEqual(len(events), self.ROUNDS)
+        final = dict(Lesson.objects.values_list('pk', 'status'))
+        for lesson_id, to_status in wins:
+            self.assertEqual(final[lesson_id], to_status)
+
+
+class LessonSeriesTestCase(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True)
+        self.now = timezone.now().replace(microsecond=0)
+        self.first = self.now + datetime.timedelta(days=1)
+
+    def create(self, occurrences=52, interval_weeks=1):
+        from .series import create_series
+        return create_series(self.teacher, self.student, "Violin", self.first, interval_weeks, occurrences)
+
+    def test_only_the_window_is_created(self):
+        from .series import materialize_due
+
+        with override_settings(LESSON_SERIES_WINDOW_WEEKS=4):
+            # 2 savepoints (x2), insert the rule, lock it, lock the teacher, busy check, one INSERT for all
+            # lessons, update the rule
+            with self.assertNumQueries(10):
+                series = self.create()
+            self.assertEqual(series.lessons.count(), 4)  # day 1, 8, 15, 22
+            self.assertEqual(set(series.lessons.values_list('status', flat=True)), {'REQUESTED'})
+
+            # Nothing new is due until time moves on
+            self.assertEqual(materialize_due(self.now), (0, 0))
+            self.assertEqual(materialize_due(self.now + datetime.timedelta(weeks=2)), (1, 2))
+
+        series.refresh_from_db()
+        self.assertEqual(series.materialized_count, 6)
+        self.assertEqual(series.next_start, self.first + datetime.timedelta(weeks=6))
+        starts = list(series.lessons.order_by('start_time').values_list('start_time', flat=True))
+        self.assertEqual(starts[1] - starts[0], datetime.timedelta(weeks=1))
+
+    def test_series_ends_and_skips_clashes(self):
+        from .series import materialize_due
+
+        Lesson.objects.create(teacher=self.teacher, student=self.student, topic="Other",
+                              start_time=self.first + datetime.timedelta(weeks=2, minutes=30))
+        series = self.create(occurrences=3, interval_weeks=2)
+        self.assertEqual(series.lessons.count(), 1)  # week 0; week 2 clashes
+        materialize_due(self.now + datetime.timedelta(weeks=10))
+        series.refresh_from_db()
+        self.assertEqual(series.lessons.count(), 2)  # + week 4, then the series is done
+        self.assertIsNone(series.next_start)
+        self.assertEqual(materialize_due(self.now + datetime.timedelta(weeks=20)), (0, 0))
+
+    def test_request_and_approve_as_a_whole(self):
+        from .models import LessonSeries
+
+        self.client.login(username='student', password='password')
+        self.client.post(reverse('request_lesson', args=[self.teacher.pk]), {
+            'topic': 'Cello', 'start_time': timezone.localtime(self.first).strftime('%Y-%m-%dT%H:%M'),
+            'repeat': 1, 'repeat_count': 12,
+        })
+        series = LessonSeries.objects.get()
+        self.assertEqual((series.occurrences, series.lessons.count()), (12, 4))
+
+        self.client.login(username='teacher', password='password')
+        self.client.post(reverse('approve_lesson', args=[series.lessons.first().pk]))
+        series.refresh_from_db()
+        self.assertEqual(series.status, LessonSeries.ACTIVE)
+        self.assertEqual(set(series.lessons.values_list('status', flat=True)), {'SCHEDULED'})
+
+        # Later occurrences come in already scheduled
+        from .series import materialize_due
+        materialize_due(self.now + datetime.timedelta(weeks=1))
+        self.assertEqual(series.lessons.filter(status='SCHEDULED').count(), 5)
+
+    def test_bulk_approve_activates_the_series(self):
+        from .bulk import apply_bulk_action
+        from .models import LessonSeries
+        from .series import materialize_due
+
+        series = self.create(occurrences=12)
+        apply_bulk_action(self.teacher, 'approve', series.lessons.values_list('pk', flat=True))
+        series.refresh_from_db()
+        self.assertEqual(series.status, LessonSeries.ACTIVE)
+
+        # so the occurrences created later don't need approving one by one
+        materialize_due(self.now + datetime.timedelta(weeks=1))
+        self.assertEqual(set(series.lessons.values_list('status', flat=True)), {'SCHEDULED'})
+
+    def test_decline_removes_the_series(self):
+        from .models import LessonSeries
+
+        series = self.create(occurrences=5)
+        self.client.login(username='teacher', password='password')
+        self.client.post(reverse('decline_lesson', args=[series.lessons.first().pk]))
+        series.refresh_from_db()
+        self.assertEqual(series.status, LessonSeries.CANCELLED)
+        self.assertFalse(series.lessons.exists())
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        from .models import MpesaTransaction
+
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.other = User.objects.create_user(username='other', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True)
+        day = timezone.make_aware(datetime.datetime(2026, 3, 10, 9, 0))
+        for i, (teacher, status) in enumerate([(self.teacher, 'PAID'), (self.teacher, 'SCHEDULED'), (self.other, 'PAID')]):
+            lesson = Lesson.objects.create(teacher=teacher, student=self.student, topic=f"Topic, {i}",
+                                           start_time=day + datetime.timedelta(days=i), status=status)
+            if status == 'PAID':
+                MpesaTransaction.objects.create(lesson=lesson, phone_number='254712345678', amount=1500,
+                                                is_successful=True, mpesa_receipt_number=f'R{i}')
+
+    def download(self, kind, **params):
+        response = self.client.get(reverse('export_data', args=[kind]), params)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_csv_export_with_filters(self):
+        import csv
+
+        self.client.login(username='admin', password='password')
+        response, body = self.download('lessons', teacher=self.teacher.pk, **{'from': '2026-03-10', 'to': '2026-03-11'})
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment;', response['Content-Disposition'])
+        rows = list(csv.DictReader(body.splitlines()))
+        self.assertEqual([row['topic'] for row in rows], ["Topic, 0", "Topic, 1"])
+        self.assertEqual(rows[0]['teacher_username'], 'teacher')
+
+        _, body = self.download('lessons', status='PAID', **{'from': '2026-03-11'})
+        self.assertEqual(len(body.splitlines()), 2)  # header + the other teacher's lesson
+
+    def test_csv_cells_cannot_run_formulas(self):
+        import csv
+
+        Lesson.objects.filter(topic="Topic, 0").update(topic='=HYPERLINK("http://evil.example","Click")')
+        User.objects.filter(pk=self.teacher.pk).update(username='@SUM(1+1)')
+        self.client.login(username='admin', password='password')
+        _, body = self.download('lessons', teacher=self.teacher.pk)
+        rows = list(csv.DictReader(body.splitlines()))
+        self.assertEqual(rows[0]['topic'], '\'=HYPERLINK("http://evil.example","Click")')
+        self.assertEqual(rows[0]['teacher_username'], "'@SUM(1+1)")
+        self.assertEqual(rows[1]['topic'], "Topic, 1")
+
+        _, body = self.download('lessons', format='jsonl', teacher=self.teacher.pk)
+        self.assertEqual(json.loads(body.splitlines()[0])['teacher_username'], '@SUM(1+1)')  # not a spreadsheet format
+
+    def test_jsonl_transactions_and_errors(self):
+        self.client.login(username='admin', password='password')
+        _, body = self.download('transactions', format='jsonl', status='paid')
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(sorted(row['mpesa_receipt_number'] for row in rows), ['R0', 'R2'])
+
+        self.assertEqual(self.client.get(reverse('export_data', args=['lessons']), {'status': 'NOPE'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('export_data', args=['users'])).status_code, 400)
+        self.client.login(username='teacher', password='password')
+        self.assertEqual(self.client.get(reverse('export_data', args=['lessons'])).status_code, 302)
+
+    async def test_asgi_streams_an_async_iterator(self):
+        from asgiref.sync import sync_to_async
+        from .exports import stream
+
+        await self.async_client.aforce_login(self.admin)
+        response = await self.async_client.get(reverse('export_data', args=['lessons']), {'teacher': self.teacher.pk})
+        self.assertTrue(response.is_async)  # sent line by line, not collected into a list first
+        body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertEqual(body, ''.join(await sync_to_async(lambda: list(stream('lessons', teacher=self.teacher.pk)))()))
+
+        response = await self.async_client.get(reverse('export_data', args=['lessons']), {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_command(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        out = StringIO()
+        call_command('export_data', 'lessons', '--format', 'jsonl', '--teacher', str(self.other.pk), stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 1)
+
+
+class AnalyticsRollupTestCase(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True)
+        self.day = timezone.localdate() - datetime.timedelta(days=3)
+        self.start = timezone.make_aware(datetime.datetime.combine(self.day, datetime.time(10, 0)))
+
+    def lesson(self, status='SCHEDULED', start=None, **extra):
+        return Lesson.objects.create(teacher=self.teacher, student=self.student, topic="Scales",
+                                     start_time=start or self.start, status=status, **extra)
+
+    def rollup(self, day=None):
+        from .models import DailyLessonRollup
+        return DailyLessonRollup.objects.filter(day=day or self.day, teacher=self.teacher).first()
+
+    def test_refresh_matches_lessons_and_is_incremental(self):
+        from .rollups import refresh_rollups
+
+        self.lesson('SCHEDULED', duration_minutes=45)
+        self.lesson('CANCELLED', start=self.start + datetime.timedelta(hours=2))
+        completed = self.lesson('SCHEDULED', start=self.start + datetime.timedelta(hours=4))
+        completed.transition('COMPLETED')
+
+        # Nothing changed after the first run: the second recomputes nothing
+        later = timezone.now() + datetime.timedelta(hours=1)
+        self.assertEqual(refresh_rollups(now=later), (1, 1))
+        row = self.rollup()
+        self.assertEqual((row.scheduled, row.cancelled, row.completed), (1, 1, 1))
+        self.assertEqual(row.booked_minutes, 45 + 60)
+        self.assertEqual(row.taught_minutes, 60)
+
+        self.assertEqual(refresh_rollups(now=later), (0, 0))
+
+    def test_moved_and_deleted_lessons_fix_the_old_day(self):
+        from .rollups import refresh_rollups
+
+        moved = self.lesson()
+        gone = self.lesson(start=self.start + datetime.timedelta(hours=3))
+        refresh_rollups()
+        self.assertEqual(self.rollup().scheduled, 2)
+
+        next_day = self.start + datetime.timedelta(days=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            moved.start_time = next_day
+            moved.save()
+            gone.delete()
+        # Both days get recomputed even if the watermark alone would miss the old one
+        refresh_rollups(now=timezone.now() + datetime.timedelta(hours=1))
+        self.assertIsNone(self.rollup())
+        self.assertEqual(self.rollup(next_day.date()).scheduled, 1)
+
+    def test_dirty_days_survive_a_rolled_back_transaction(self):
+        from django.db import transaction
+        from .models import RollupDirtyDay
+        from .rollups import mark_dirty
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    mark_dirty(self.start)
+                    raise ValueError
+            except ValueError:
+                pass
+            with transaction.atomic():
+                mark_dirty(self.start + datetime.timedelta(days=1))
+        self.assertIn(self.day + datetime.timedelta(days=1), RollupDirtyDay.objects.values_list('day', flat=True))
+
+    def test_payment_latency(self):
+        from .rollups import analytics_summary, refresh_rollups
+
+        lesson = self.lesson()
+        lesson.transition('COMPLETED')
+        Lesson.objects.filter(pk=lesson.pk).update(completed_at=timezone.now() - datetime.timedelta(hours=2))
+        lesson.refresh_from_db()
+        lesson.transition('PAID')
+        refresh_rollups(full=True)
+
+        row = self.rollup()
+        self.assertEqual((row.paid, row.payment_latency_lessons), (1, 1))
+        self.assertAlmostEqual(row.payment_latency_seconds, 2 * 60 * 60, delta=5)
+        summary = analytics_summary(30)
+        self.assertAlmostEqual(summary['average_payment_latency'].total_seconds(), 2 * 60 * 60, delta=5)
+        self.assertEqual(summary['teacher_utilisation'][0]['taught_minutes'], 60)
+
+    def test_analytics_page_reads_only_rollups(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .models import MpesaTransaction
+        from .rollups import refresh_rollups
+        from .stats import record_payment
+
+        paid = self.lesson('PAID')
+        record_payment(MpesaTransaction.objects.create(lesson=paid, phone_number='254712345678', amount=2000,
+                                                       is_successful=True, mpesa_receipt_number='R1'))
+        refresh_rollups()
+
+        self.client.login(username='admin', password='password')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('analytics'), {'days': 7})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'teacher')
+        self.assertEqual(response.context['revenue_total'], 2000)
+        self.assertFalse([q['sql'] for q in queries if 'tuttiapp_lesson"' in q['sql']])
+
+        self.client.login(username='teacher', password='password')
+        self.assertEqual(self.client.get(reverse('analytics')).status_code, 302)
+
+
+class PaymentReconciliationTestCase(TestCase):
+    STATEMENT = (
+        "Account Holder:,Tutti Music\n"
+        "Time Period:,01 Mar 2026 - 31 Mar 2026\n"
+        "\n"
+        "Receipt No.,Completion Time,Initiation Time,Details,Transaction Status,Paid In,Withdrawn,Balance\n"
+        "RCP1LOST,2026-03-10 09:05:00,2026-03-10 09:04:00,Pay Bill Online from 254712345678 - STUDENT Acc. Tutti-{lost},Completed,\"1,500.00\",,9000\n"
+        "RCP2OK,2026-03-10 09:06:00,2026-03-10 09:05:00,Pay Bill Online from 254712345678 - STUDENT Acc. Tutti-{ok},Completed,1500.00,,10500\n"
+        "RCP3SHORT,2026-03-10 09:07:00,2026-03-10 09:06:00,Pay Bill Online from 254712345678 - STUDENT Acc. Tutti-{short},Completed,500.00,,11000\n"
+        "RCP4WHO,2026-03-10 09:08:00,2026-03-10 09:07:00,Pay Bill Online from 254700000000 - SOMEONE Acc. 12345,Completed,700.00,,11700\n"
+        "RCP5FEE,2026-03-10 09:09:00,2026-03-10 09:09:00,Withdrawal Charge,Completed,,30.00,11670\n"
+    )
+
+    def setUp(self):
+        from .models import MpesaTransaction
+
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True)
+        self.transactions = {}
+        for i, name in enumerate(['lost', 'ok', 'short', 'pending_paid', 'pending_cancelled', 'pending_running']):
+            lesson = Lesson.objects.create(teacher=self.teacher, student=self.student, topic=name, price=1500,
+                                           start_time=timezone.now() - datetime.timedelta(days=1, hours=i),
+                                           status='PAID' if name == 'ok' else 'PENDING_PAYMENT')
+            self.transactions[name] = MpesaTransaction.objects.create(
+                lesson=lesson, phone_number='254712345678', amount=1500, checkout_request_id=f'ws_CO_{name}',
+                is_successful=name == 'ok', mpesa_receipt_number='RCP2OK' if name == 'ok' else None,
+            )
+        MpesaTransaction.objects.update(transaction_date=timezone.now() - datetime.timedelta(hours=1))
+
+    def statement(self):
+        return self.STATEMENT.format(**{name: t.lesson_id for name, t in self.transactions.items()}).splitlines()
+
+    def test_statement_fixes_lost_callbacks_and_reports_mismatches(self):
+        from .models import PlatformCounter
+        from .reconciliation import AMOUNT_MISMATCH, UNMATCHED, reconcile_statement
+
+        report = reconcile_statement(self.statement())
+        self.assertEqual((report.lines, report.matched, report.fixed), (4, 1, 1))
+        self.assertEqual(dict(report.mismatch_counts), {AMOUNT_MISMATCH: 1, UNMATCHED: 1})
+
+        lost = self.transactions['lost']
+        lost.refresh_from_db()
+        self.assertTrue(lost.is_successful)
+        self.assertEqual(lost.mpesa_receipt_number, 'RCP1LOST')
+        self.assertEqual(Lesson.objects.get(pk=lost.lesson_id).status, 'PAID')
+        self.assertEqual(PlatformCounter.objects.get(name=PlatformCounter.REVENUE).value, 1500)
+        self.assertNotEqual(Lesson.objects.get(pk=self.transactions['short'].lesson_id).status, 'PAID')
+
+        # Running it again changes nothing
+        report = reconcile_statement(self.statement())
+        self.assertEqual((report.matched, report.fixed), (2, 0))
+
+    def test_status_query_settles_pending_pushes(self):
+        from .daraja_stub import DarajaStub
+        from .mpesa import MpesaGateway
+        from .reconciliation import (PAID_WITHOUT_PAYMENT, ReconciliationReport, check_paid_lessons,
+                                     reconcile_pending, reconcile_statement)
+
+        with DarajaStub() as stub:
+            stub.query_results = {
+                'ws_CO_pending_paid': ('0', 'The service request is processed successfully.'),
+                'ws_CO_pending_cancelled': ('1032', 'Request cancelled by user'),
+                'ws_CO_lost': ('0', 'The service request is processed successfully.'),
+            }
+            report = reconcile_pending(client=MpesaGateway(base_url=stub.url))
+            self.assertEqual(stub.calls['stk_query'], 5)  # every unpaid push older than 10 minutes
+        self.assertEqual((report.fixed, report.failed, report.pending), (2, 1, 2))
+
+        paid, cancelled = self.transactions['pending_paid'], self.transactions['pending_cancelled']
+        paid.refresh_from_db()
+        cancelled.refresh_from_db()
+        self.assertEqual((paid.is_successful, paid.result_code, paid.mpesa_receipt_number), (True, 0, None))
+        self.assertEqual((cancelled.payment_state, cancelled.result_code), ('failed', 1032))
+        self.assertEqual(Lesson.objects.get(pk=paid.lesson_id).status, 'PAID')
+
+        # The statement later fills in the receipt the query couldn't give
+        reconcile_statement(self.statement())
+        lost = self.transactions['lost']
+        lost.refresh_from_db()
+        self.assertEqual(lost.mpesa_receipt_number, 'RCP1LOST')
+
+        # A lesson marked PAID by hand, with no payment behind it
+        Lesson.objects.filter(pk=self.transactions['short'].lesson_id).update(status='PAID')
+        report = check_paid_lessons(ReconciliationReport())
+        self.assertEqual(report.mismatch_counts[PAID_WITHOUT_PAYMENT], 1)
+
+    def test_command_dry_run(self):
+        import tempfile
+        from io import StringIO
+        from django.core.management import call_command
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as statement:
+            statement.write('\n'.join(self.statement()))
+        self.addCleanup(os.remove, statement.name)
+        out = StringIO()
+        call_command('reconcile_payments', statement=[statement.name], dry_run=True, stdout=out)
+        self.assertIn("1 would fix", out.getvalue())
+        self.assertIn("unmatched: 1", out.getvalue())
+        self.assertNotEqual(Lesson.objects.get(pk=self.transactions['lost'].lesson_id).status, 'PAID')
+
+
+class UserDeletionTestCase(TestCase):
+    def setUp(self):
+        from .models import MpesaTransaction
+
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+        self.student = User.objects.create_user(username='student', password='password', is_student=True)
+        start = timezone.now() - datetime.timedelta(days=30)
+        for i, status in enumerate(['PAID', 'SCHEDULED', 'CANCELLED', 'PENDING_PAYMENT']):
+            lesson = Lesson.objects.create(teacher=self.teacher, student=self.student, topic=f"Lesson {i}",
+                                           start_time=start + datetime.timedelta(days=i), status=status)
+            MpesaTransaction.objects.create(lesson=lesson, phone_number='254712345678', amount=1500,
+                                            is_successful=status == 'PAID')
+        self.client.login(username='admin', password='password')
+
+    def delete(self, user):
+        return self.client.post(reverse('delete_user', args=[user.pk]))
+
+    def test_small_user_deleted_inline(self):
+        from .models import MpesaTransaction
+
+        Lesson.objects.filter(status='PAID').delete()
+        with self.settings(USER_DELETE_INLINE_LIMIT=100):
+            self.delete(self.teacher)
+        self.assertFalse(User.objects.filter(pk=self.teacher.pk).exists())
+        self.assertEqual(MpesaTransaction.objects.count(), 0)
+
+    def test_small_user_with_paid_lessons_is_anonymised_inline(self):
+        from .deletion import INLINE, delete_user
+        from .models import MpesaTransaction
+
+        with self.settings(USER_DELETE_INLINE_LIMIT=100):
+            self.assertEqual(delete_user(self.teacher), INLINE)
+        teacher = User.objects.get(pk=self.teacher.pk)
+        self.assertEqual((teacher.username, teacher.is_active, teacher.deletion_requested_at),
+                         (f'deleted-{teacher.pk}', False, None))
+        self.assertEqual(list(Lesson.objects.values_list('status', flat=True)), ['PAID'])
+        self.assertEqual(MpesaTransaction.objects.get().is_successful, True)
+
+    def test_large_user_disabled_then_purged_keeping_paid_lessons(self):
+        from .deletion import purge_deleted_users
+        from .models import MpesaTransaction, PlatformCounter, TeacherCard
+
+        teacher_client = Client()
+        teacher_client.login(username='teacher', password='password')
+
+        with self.settings(USER_DELETE_INLINE_LIMIT=3):
+            # The request only counts up to the limit and saves the user, whatever their history
+            with self.assertNumQueries(8):
+                self.delete(self.teacher)
+        teacher = User.objects.get(pk=self.teacher.pk)
+        self.assertFalse(teacher.is_active)
+        self.assertIsNotNone(teacher.deletion_requested_at)
+        self.assertEqual(Lesson.objects.count(), 4)
+        self.assertFalse(TeacherCard.objects.filter(teacher_id=teacher.pk).exists())
+        self.assertEqual(PlatformCounter.objects.get(name=PlatformCounter.TEACHERS).value, 0)
+        self.assertEqual(teacher_client.get(reverse('dashboard')).status_code, 302)  # logged out
+
+        self.assertEqual(purge_deleted_users(batch_size=2), (1, 3))
+        teacher.refresh_from_db()
+        self.assertEqual(teacher.username, f'deleted-{teacher.pk}')
+        self.assertIsNone(teacher.deletion_requested_at)
+        self.assertEqual(list(Lesson.objects.values_list('status', flat=True)), ['PAID'])
+        self.assertEqual(MpesaTransaction.objects.get().is_successful, True)
+        self.assertEqual(purge_deleted_users(), (0, 0))
+
+    def test_purge_deletes_users_without_paid_lessons(self):
+        from .deletion import SCHEDULED, delete_user, purge_deleted_users
+
+        Lesson.objects.filter(status='PAID').delete()
+        with self.settings(USER_DELETE_INLINE_LIMIT=1):
+            self.assertEqual(delete_user(self.student), SCHEDULED)
+        purge_deleted_users()
+        self.assertFalse(User.objects.filter(pk=self.student.pk).exists())
+        self.assertEqual(Lesson.objects.count(), 0)
+
+
+class RequestMetricsTestCase(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        from . import metrics
+
+        cache.clear()
+        metrics.reset()
+        self.staff = User.objects.create_user(username='staff', password='password', is_staff=True)
+        self.teacher = User.objects.create_user(username='teacher', password='password', is_teacher=True)
+
+    def test_views_are_timed_and_exposed(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .metrics import request_metrics
+
+        self.client.login(username='teacher', password='password')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('dashboard'))
+        dashboard_queries = len(queries)  # the next request clears the query log
+        self.client.get('/no-such-page/')
+
+        report = request_metrics()
+        self.assertEqual(report['dashboard']['count'], 1)
+        self.assertEqual(report['dashboard']['db_queries'], dashboard_queries)
+        self.assertEqual(report['dashboard']['buckets'][-1], 1)
+        self.assertEqual(report['unresolved']['count'], 1)
+
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 302)  # staff only
+        self.client.login(username='staff', password='password')
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('# TYPE tutti_request_duration_seconds histogram', body)
+        self.assertIn('tutti_request_duration_seconds_count{view="dashboard"} 1', body)
+        self.assertIn('tutti_request_duration_quantile_seconds{view="dashboard",quantile="0.95"}', body)
+
+    async def test_async_views_count_their_queries(self):
+        from asgiref.sync import sync_to_async
+        from .metrics import request_metrics
+
+        # Under ASGI the queries run on sync_to_async threads, not on the request's own
+        await self.async_client.aforce_login(self.teacher)
+        response = await self.async_client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        entry = (await sync_to_async(request_metrics)())['dashboard']
+        self.assertEqual(entry['count'], 1)
+        self.assertGreater(entry['db_queries'], 0)
+        self.assertGreater(entry['db_seconds'], 0)
+
+    def test_histogram_window_rolls(self):
+        import time
+        from .metrics import record, request_metrics
+
+        record('dashboard', 0.004)
+        record('dashboard', 0.3)
+        record('dashboard', 2.0, status=500)
+        record('dashboard', 0.004, now=time.time() - 15 * 60)  # outside the window
+        entry = request_metrics()['dashboard']
+        self.assertEqual(entry['count'], 3)
+        self.assertEqual(entry['errors'], 1)
+        self.assertEqual(entry['buckets'][0], 1)
+        self.assertEqual(entry['quantiles'][0.5], 0.5)
+        self.assertEqual(entry['quantiles'][0.99], 2.5)
+
+    def test_exported_histogram_only_goes_up(self):
+        import time
+        from .metrics import prometheus_text, record, request_metrics
+
+        record('dashboard', 0.004, now=time.time() - 15 * 60)  # already out of the window
+        record('dashboard', 0.3)
+        report = request_metrics()
+        self.assertEqual((report['dashboard']['count'], report['dashboard']['total']['count']), (1, 2))
+        body = prometheus_text(report)
+        # Prometheus' rate() and histogram_quantile() need the running totals, not the window
+        self.assertIn('tutti_request_duration_seconds_count{view="dashboard"} 2', body)
+        self.assertIn('tutti_request_duration_seconds_bucket{view="dashboard",le="0.005"} 1', body)
+        self.assertIn('# TYPE tutti_request_errors_total counter', body)
+        self.assertIn('tutti_request_duration_quantile_seconds{view="dashboard",quantile="0.5"} 0.5', body)
+
+    def test_slow_requests_are_logged_as_json(self):
+        from .metrics import JsonFormatter
+
+        self.client.login(username='teacher', password='password')
+        with self.settings(SLOW_REQUEST_MS=0), self.assertLogs('tuttiapp.slow_requests', 'WARNING') as logs:
+            self.client.get(reverse('dashboard'))
+        entry = json.loads(JsonFormatter().format(logs.records[0]))
+        self.assertEqual((entry['view'], entry['status'], entry['user_id']), ('dashboard', 200, self.teacher.pk))
+        self.assertIn('db_queries', entry)
+
+
+class BenchmarkSuiteTestCase(TestCase):
+    def test_seeded_data_and_view_benchmark(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from .datagen import rebuild_derived, seed_lessons, seed_transactions, seed_users
+        from .models import MpesaTransaction
+
+        teachers, students = seed_users(3, 'teacher'), seed_users(10, 'student')
+        seed_lessons(300, teachers, students)
+        seed_transactions()
+        rebuild_derived()
+
+        now = timezone.now()
+        self.assertFalse(Lesson.objects.filter(start_time__gt=now, status__in=Lesson.TAUGHT_STATUSES).exists())
+        paid = Lesson.objects.filter(status='PAID')
+        self.assertTrue(paid.exists())
+        self.assertEqual(MpesaTransaction.objects.filter(is_successful=True).count(), paid.count())
+        self.assertEqual(seed_transactions(), 0)  # nothing left to add
+
+        from .models import MpesaCallback
+
+        out = StringIO()
+        lessons = Lesson.objects.count()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            call_command('bench_views', requests=2, only=['dashboard_teacher', 'approve_lesson', 'mpesa_callback'], stdout=out)
+        self.assertTrue(callbacks)  # outside a test each request commits, and this work is timed with it
+        self.assertIn('dashboard_teacher', out.getvalue())
+        self.assertIn('queries', out.getvalue())
+        # What the actions created is deleted again
+        self.assertFalse(Lesson.objects.filter(topic="Benchmark").exists())
+        self.assertEqual(Lesson.objects.count(), lessons)
+        self.assertFalse(MpesaCallback.objects.exists())
+
+
+class ViewQueryBudgetTestCase(TestCase):
+    """
+    Every URL name in tutti/urls.py has a query budget (tuttiapp/querybudget.py). Each view is
+    requested against a small and a large fixture, from a cold cache: it has to stay within its
+    budget and run no more queries for the large one. Failures name the template line (or the
+    line of code) that ran the extra queries.
+    """
+    SMALL, LARGE = 2, 12
+
+    # Django's own pages (django.contrib.auth.urls and the admin) aren't ours to budget.
+    # (url name, who, method, URL args from the fixture, GET params / POST body, budget)
+    SCENARIOS = [
+        ('dashboard', 'teacher', 'get', None, {}, Budget(3)),
+        ('dashboard', 'teacher', 'get', None, {'segment': 'history'}, Budget(3)),
+        ('dashboard', 'student', 'get', None, {}, Budget(3)),
+        ('dashboard', 'admin', 'get', None, {}, Budget(6)),
+        ('teacher_list', 'student', 'get', None, {}, Budget(4)),
+        ('teacher_list', 'student', 'get', None, {'q': 'Piano', 'available': 7}, Budget(4)),
+        ('request_lesson', 'student', 'get', lambda f: [f['teacher'].pk], {}, Budget(4)),
+        ('teacher_availability', 'student', 'get', lambda f: [f['teacher'].pk], {}, Budget(5)),
+        ('approve_lesson', 'teacher', 'post', lambda f: [f['REQUESTED'].pk], {}, Budget(4)),
+        ('decline_lesson', 'teacher', 'post', lambda f: [f['REQUESTED'].pk], {}, Budget(6)),
+        ('bulk_lessons', 'teacher', 'post', lambda f: ['approve'], lambda f: {'ids': f['requested_ids']}, Budget(6)),
+        ('reschedule_lesson', 'teacher', 'get', lambda f: [f['SCHEDULED'].pk], {}, Budget(5)),
+        ('accept_reschedule', 'student', 'post', lambda f: [f['RESCHEDULE_PENDING'].pk], {}, Budget(4)),
+        ('initiate_payment', 'student', 'get', lambda f: [f['unpaid'].pk], {}, Budget(4)),
+        ('payment_pending', 'student', 'get', lambda f: [f['payment'].pk], {}, Budget(3)),
+        ('payment_status', 'student', 'get', lambda f: [f['payment'].pk], {}, Budget(3)),
+        ('mpesa_callback', None, 'post', None, lambda f: f['callback'], Budget(1)),
+        ('complete_lesson', 'teacher', 'post', lambda f: [f['SCHEDULED'].pk], {}, Budget(4)),
+        ('mark_lesson_paid', 'teacher', 'post', lambda f: [f['PENDING_PAYMENT'].pk], {}, Budget(4)),
+        ('signup', None, 'get', None, {}, Budget(0)),
+        ('delete_lesson', 'teacher', 'post', lambda f: [f['CANCELLED'].pk], {}, Budget(6)),
+        ('manage_users', 'admin', 'get', None, {}, Budget(3)),
+        ('manage_users', 'admin', 'get', None, {'q': 'qb_student'}, Budget(5)),
+        # Deletes inline only up to USER_DELETE_INLINE_LIMIT rows. 27 is the whole inline path and does not grow
+        # with the user's history: 3 for session/admin/target, 3 cascade COUNTs, 1 paid-lessons EXISTS, 6 for
+        # _disable (save, teacher card, counter signal), 7 for one batched delete of the unpaid lessons plus the
+        # empty next batch, then series, EXISTS, anonymising save and card. Paid lessons are kept, not deleted,
+        # so their revenue never has to be taken back out row by row.
+        ('delete_user', 'admin', 'post', lambda f: [f['leaving'].pk], {}, Budget(27)),
+        ('cache_stats', 'admin', 'get', None, {}, Budget(2)),
+        ('analytics', 'admin', 'get', None, {}, Budget(8)),
+        ('export_data', 'admin', 'get', lambda f: ['lessons'], {}, Budget(3)),
+        ('export_data', 'admin', 'get', lambda f: ['transactions'], {'format': 'jsonl'}, Budget(3)),
+        ('metrics', 'admin', 'get', None, {}, Budget(2)),
+    ]
+
+    def build_fixture(self, rows):
+        """`rows` of everything a page lists: lessons in each status, payments, teachers, students, users."""
+        from .datagen import rebuild_derived, seed_lessons, seed_transactions, seed_users
+        from .models import MpesaTransaction
+
+        teacher = User.objects.create_user(username='qb_teacher', password='password', is_teacher=True)
+        student = User.objects.create_user(username='qb_student', password='password', is_student=True,
+                                           phone_number='254712345678')
+        admin = User.objects.create_superuser(username='qb_admin', password='password')
+        leaving = User.objects.create_user(username='qb_leaving', password='password', is_student=True)
+        teachers, students = seed_users(rows, 'teacher', prefix='qb'), seed_users(rows, 'student', prefix='qb')
+        seed_lessons(rows * 10, teachers + [teacher.pk], students + [student.pk])
+
+        now = timezone.now()
+        fixture = {'teacher': teacher, 'student': student, 'admin': admin, 'leaving': leaving}
+        for i, (status, _) in enumerate(Lesson.STATUS_CHOICES):
+            past = status in Lesson.TAUGHT_STATUSES or status == 'CANCELLED'
+            lessons = Lesson.objects.bulk_create([
+                Lesson(teacher=teacher, student=student, topic=f"{status} {n}", status=status, price=1500,
+                       start_time=now + datetime.timedelta(days=-30 if past else 30, hours=i * rows + n))
+                for n in range(rows)
+            ])
+            fixture[status] = lessons[0]
+        Lesson.objects.bulk_create([
+            Lesson(teacher=teacher, student=leaving, topic=f"{status.title()} {n}", status=status, price=1500,
+                   start_time=now - datetime.timedelta(days=60, hours=n))
+            for status in ('PAID', 'COMPLETED', 'CANCELLED') for n in range(rows)
+        ])
+        fixture['requested_ids'] = list(Lesson.objects.filter(teacher=teacher, status='REQUESTED').values_list('pk', flat=True))
+        fixture['unpaid'] = Lesson.objects.filter(teacher=teacher, status='PENDING_PAYMENT').last()
+        seed_transactions()
+        fixture['payment'] = MpesaTransaction.objects.create(
+            lesson=fixture['unpaid'], amount=1500, phone_number='254712345678', checkout_request_id='ws_CO_qb')
+        fixture['callback'] = {'Body': {'stkCallback': {
+            'MerchantRequestID': 'qb', 'CheckoutRequestID': 'ws_CO_qb', 'ResultCode': 0,
+            'ResultDesc': 'The service request is processed successfully.',
+            'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'QB0001'}]},
+        }}}
+        rebuild_derived()
+        return fixture
+
+    def measure(self, rows):
+        """Builds the fixture, requests every scenario once and rolls it all back. {scenario: QueryRecorder}."""
+        from django.core.cache import cache
+        from django.db import connection, transaction
+        from .querybudget import QueryRecorder
+
+        class Rollback(Exception):
+            pass
+
+        recorders = {}
+        try:
+            with transaction.atomic():
+                fixture = self.build_fixture(rows)
+                for i, (name, who, method, args, data, _) in enumerate(self.SCENARIOS):
+                    client = Client()
+                    if who:
+                        client.force_login(fixture[who])
+                    path = reverse(name, args=args(fixture) if args else None)
+                    data = data(fixture) if callable(data) else data
+                    kwargs = {'content_type': 'application/json'} if method == 'post' and data else {}
+                    cache.clear()  # every view pays for its cache misses, the same for both fixtures
+                    recorder = QueryRecorder()
+                    try:
+                        with transaction.atomic():  # keeps the fixture the same for the next scenario
+                            with connection.execute_wrapper(recorder):
+                                response = getattr(client, method)(path, data, **kwargs)
+                                if response.streaming:
+                                    b''.join(response.streaming_content)
+                            raise Rollback
+                    except Rollback:
+                        pass
+                    self.assertLess(response.status_code, 400, f"{name} {data}: {response.status_code}")
+                    recorders[i] = recorder
+                raise Rollback
+        except Rollback:
+            pass
+        return recorders
+
+    def test_every_url_name_has_a_budget(self):
+        from tutti.urls import urlpatterns
+        from django.urls import URLPattern
+
+        names = {pattern.name for pattern in urlpatterns if isinstance(pattern, URLPattern) and pattern.name}
+        budgeted = {scenario[0] for scenario in self.SCENARIOS}
+        self.assertEqual(names - budgeted, set(), "Add these views to ViewQueryBudgetTestCase.SCENARIOS")
+
+    def test_query_counts_stay_within_budget_and_flat(self):
+        from .querybudget import growth_report
+
+        small, large = self.measure(self.SMALL), self.measure(self.LARGE)
+        problems = []
+        for i, (name, who, method, args, data, budget) in enumerate(self.SCENARIOS):
+            label = f"{name} ({who or 'anonymous'} {method.upper()}{' ' + str(data) if data and not callable(data) else ''})"
+            if len(large[i]) > len(small[i]) + budget.per_row * (self.LARGE - self.SMALL):
+                problems.append(
+                    f"{label}: {len(small[i])} queries with {self.SMALL} rows, {len(large[i])} with {self.LARGE}. "
+                    f"Extra queries:\n{growth_report(small[i], large[i])}"
+                )
+            elif len(large[i]) > budget.allows(self.LARGE):
+                problems.append(f"{label}: {len(large[i])} queries, budget {budget.allows(self.LARGE)}")
+        self.assertFalse(problems, '\n'.join(problems))
+
+    def test_growth_report_names_the_template_line(self):
+        from django.db import connection
+        from django.template import Context, Engine
+        from .querybudget import QueryRecorder, growth_report
+
+        engine = Engine(loaders=[('django.template.loaders.locmem.Loader', {
+            'lessons.html': "<ul>\n{% for lesson in lessons %}\n<li>{{ lesson.student.username }}</li>\n{% endfor %}\n</ul>",
+        })])
+        template = engine.get_template('lessons.html')
+        teacher = User.objects.create_user(username='teacher', is_teacher=True)
+        student = User.objects.create_user(username='student', is_student=True)
+
+        def render(count):
+            Lesson.objects.bulk_create([
+                Lesson(teacher=teacher, student=student, topic="N+1", start_time=timezone.now() + datetime.timedelta(days=1, hours=i))
+                for i in range(count)
+            ])
+            recorder = QueryRecorder()
+            with connection.execute_wrapper(recorder):
+                template.render(Context({'lessons': Lesson.objects.order_by('pk')}))
+            Lesson.objects.all().delete()
+            return recorder
+
+        report = growth_report(render(2), render(5))
+        self.assertIn("+3 at lessons.html line 3: {{ lesson.student.username }}", report)
+        self.assertIn('"tuttiapp_user"', report)
+
+
+class DatabaseTuningTestCase(TestCase):
+    def test_sqlite_connections_get_the_tuned_pragmas(self):
+        import tempfile
+        from django.conf import settings
+        from django.db import connection
+        from django.db.backends.sqlite3.base import DatabaseWrapper
+        from .db import sqlite_pragmas
+
+        self.assertEqual(connection.settings_dict['OPTIONS'].get('transaction_mode'), 'IMMEDIATE')
+        with tempfile.TemporaryDirectory() as directory:
+            # A second connection to a database file, set up the way the app's own connections are
+            wrapper = DatabaseWrapper({**connection.settings_dict, 'NAME': os.path.join(directory, 'tuned.sqlite3')}, 'tuned')
+            try:
+                pragmas = sqlite_pragmas(wrapper)
+            finally:
+                wrapper.close()
+        self.assertEqual(pragmas['journal_mode'], 'wal')
+        self.assertEqual(pragmas['synchronous'], 1)  # NORMAL
+        self.assertEqual(pragmas['busy_timeout'], settings.SQLITE_PRAGMAS['busy_timeout'])
+        self.assertEqual(pragmas['mmap_size'], settings.SQLITE_PRAGMAS['mmap_size'])
+        self.assertEqual(pragmas['cache_size'], settings.SQLITE_PRAGMAS['cache_size'])
+
+    def test_in_memory_databases_keep_their_journal(self):
+        from django.db import connection
+        from .db import sqlite_pragmas
+
+        self.assertTrue(connection.is_in_memory_db())
+        self.assertEqual(sqlite_pragmas(connection)['journal_mode'], 'memory')
+        self.assertEqual(sqlite_pragmas(connection)['synchronous'], 1)
+
+    def test_write_benchmark_needs_a_database_file(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        with self.assertRaisesMessage(CommandError, "Needs a database file"):
+            call_command('bench_writes', writes=1)
+
+
+class AsyncViewsTestCase(TestCase):
+    def setUp(self):
+        from .daraja_stub import DarajaStub
+        from .models import MpesaTransaction
+        from .mpesa import reset_gateway
+        from django.core.cache import cache
+
+        cache.clear()
+        self.stub = DarajaStub().start()
+        self.addCleanup(self.stub.stop)
+        settings_override = override_settings(MPESA_API_BASE_URL=self.stub.url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_gateway()
+        self.addCleanup(reset_gateway)
+
+        self.teacher = User.objects.create_user(username='teacher', is_teacher=True)
+        self.student = User.objects.create_user(username='student', is_student=True)
+        self.lesson = Lesson.objects.create(teacher=self.teacher, student=self.student, topic="Scales",
+                                            start_time=timezone.now() + datetime.timedelta(days=1),
+                                            status='PENDING_PAYMENT')
+        self.payment = MpesaTransaction.objects.create(lesson=self.lesson, amount=1500, phone_number='254712345678',
+                                                       push_status=MpesaTransaction.PUSH_QUEUED)
+
+    def test_read_and_callback_views_are_async(self):
+        from asgiref.sync import iscoroutinefunction
+        from . import views
+
+        for view in (views.dashboard, views.payment_pending, views.payment_status, views.mpesa_callback):
+            self.assertTrue(iscoroutinefunction(view), view.__name__)
+
+    async def test_views_under_the_async_client(self):
+        from .models import MpesaCallback
+
+        await self.async_client.aforce_login(self.student)
+        response = await self.async_client.get(reverse('payment_status', args=[self.payment.id]))
+        self.assertEqual(response.json()['state'], 'queued')
+        response = await self.async_client.get(reverse('dashboard'))
+        self.assertContains(response, "Scales")
+
+        response = await self.async_client.post(reverse('mpesa_callback'), {'Body': {'stkCallback': {
+            'ResultCode': 0, 'CheckoutRequestID': 'ws_CO_async'}}}, content_type='application/json')
+        self.assertEqual(response.json()['ResultDesc'], 'Accepted')
+        self.assertTrue(await MpesaCallback.objects.filter(checkout_request_id='ws_CO_async').aexists())
+
+        await self.async_client.aforce_login(await User.objects.acreate(username='other', is_student=True))
+        response = await self.async_client.get(reverse('payment_status', args=[self.payment.id]))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_async_push_updates_the_status(self):
+        from .models import MpesaTransaction
+        from .payments import aget_payment_status, asend_stk_push
+
+        self.assertEqual((await aget_payment_status(self.payment.id))['state'], 'queued')
+        await asend_stk_push(self.payment.id)
+        payment = await MpesaTransaction.objects.aget(pk=self.payment.id)
+        self.assertEqual(payment.push_status, MpesaTransaction.PUSH_SENT)
+        self.assertTrue(payment.checkout_request_id)
+        self.assertEqual((await aget_payment_status(self.payment.id))['state'], 'waiting_for_pin')  # invalidated
+        self.assertEqual(self.stub.calls, {'token': 1, 'stk_push': 1})
+
+    async def test_async_gateway_with_and_without_httpx(self):
+        import asyncio
+        from .mpesa import AsyncMpesaGateway
+
+        for use_httpx in (None, False):
+            gateway = AsyncMpesaGateway(base_url=self.stub.url, use_httpx=use_httpx)
+            try:
+                responses = await asyncio.gather(*(
+                    gateway.stk_push('0712345678', 1500, f"Tutti-{i}", "Lesson", 'https://example.com/cb/')
+                    for i in range(10)
+                ))
+                self.assertTrue(all(r.response_code == '0' for r in responses))
+                self.stub.query_results[responses[0].checkout_request_id] = (1032, 'Request cancelled by user')
+                self.stub.revoke_tokens()
+                query = await gateway.stk_query(responses[0].checkout_request_id)  # 401 -> new token -> retried
+                self.assertEqual((query.result_code, query.result_desc), ('1032', 'Request cancelled by user'))
+                self.assertEqual(gateway.metrics()['stk_push']['calls'], 10)
+            finally:
+                await gateway.aclose()
+        self.assertEqual(self.stub.calls['stk_push'], 20)
+        self.assertEqual(self.stub.calls['token'], 4)  # one per gateway, one after each revocation
@@ -2,11 +2,12 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.views.decorators.http import require_POST
 from django.contrib import messages
-from .models import Lesson, MpesaTransaction, User
-from django_daraja.mpesa.core import MpesaClient
+from .models import Lesson, MpesaTransaction, User, MAX_LESSON_MINUTES, InvalidTransition
+from .payments import aget_payment_status, is_stale_push, queue_stk_push # background STK pushes
 from .forms import LessonRequestForm
 
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest # exports stream differently under ASGI
 from django.views.decorators.csrf import csrf_exempt
 import json
 from .forms import MpesaPaymentForm
@@ -14,59 +15,112 @@ from .models import validate_kenyan_phone
 
 from django.db.models import Sum, Count # this is for aggregations like total revenue
 from django.db.models import Q # For search queries
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .pagination import akeyset_paginate # cursor pagination for the dashboard lesson table
+from .stats import aget_admin_stats # running totals for the admin dashboard
+from .callbacks import aingest_callback # M-Pesa callback inbox
+from .scheduling import SlotTaken, book, is_slot_free, next_free_slots # teacher availability
+from .marketplace import CARD_CACHE_SECONDS, marketplace_page # paginated teacher cards
+from .search import list_users, search_users # indexed user search for manage_users
+from . import cache as app_cache # namespaced cache + hit/miss counters
+from .bulk import DELETED, UPDATED, BulkActionError, apply_bulk_action # bulk teacher actions
+from .series import approve_series, create_series, decline_series # recurring lessons
+from .exports import ExportError, astream as export_astream, parse_filters, stream as export_stream # finance exports
+from .rollups import analytics_summary # revenue & utilisation analytics
+from .deletion import INLINE as DELETED_INLINE, delete_user as delete_user_service # cascade-safe user deletion
+from . import metrics as request_metrics # per-view timings for /metrics
+
+DASHBOARD_SEGMENTS = ('upcoming', 'history')
 
 # ==========================================
 # 1. THE DASHBOARD (Home Base)
 # ==========================================
 @login_required # Ensure only logged-in users can access
-def dashboard(request):
-    user = request.user # Get the logged-in user
+async def dashboard(request):
+    # Async: every read below goes through the async ORM / cache, so under ASGI the page
+    # doesn't hold a thread while it waits for the database.
+    user = await _auser(request) # Get the logged-in user
     context = {} # Initialize empty context
 
     # === SCENARIO 1: THE SUPERUSER (Admin) ===
     if user.is_superuser:
         # 1. High Level Stats
-        total_students = User.objects.filter(is_student=True).count()
-        total_teachers = User.objects.filter(is_teacher=True).count()
+        # These are running totals kept up to date by tuttiapp/stats.py and served from the cache,
+        # so this no longer COUNTs the users / SUMs the payments on every load.
+        admin_stats = await aget_admin_stats()
         
-        # Calculate Revenue (Sum of successful M-Pesa transactions)
-        # We use 'aggregate' which returns a dictionary like {'amount__sum': 5000}
-        revenue_data = MpesaTransaction.objects.filter(is_successful=True).aggregate(Sum('amount'))
-        total_revenue = revenue_data['amount__sum'] or 0
-        
-        # 2. Recent Data for the Tables
-        recent_transactions = MpesaTransaction.objects.all().order_by('-transaction_date')[:5]
-        recent_users = User.objects.all().order_by('-date_joined')[:5]
+        # 2. Recent Data for the Tables (both are indexed, so only 5 rows are read)
+        # Read here rather than by the template: templates can't run async queries
+        recent_transactions = [tx async for tx in MpesaTransaction.objects.all().order_by('-transaction_date')[:5]]
+        recent_users = [u async for u in User.objects.all().order_by('-date_joined')[:5]]
         
         context = {
             'is_admin': True, # Flag to tell template to show Admin Mode
-            'total_students': total_students,
-            'total_teachers': total_teachers,
-            'total_revenue': total_revenue,
+            'total_students': admin_stats['total_students'],
+            'total_teachers': admin_stats['total_teachers'],
+            'total_revenue': admin_stats['total_revenue'],
+            'revenue_by_day': admin_stats['revenue_by_day'],
             'recent_transactions': recent_transactions,
             'recent_users': recent_users,
         }
 
-    # === SCENARIO 2: THE TEACHER ===
-    elif user.is_teacher:
-        my_lessons = Lesson.objects.filter(teacher=user).order_by('start_time')
-        context = {'lessons': my_lessons}
+    # === SCENARIO 2 & 3: THE TEACHER / THE STUDENT ===
+    elif user.is_teacher or user.is_student:
+        if user.is_teacher:
+            my_lessons = Lesson.objects.feed().for_teacher(user)
+        else:
+            my_lessons = Lesson.objects.feed().for_student(user)
+
+        # Split into "upcoming" (soonest first) and "history" (most recent first),
+        # then show one keyset page of the chosen segment.
+        segment = request.GET.get('segment')
+        if segment not in DASHBOARD_SEGMENTS:
+            segment = 'upcoming'
+        now = timezone.now()
+        if segment == 'upcoming':
+            page = await akeyset_paginate(my_lessons.upcoming(now), request.GET.get('cursor'))
+        else:
+            page = await akeyset_paginate(my_lessons.history(now), request.GET.get('cursor'), descending=True)
 
-    # === SCENARIO 3: THE STUDENT ===
-    elif user.is_student:
-        my_lessons = Lesson.objects.filter(student=user).order_by('start_time')
-        context = {'lessons': my_lessons}
+        context = {
+            'lessons': page,
+            'segment': segment,
+            'next_cursor': page.next_cursor,
+        }
 
     return render(request, 'tuttiapp/dashboard.html', context)
 
+
+async def _auser(request):
+    # The async views load the user with `await request.auser()`, and hand it to request.user too:
+    # the templates' {{ user }} would otherwise load it again with sync code, which can't run here.
+    request.user = await request.auser()
+    return request.user
+
 # ==========================================
 # 2. MARKETPLACE (Find & Request Teachers)
 # ==========================================
 @login_required
 def teacher_list(request):
-    """Displays a list of all users marked as teachers."""
-    teachers = User.objects.filter(is_teacher=True)
-    return render(request, 'tuttiapp/teacher_list.html', {'teachers': teachers})
+    """
+    Displays the teachers, a page at a time, from their precomputed cards (tuttiapp/marketplace.py).
+    Optional filters: ?q=<topic or name> and ?available=<days> (has a free slot within that many days).
+    """
+    keyword = (request.GET.get('q') or '').strip()
+    try:
+        available = int(request.GET.get('available') or 0)
+    except ValueError:
+        available = 0
+    page = marketplace_page(keyword, available, request.GET.get('page'))
+
+    context = {
+        'teachers': page,
+        'search_term': keyword,
+        'available': available,
+        'card_cache_seconds': CARD_CACHE_SECONDS,
+    }
+    return render(request, 'tuttiapp/teacher_list.html', context)
 
 @login_required
 def request_lesson(request, teacher_id):
@@ -74,8 +128,17 @@ def request_lesson(request, teacher_id):
     target_teacher = get_object_or_404(User, pk=teacher_id)
     
     if request.method == 'POST':
-        form = LessonRequestForm(request.POST)
-        if form.is_valid():
+        form = LessonRequestForm(request.POST, teacher=target_teacher)
+        if form.is_valid() and form.cleaned_data.get('repeat'):
+            # A recurring booking: only the next few weeks of lessons are created now
+            series = create_series(
+                teacher=target_teacher, student=request.user, topic=form.cleaned_data['topic'],
+                first_start=form.cleaned_data['start_time'], interval_weeks=form.cleaned_data['repeat'],
+                occurrences=form.cleaned_data['repeat_count'],
+            )
+            messages.success(request, f"Request for {series.occurrences} lessons sent to {target_teacher.username}!")
+            return redirect('dashboard')
+        elif form.is_valid():
             # Create the lesson object but don't save to DB yet
             lesson = form.save(commit=False)
             
@@ -84,33 +147,76 @@ def request_lesson(request, teacher_id):
             lesson.teacher = target_teacher
             lesson.status = 'REQUESTED'  # Important!
             
-            lesson.save()
-            
-            messages.success(request, f"Request sent to {target_teacher.username}!")
-            return redirect('dashboard')
+            try:
+                book(lesson)  # checks the slot again under the teacher's lock, then saves
+            except SlotTaken:
+                form.add_error('start_time', f"{target_teacher.username} was just booked at that time. Please pick another slot.")
+            else:
+                messages.success(request, f"Request sent to {target_teacher.username}!")
+                return redirect('dashboard')
     else:
-        form = LessonRequestForm()
+        form = LessonRequestForm(teacher=target_teacher)
 
     context = {
         'form': form,
-        'teacher': target_teacher
+        'teacher': target_teacher,
+        'next_slots': next_free_slots(target_teacher, timezone.now()), # shown as suggestions on the form
     }
     return render(request, 'tuttiapp/request_lesson.html', context)
 
 
+@login_required
+def teacher_availability(request, teacher_id):
+    """
+    JSON: is ?start=<ISO datetime> free for this teacher (for ?duration= minutes, default 60),
+    and the next free slots from that time.
+    """
+    teacher = get_object_or_404(User, pk=teacher_id, is_teacher=True)
+    start = parse_datetime(request.GET.get('start', '')) or timezone.now()
+    if timezone.is_naive(start):
+        start = timezone.make_aware(start)
+    try:
+        duration = min(max(int(request.GET.get('duration', 60)), 1), MAX_LESSON_MINUTES)
+    except ValueError:
+        duration = 60
+
+    return JsonResponse({
+        'teacher': teacher.id,
+        'start': start.isoformat(),
+        'duration_minutes': duration,
+        'is_free': is_slot_free(teacher, start, duration),
+        'next_free_slots': [slot.isoformat() for slot in next_free_slots(teacher, start, duration)],
+    })
+
+
 # ==========================================
 # 3. TEACHER ACTIONS (Approve/Decline)
 # ==========================================
+def _transition(request, lesson, to_status, *fields):
+    """Lesson.transition() for the views: tells the user instead of failing if the status moved on."""
+    try:
+        lesson.transition(to_status, *fields)
+        return True
+    except InvalidTransition as e:
+        messages.error(request, f"This lesson is already {e.lesson.get_status_display()}, so that can't be done now.")
+        return False
+    except Lesson.DoesNotExist:  # deleted by someone else since we loaded it
+        messages.error(request, "This lesson no longer exists.")
+        return False
+
 @login_required
 @require_POST
 def approve_lesson(request, lesson_id):
-    lesson = get_object_or_404(Lesson, pk=lesson_id)
+    lesson = get_object_or_404(Lesson.objects.only('id', 'status', 'teacher_id', 'series'), pk=lesson_id)
     
     # Security check: Only the assigned teacher can approve
-    if request.user == lesson.teacher:
-        lesson.status = 'SCHEDULED'
-        lesson.save()
-        messages.success(request, "Lesson Confirmed!")
+    if request.user.id == lesson.teacher_id and lesson.series_id and lesson.status == 'REQUESTED':
+        # Part of a recurring booking: it is accepted as a whole
+        approved = approve_series(lesson.series)
+        messages.success(request, f"Weekly lessons confirmed ({approved} scheduled so far)!")
+    elif request.user.id == lesson.teacher_id:
+        if _transition(request, lesson, 'SCHEDULED'):
+            messages.success(request, "Lesson Confirmed!")
     else:
         messages.error(request, "You are not authorized to approve this.")
         
@@ -121,13 +227,43 @@ def approve_lesson(request, lesson_id):
 def decline_lesson(request, lesson_id):
     lesson = get_object_or_404(Lesson, pk=lesson_id)
     
-    if request.user == lesson.teacher:
+    if request.user == lesson.teacher and lesson.series_id and lesson.status == 'REQUESTED':
+        decline_series(lesson.series) # the whole recurring booking
+        messages.warning(request, "Request declined.")
+    elif request.user == lesson.teacher:
         lesson.delete() # Or you could set status to 'CANCELLED'
         messages.warning(request, "Request declined.")
         
     return redirect('dashboard')
 
 
+@login_required
+@require_POST
+def bulk_lessons(request, action):
+    """
+    JSON API: apply one teacher action to many lessons at once (see tuttiapp/bulk.py).
+    Body: {"ids": [1, 2, 3]} (or form fields ids=1&ids=2). Answers with the outcome per lesson id.
+    """
+    if request.content_type == 'application/json':
+        try:
+            lesson_ids = json.loads(request.body or b'{}').get('ids', [])
+        except (ValueError, AttributeError):
+            return JsonResponse({'error': "Body must be a JSON object with an 'ids' list"}, status=400)
+    else:
+        lesson_ids = request.POST.getlist('ids')
+
+    try:
+        results = apply_bulk_action(request.user, action, lesson_ids)
+    except BulkActionError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({
+        'action': action,
+        'changed': sum(1 for result in results.values() if result['outcome'] in (UPDATED, DELETED)),
+        'results': {str(lesson_id): result for lesson_id, result in results.items()},
+    })
+
+
 # ==================================
 # ==================================
     
@@ -152,9 +288,12 @@ def reschedule_lesson(request, lesson_id):
         form = LessonRescheduleForm(request.POST, instance=lesson)
         if form.is_valid():
             lesson = form.save(commit=False)
-            lesson.status = 'RESCHEDULE_PENDING' # Change status so student sees it
-            lesson.save()
-            messages.success(request, "Reschedule proposal sent to student.")
+            lesson.is_student_reminder_sent = False # remind the student again for the new time
+            lesson.reminder_claim = None
+            # Change status so student sees it (only the edited columns are written)
+            if _transition(request, lesson, 'RESCHEDULE_PENDING', 'start_time', 'topic',
+                           'is_student_reminder_sent', 'reminder_claim'):
+                messages.success(request, "Reschedule proposal sent to student.")
             return redirect('dashboard')
     else:
         # Pre-fill the form with the current data
@@ -166,20 +305,25 @@ def reschedule_lesson(request, lesson_id):
 @login_required
 @require_POST
 def accept_reschedule(request, lesson_id):
-    lesson = get_object_or_404(Lesson, pk=lesson_id)
+    lesson = get_object_or_404(Lesson.objects.only('id', 'status', 'teacher_id', 'student_id'), pk=lesson_id)
     
-    if request.user == lesson.student:
-        lesson.status = 'SCHEDULED' # Make it official again
-        lesson.save()
-        messages.success(request, "New time accepted!")
+    if request.user.id == lesson.student_id:
+        if _transition(request, lesson, 'SCHEDULED'): # Make it official again
+            messages.success(request, "New time accepted!")
     
     return redirect('dashboard')
 
 
-# 1. THE PAYMENT PAGE (Show Form & Trigger STK)
+# 1. THE PAYMENT PAGE (Show Form & Queue STK)
 @login_required
 def initiate_payment(request, lesson_id):
     lesson = get_object_or_404(Lesson, pk=lesson_id)
+
+    # A push that is still in flight (or already paid) shouldn't be sent twice.
+    # One stuck in the queue (lost by a restarted worker) may be retried.
+    existing = MpesaTransaction.objects.filter(lesson=lesson).first()
+    if existing and existing.payment_state in ('queued', 'waiting_for_pin', 'paid') and not is_stale_push(existing):
+        return redirect('payment_pending', payment_id=existing.id)
     
     if request.method == 'POST':
         form = MpesaPaymentForm(request.POST)
@@ -190,32 +334,12 @@ def initiate_payment(request, lesson_id):
                 # 1. Sanitize the phone number (07XX -> 2547XX)
                 phone_number = validate_kenyan_phone(raw_phone)
                 
-                # 2. Setup M-Pesa Client
-                client = MpesaClient()
-                amount = int(lesson.price)
-                account_reference = f"Tutti-{lesson.id}"
-                transaction_desc = f"Lesson: {lesson.topic}"
+                # 2. Queue the STK Push. The actual call to Safaricom happens in the background
+                # (tuttiapp/payments.py) so this request returns straight away.
+                payment = queue_stk_push(lesson, phone_number)
                 
-                # IMPORTANT: This URL must be accessible from the internet
-                callback_url = 'https://tutti-pnpn.onrender.com/mpesa/callback/'  # Replace with your actual callback URL. i have just used a dummy one here.
-                
-                # 3. Fire STK Push
-                response = client.stk_push(phone_number, amount, account_reference, transaction_desc, callback_url)
-                
-                # 4. Save the Checkout Request ID to track the payment
-                # Note: response is an object, we access attributes directly
-                if response.response_code == '0':
-                    MpesaTransaction.objects.create(
-                        lesson=lesson,
-                        checkout_request_id=response.checkout_request_id,
-                        phone_number=phone_number,
-                        amount=amount
-                    )
-                    messages.success(request, f"STK Push sent to {phone_number}. Enter your PIN!")
-                else:
-                    messages.error(request, f"M-Pesa Error: {response.response_description}")
-
-                return redirect('dashboard')
+                # 3. Send the student to the page that polls the payment status
+                return redirect('payment_pending', payment_id=payment.id)
                 
             except Exception as e:
                 messages.error(request, f"Error: {str(e)}")
@@ -227,49 +351,40 @@ def initiate_payment(request, lesson_id):
     return render(request, 'tuttiapp/pay_confirm.html', {'form': form, 'lesson': lesson})
 
 
+async def _payment_status_for(request, payment_id):
+    # Only the student paying and their teacher may see a payment
+    user = await _auser(request)
+    status = await aget_payment_status(payment_id)
+    if status is None or user.id not in (status['student_id'], status['teacher_id']):
+        raise Http404("No such payment")
+    return status
+
+
+@login_required
+async def payment_pending(request, payment_id):
+    """The "check your phone" page. It polls payment_status until the payment is settled."""
+    status = await _payment_status_for(request, payment_id)
+    return render(request, 'tuttiapp/payment_pending.html', {'payment': status})
+
+
+@login_required
+async def payment_status(request, payment_id):
+    """Lightweight JSON for the pay page to poll (served from the cache). Async: polls hold no thread."""
+    status = await _payment_status_for(request, payment_id)
+    return JsonResponse({key: status[key] for key in ('id', 'state', 'message', 'lesson_id')})
+
+
 # 2. THE CALLBACK (Safaricom talks to us)
 @csrf_exempt # Safaricom doesn't have our CSRF token, so we exempt this view
-def mpesa_callback(request):
+async def mpesa_callback(request):
+    """
+    Only stores the raw callback in the inbox and answers straight away.
+    The worker (manage.py process_mpesa_callbacks) marks the transaction and lesson as paid,
+    so a burst of payments or a retried callback can't slow down or double-apply here.
+    """
     if request.method == 'POST':
-        try:
-            # 1. Parse the JSON response
-            body = json.loads(request.body)
-            stk_callback = body.get('Body', {}).get('stkCallback', {})
-            
-            result_code = stk_callback.get('ResultCode')
-            checkout_id = stk_callback.get('CheckoutRequestID')
-            result_desc = stk_callback.get('ResultDesc')
+        await aingest_callback(request.body.decode('utf-8', errors='replace'))
 
-            # 2. Find the transaction
-            transaction = MpesaTransaction.objects.get(checkout_request_id=checkout_id)
-            
-            # 3. Update Transaction Status
-            if result_code == 0:
-                # Success!
-                transaction.is_successful = True
-                transaction.result_desc = "Payment Successful"
-                
-                # Extract Receipt Number
-                items = stk_callback.get('CallbackMetadata', {}).get('Item', [])
-                for item in items:
-                    if item.get('Name') == 'MpesaReceiptNumber':
-                        transaction.mpesa_receipt_number = item.get('Value')
-                
-                transaction.save()
-                
-                # 4. MARK LESSON AS PAID
-                lesson = transaction.lesson
-                lesson.status = 'PAID'
-                lesson.save()
-            else:
-                # User cancelled or failed
-                transaction.is_successful = False
-                transaction.result_desc = result_desc
-                transaction.save()
-                
-        except Exception as e:
-            print(f"Callback Error: {e}")
-            
     return JsonResponse({"ResultCode": 0, "ResultDesc": "Accepted"})
 
 
@@ -281,13 +396,12 @@ def complete_lesson(request, lesson_id):
     This triggers the status change to PENDING_PAYMENT,
     which reveals the Pay button to the student.
     """
-    lesson = get_object_or_404(Lesson, pk=lesson_id)
+    lesson = get_object_or_404(Lesson.objects.only('id', 'status', 'teacher_id'), pk=lesson_id)
     
     # Security: Only the teacher can do this
-    if request.user == lesson.teacher:
-        lesson.status = 'PENDING_PAYMENT'
-        lesson.save()
-        messages.success(request, "Lesson marked as Complete. Payment requested from student.")
+    if request.user.id == lesson.teacher_id:
+        if _transition(request, lesson, 'PENDING_PAYMENT'):
+            messages.success(request, "Lesson marked as Complete. Payment requested from student.")
     else:
         messages.error(request, "You are not authorized to manage this lesson.")
         
@@ -302,12 +416,11 @@ def mark_lesson_paid(request, lesson_id):
     Manual override for cash payments or testing.
     Only the Teacher can perform this.
     """
-    lesson = get_object_or_404(Lesson, pk=lesson_id)
+    lesson = get_object_or_404(Lesson.objects.only('id', 'status', 'teacher_id'), pk=lesson_id)
     
-    if request.user == lesson.teacher:
-        lesson.status = 'PAID'
-        lesson.save()
-        messages.success(request, "Payment recorded manually (Cash/Test).")
+    if request.user.id == lesson.teacher_id:
+        if _transition(request, lesson, 'PAID'):
+            messages.success(request, "Payment recorded manually (Cash/Test).")
     else:
         messages.error(request, "Not authorized.")
         
@@ -362,17 +475,17 @@ def manage_users(request):
     Admin-only page to view and manage all users.
     """
     # Get search term (if any)
-    query = request.GET.get('q')
+    query = (request.GET.get('q') or '').strip()
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        page = 1
     
     if query:
-        # Search by username, email, or phone
-        users = User.objects.filter(
-            Q(username__icontains=query) | 
-            Q(email__icontains=query) | 
-            Q(phone_number__icontains=query)
-        ).order_by('-date_joined')
+        # Search by username, email, or phone (ranked, see tuttiapp/search.py)
+        users = search_users(query, page=page)
     else:
-        users = User.objects.all().order_by('-date_joined')
+        users = list_users(page=page)
 
     return render(request, 'tuttiapp/manage_users.html', {'users': users, 'search_term': query})
 
@@ -391,7 +504,71 @@ def delete_user(request, user_id):
         return redirect('manage_users')
         
     username = user_to_delete.username
-    user_to_delete.delete()
-    messages.success(request, f"User '{username}' has been deleted.")
+    # Small accounts go at once; big ones are disabled now and purged in the background
+    if delete_user_service(user_to_delete) == DELETED_INLINE:
+        messages.success(request, f"User '{username}' has been deleted.")
+    else:
+        messages.success(request, f"User '{username}' has been disabled and will be deleted in the background. Paid lessons are kept for the accounts.")
     
-    return redirect('manage_users')
\ No newline at end of file
+    return redirect('manage_users')
+
+@user_passes_test(lambda u: u.is_superuser)
+def cache_stats(request):
+    """
+    Admin-only JSON: cache hits and misses per namespace (see tuttiapp/cache.py), summed over all
+    workers when the cache backend is shared. POST ?reset=1 starts the counts again.
+    """
+    if request.method == 'POST' and request.GET.get('reset'):
+        app_cache.reset_stats()
+    return JsonResponse(app_cache.cache_stats())
+
+
+@user_passes_test(lambda u: u.is_staff)
+def metrics(request):
+    """
+    Staff-only: per-view request counts, duration histograms and percentiles, DB queries and DB time
+    over the last few minutes, in the Prometheus text format (see tuttiapp/metrics.py).
+    """
+    text = request_metrics.prometheus_text(request_metrics.request_metrics())
+    return HttpResponse(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@user_passes_test(lambda u: u.is_superuser)
+def export_data(request, kind):
+    """
+    Admin-only: the full lessons / transactions table as a CSV or JSON Lines download (see tuttiapp/exports.py).
+    ?format=csv|jsonl &from=YYYY-MM-DD &to=YYYY-MM-DD &teacher=<id> &status=<lesson status or payment state>
+    """
+    fmt = request.GET.get('format', 'csv')
+    try:
+        filters = parse_filters(request.GET.get('from'), request.GET.get('to'),
+                                request.GET.get('teacher'), request.GET.get('status'))
+        # Under ASGI only an async iterator is streamed; a sync one would be read whole first
+        lines = (export_astream if isinstance(request, ASGIRequest) else export_stream)(kind, fmt, **filters)
+    except ExportError as e:
+        return HttpResponseBadRequest(str(e))
+
+    content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(lines, content_type=f'{content_type}; charset=utf-8')
+    filename = f"tutti-{kind}-{timezone.localdate():%Y%m%d}.{fmt}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+ANALYTICS_RANGES = (7, 30, 90, 365)
+
+@user_passes_test(lambda u: u.is_superuser)
+def analytics(request):
+    """
+    Admin-only: revenue, lesson counts, payment latency and teacher utilisation for the last ?days=30.
+    Reads the rollup tables only (see tuttiapp/rollups.py), never the lessons themselves.
+    """
+    try:
+        days = int(request.GET.get('days', 30))
+    except ValueError:
+        days = 30
+    if days not in ANALYTICS_RANGES:
+        days = 30
+    context = analytics_summary(days)
+    context['ranges'] = ANALYTICS_RANGES
+    return render(request, 'tuttiapp/analytics.html', context)